@@ -0,0 +1,252 @@
+"""
+Durable alert outbox (SQLite) and its delivery worker.
+
+The pipeline only calls enqueue(): the alert text plus the chart *data* are committed to the
+local queue and ingestion moves on. The worker (python alert_outbox.py) renders the charts,
+sends the due messages in batches over a single SMTP session and retries failures with
+exponential backoff; messages that keep failing are parked as 'dead' for inspection.
+"""
+import os
+import time
+import json
+import random
+import sqlite3
+import argparse
+import logging
+import smtplib
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.image import MIMEImage
+from dotenv import load_dotenv
+
+# Setup Logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Load Environment Variables
+load_dotenv()
+
+# Configuration
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+OUTBOX_PATH = os.getenv("ALERT_OUTBOX_PATH", os.path.join(DATA_DIR, "alert_outbox.sqlite"))
+OUTBOX_BATCH_SIZE = int(os.getenv("ALERT_BATCH_SIZE", 20))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("ALERT_MAX_ATTEMPTS", 6))
+OUTBOX_BACKOFF_S = float(os.getenv("ALERT_BACKOFF_S", 30))
+OUTBOX_POLL_S = float(os.getenv("ALERT_POLL_S", 10))
+
+# SMTP Config
+SMTP_SERVER = os.getenv("SMTP_SERVER")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_USER = os.getenv("SMTP_USER")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
+ALERT_RECEIVER = os.getenv("ALERT_RECEIVER")
+ALERT_SENDER = os.getenv("ALERT_SENDER", SMTP_USER or "alertas@localhost")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    chart TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at);
+"""
+
+
+def connect(path=OUTBOX_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def chart_spec(series, title, filename):
+    """Serializable description of a bar chart (rendered later by the worker)."""
+    return {
+        'title': title,
+        'filename': filename,
+        'labels': [str(i) for i in series.index],
+        'values': [float(v) for v in series.to_numpy()]
+    }
+
+
+def enqueue(subject, body, chart=None, path=OUTBOX_PATH):
+    """Durably queues one alert; returns its outbox id. Never talks to SMTP."""
+    now = time.time()
+    with connect(path) as conn:
+        cur = conn.execute(
+            "INSERT INTO outbox (created_at, subject, body, chart, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+            (now, subject, body, json.dumps(chart) if chart else None, now)
+        )
+        alert_id = cur.lastrowid
+    conn.close()
+    logging.info(f"Alert queued #{alert_id}: {subject}")
+    return alert_id
+
+
+def create_trend_chart(chart, out_dir):
+    """Renders a chart spec to PNG; returns the file path (None on failure)."""
+    try:
+        import matplotlib
+        matplotlib.use('Agg')  # non-interactive backend
+        import matplotlib.pyplot as plt
+
+        plt.figure(figsize=(10, 6))
+        plt.bar(chart['labels'], chart['values'], color='#00f2ff', edgecolor='black')
+        plt.title(chart['title'], fontsize=14, fontweight='bold', color='black')
+        plt.ylabel('Volumen', fontsize=12)
+        plt.xlabel('Periodo (Mes)', fontsize=12)
+        plt.xticks(rotation=90)
+        plt.grid(axis='y', linestyle='--', alpha=0.7)
+        plt.tight_layout()
+        chart_path = os.path.join(out_dir, chart.get('filename') or 'alerta.png')
+        plt.savefig(chart_path)
+        plt.close()
+        return chart_path
+    except Exception as e:
+        logging.error(f"Failed to create chart: {e}")
+        return None
+
+
+def build_message(row, out_dir):
+    msg = MIMEMultipart()
+    msg['From'] = ALERT_SENDER
+    msg['To'] = ALERT_RECEIVER
+    msg['Subject'] = row['subject']
+    msg.attach(MIMEText(row['body'], 'plain'))
+
+    if row['chart']:
+        chart = json.loads(row['chart'])
+        image_path = create_trend_chart(chart, out_dir)
+        if image_path and os.path.exists(image_path):
+            with open(image_path, 'rb') as f:
+                msg.attach(MIMEImage(f.read(), name=os.path.basename(image_path)))
+            os.remove(image_path)
+    return msg
+
+
+def open_smtp():
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+    if SMTP_STARTTLS:
+        server.starttls()
+    if SMTP_USER and SMTP_PASSWORD:
+        server.login(SMTP_USER, SMTP_PASSWORD)
+    return server
+
+
+def backoff_delay(attempts, base=OUTBOX_BACKOFF_S):
+    """Exponential backoff with +/-20% jitter."""
+    return base * (2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+
+
+def claim_due(conn, limit):
+    conn.row_factory = sqlite3.Row
+    return conn.execute(
+        "SELECT * FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+        (time.time(), limit)
+    ).fetchall()
+
+
+def mark_sent(conn, alert_id):
+    conn.execute("UPDATE outbox SET status = 'sent', sent_at = ?, attempts = attempts + 1, last_error = NULL WHERE id = ?", (time.time(), alert_id))
+
+
+def mark_failed(conn, row, error, max_attempts, base_delay):
+    attempts = row['attempts'] + 1
+    if attempts >= max_attempts:
+        conn.execute("UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?", (attempts, str(error), row['id']))
+        logging.error(f"Alert #{row['id']} dead after {attempts} attempts: {error}")
+    else:
+        delay = backoff_delay(attempts, base_delay)
+        conn.execute("UPDATE outbox SET attempts = ?, last_error = ?, next_attempt_at = ? WHERE id = ?",
+                     (attempts, str(error), time.time() + delay, row['id']))
+        logging.warning(f"Alert #{row['id']} failed (attempt {attempts}), retrying in {delay:.0f} s: {error}")
+
+
+def drain(path=OUTBOX_PATH, batch_size=OUTBOX_BATCH_SIZE, max_attempts=OUTBOX_MAX_ATTEMPTS, base_delay=OUTBOX_BACKOFF_S):
+    """
+    Delivers every alert that is due, `batch_size` messages per SMTP session.
+    Returns {'sent': n, 'failed': n}. Without SMTP settings alerts are printed and marked sent.
+    """
+    stats = {'sent': 0, 'failed': 0}
+    out_dir = os.path.dirname(os.path.abspath(path))
+    conn = connect(path)
+    try:
+        while True:
+            rows = claim_due(conn, batch_size)
+            if not rows:
+                break
+
+            if not all([SMTP_SERVER, ALERT_RECEIVER]):
+                logging.warning("SMTP settings missing. Printing alerts instead of sending.")
+                for row in rows:
+                    print(f"--- FAKE EMAIL ALERT ---\nSubject: {row['subject']}\nBody: {row['body']}\nChart Attached: {bool(row['chart'])}\n------------------------")
+                    with conn:
+                        mark_sent(conn, row['id'])
+                    stats['sent'] += 1
+                continue
+
+            try:
+                server = open_smtp()
+            except Exception as e:
+                # Nothing in this batch can go out; every message backs off
+                with conn:
+                    for row in rows:
+                        mark_failed(conn, row, f"SMTP connect: {e}", max_attempts, base_delay)
+                stats['failed'] += len(rows)
+                break
+
+            start = time.perf_counter()
+            try:
+                for row in rows:
+                    try:
+                        server.send_message(build_message(row, out_dir))
+                        with conn:
+                            mark_sent(conn, row['id'])
+                        stats['sent'] += 1
+                    except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                        # Session lost: this row backs off, the rest are picked up by the next batch
+                        with conn:
+                            mark_failed(conn, row, e, max_attempts, base_delay)
+                        stats['failed'] += 1
+                        break
+                    except Exception as e:
+                        with conn:
+                            mark_failed(conn, row, e, max_attempts, base_delay)
+                        stats['failed'] += 1
+            finally:
+                try:
+                    server.quit()
+                except Exception:
+                    pass
+            logging.info(f"Alert batch: {len(rows)} messages in {time.perf_counter() - start:.2f} s over one SMTP session")
+    finally:
+        conn.close()
+    return stats
+
+
+def run_worker(path=OUTBOX_PATH, poll_interval=OUTBOX_POLL_S, once=False):
+    logging.info(f"Alert worker watching {path}")
+    while True:
+        stats = drain(path)
+        if stats['sent'] or stats['failed']:
+            logging.info(f"Alert worker: {stats['sent']} sent, {stats['failed']} failed")
+        if once:
+            return stats
+        time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CFDI Alert Outbox Worker")
+    parser.add_argument("--once", action="store_true", help="Deliver what is due and exit")
+    parser.add_argument("--outbox", default=OUTBOX_PATH, help="Path to the SQLite outbox")
+    parser.add_argument("--poll", type=float, default=OUTBOX_POLL_S, help="Seconds between polls")
+    args = parser.parse_args()
+    run_worker(args.outbox, args.poll, once=args.once)
@@ -1,17 +1,25 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import pandas as pd
-import pymongo
 import plotly.express as px
 import plotly.graph_objects as go
 import os
 from dotenv import load_dotenv
 import json
+import logging
 import numpy as np
 import hashlib
 from streamlit_option_menu import option_menu # Import Option Menu
 import textwrap # For dedenting HTML strings
 import audit_module # Moved to top
+import schema_registry
+import gold_store
+import rollups
+import payments
+import payroll
+import concept_taxes
+import mongo_pool
+import dataset_cache
 
 # ============================================================================
 # CONFIGURACIÓN DE SUBMENÚS PREMIUM
@@ -20,7 +28,8 @@ SUBMENU_CONFIG = {
     "Cuenta T": [
         {"label": "KPIs Operativos", "key": "kpis"},
         {"label": "Análisis Estructural", "key": "estructural"},
-        {"label": "Tendencias", "key": "tendencias"}
+        {"label": "Tendencias", "key": "tendencias"},
+        {"label": "Nómina", "key": "nomina"}
     ],
     "Materialidad / REPSE": [
         {"label": "Normativa", "key": "normativa"},
@@ -39,7 +48,9 @@ SUBMENU_CONFIG = {
     ],
     "Configuración": [
         {"label": "General", "key": "general"},
-        {"label": "Modelos AI", "key": "ai"}
+        {"label": "Modelos AI", "key": "ai"},
+        {"label": "Conexiones", "key": "conexiones"},
+        {"label": "Caché de Datos", "key": "cache"}
     ]
 }
 
@@ -470,111 +481,169 @@ def plot_dark_histogram(df, x_col, y_col, color_col, title):
     return fig
 
 # --- Data Loading ---
-@st.cache_data(ttl=600)
-def load_data(company_id):
+@dataset_cache.tenant_cached
+def load_filter_options(company_id):
+    """(tipos, first date, last date) of the tenant's gold records for the sidebar filters; None if there are none."""
+    mongo_uri = os.getenv("MONGO_URI")
+    if mongo_uri:
+        try:
+            db = mongo_pool.get_db(os.getenv("DB_NAME", "cfdi_db"), uri=mongo_uri)
+            options = gold_store.mongo_filter_options(db[os.getenv("COLLECTION_NAME", "gold_cfdi")], company_id)
+            if options is not None:
+                return options
+        except Exception as e:
+            pass
+    gold_dir = os.getenv("GOLD_DIR", os.path.join(os.getenv("DATA_DIR", "./data"), "gold_cfdi"))
+    try:
+        gold = gold_store.read_tenant(gold_dir, company_id, columns=['tipo', 'fecha_emision'])
+        if gold is not None:
+            return gold_store.filter_options(gold)
+    except Exception as e:
+        pass
+    df = load_data(company_id)
+    return gold_store.filter_options(df) if df is not None else None
+
+
+def load_data(company_id, tipos=None, dates=None):
+    """
+    The tenant's gold records for the dashboard. `tipos` and a (start, end) `dates` range are
+    pushed down into the Mongo query / Parquet partitions, so only the selected window is read
+    (the local JSON export is filtered in memory). An empty window keeps the gold columns.
+    """
     mongo_uri = os.getenv("MONGO_URI")
     db_name = os.getenv("DB_NAME", "cfdi_db")
     collection_name = os.getenv("COLLECTION_NAME", "gold_cfdi")
     
-    df = pd.DataFrame()
+    windowed = tipos is not None or dates is not None
+    df = None
     
     # Try MongoDB
     if mongo_uri:
         try:
-            client = pymongo.MongoClient(mongo_uri, serverSelectionTimeoutMS=2000)
-            db = client[db_name]
+            db = mongo_pool.get_db(db_name, uri=mongo_uri)
             collection = db[collection_name]
             # --- MANDATORY FILTER BY COMPANY ---
-            data = list(collection.find({"company_id": company_id}))
-            if data:
-                df = pd.DataFrame(data)
-                if '_id' in df.columns:
-                    df = df.drop(columns=['_id'])
+            df = gold_store.read_mongo(collection, company_id, exclude=gold_store.GOLD_UNUSED_COLUMNS,
+                                       batch_size=int(os.getenv("MONGO_READ_BATCH", 5000)), tipos=tipos, dates=dates)
         except Exception as e:
-            pass
+            logging.warning(f"Gold read from MongoDB failed for {company_id}: {e}")
     
-    # Fallback to local JSON
-    if df.empty:
-        local_path = os.path.join(os.getenv("DATA_DIR", "./data"), "gold_cfdi_processed.json")
+    # Fallback to the local Parquet gold layer (only this tenant's partitions)
+    gold_dir = os.getenv("GOLD_DIR", os.path.join(os.getenv("DATA_DIR", "./data"), "gold_cfdi"))
+    if df is None:
+        try:
+            df = gold_store.read_tenant(gold_dir, company_id, exclude=gold_store.GOLD_UNUSED_COLUMNS, tipos=tipos, dates=dates)
+        except Exception as e:
+            logging.warning(f"Gold read from {gold_dir} failed for {company_id}: {e}")
+
+    # Fallback to the tenant's local JSON (read whole, then windowed in memory), unless the tenant has Parquet gold outside the window.
+    # The shared gold_cfdi_processed.json is the single-tenant export of earlier runs (and the bundled demo data).
+    if df is None and not (windowed and os.path.isdir(gold_store.tenant_dir(gold_dir, company_id))):
+        data_dir = os.getenv("DATA_DIR", "./data")
+        local_path = gold_store.json_path(data_dir, company_id)
+        shared = not os.path.exists(local_path)
+        if shared:
+            local_path = os.path.join(data_dir, "gold_cfdi_processed.json")
         if os.path.exists(local_path):
             with open(local_path, 'r') as f:
                 data = json.load(f)
-            df = pd.DataFrame(data)
-        else:
-            return None
-
-    # Post-processing
-    if not df.empty:
-        # 1. Enforce Datetime
-        if 'fecha_emision' in df.columns:
-            # Bug Fix: Do NOT force numeric first, as it destroys ISO date strings.
-            # 1. Try direct conversion (handles strings like "2026-01-15" and mixed types)
-            df['fecha_emision_dt'] = pd.to_datetime(df['fecha_emision'], errors='coerce')
-            
-            # 2. If we have NaNs, they might be numeric timestamps (e.g. from Mongo export)
-            if df['fecha_emision_dt'].isna().any():
-                 # Try converting the original column to numeric, then to datetime
-                 numeric_dates = pd.to_numeric(df['fecha_emision'], errors='coerce')
-                 # Fill NaNs in the datetime column with the converted numeric timestamps
-                 df['fecha_emision_dt'] = df['fecha_emision_dt'].fillna(pd.to_datetime(numeric_dates, unit='ms', errors='coerce'))
-            
-            df['fecha_emision'] = df['fecha_emision_dt']
-            df = df.drop(columns=['fecha_emision_dt'])
-            df = df.dropna(subset=['fecha_emision']) # Drop invalid dates
-            
-            df['month'] = df['fecha_emision'].dt.to_period('M').astype(str)
-            df['year'] = df['fecha_emision'].dt.year
-            df['week'] = df['fecha_emision'].dt.to_period('W').astype(str)
-            df['ventas_netas_calc'] = (df['subtotal'] + df['calc_iva']) - (df['calc_retenciones'] + df['descuento'])
-
-        # 2. Enforce Numeric Columns (Critical for Calculations)
-        numeric_cols = ['subtotal', 'total', 'descuento', 'calc_iva', 'calc_ieps', 'calc_ret_isr', 'calc_ret_iva', 'calc_retenciones', 'calc_traslados']
-        for col in numeric_cols:
-            if col in df.columns:
-                # Remove currency symbols if present
-                if df[col].dtype == object:
-                     df[col] = df[col].astype(str).str.replace(r'[$,]', '', regex=True)
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-            else:
-                df[col] = 0.0
+            df = pd.DataFrame(data) if shared else gold_store.tenant_rows(pd.DataFrame(data), company_id)
+            df = gold_store.filter_frame(gold_store.dashboard_frame(df), tipos, dates)
 
-        # 3. Data Integrity & Normalization (RFCs)
-        # Ensure we have standard 'emisor_rfc' and 'receptor_rfc' columns
-        
-        # Check for common variations
-        if 'rfc_emisor' in df.columns and 'emisor_rfc' not in df.columns:
-            df['emisor_rfc'] = df['rfc_emisor']
-        elif 'emisor' in df.columns and 'emisor_rfc' not in df.columns: # Sometimes 'emisor' holds the RFC
-             df['emisor_rfc'] = df['emisor']
-
-        if 'rfc_receptor' in df.columns and 'receptor_rfc' not in df.columns:
-            df['receptor_rfc'] = df['rfc_receptor']
-        elif 'receptor' in df.columns and 'receptor_rfc' not in df.columns:
-             df['receptor_rfc'] = df['receptor']
-             
-        # Fill N/A for safety in str operations
-        if 'emisor_rfc' not in df.columns: df['emisor_rfc'] = 'XAXX010101000'
-        if 'receptor_rfc' not in df.columns: df['receptor_rfc'] = 'XAXX010101000'
-        if 'emisor_nombre' not in df.columns: df['emisor_nombre'] = 'DESCONOCIDO'
-        if 'receptor_nombre' not in df.columns: df['receptor_nombre'] = 'DESCONOCIDO'
+    # Empty window: the gold columns without rows, so the views render an empty selection
+    if df is None:
+        return gold_store.empty_frame(gold_store.GOLD_UNUSED_COLUMNS) if windowed else None
+
+    return gold_store.dashboard_frame(df)
+
+
+@dataset_cache.tenant_cached
+def load_enriched(company_id, tipos=None, dates=None):
+    """
+    Enrichment stage: the windowed gold records (load_data) with receptor_rfc filled from the
+    receptor catalog, and the concept_index of their concepts (addressed by invoice uuid).
+    Cached per tenant and data version, so reruns and other sessions reuse the joined frames.
+    """
+    df = load_data(company_id, tipos, dates)
+    if df is None or df.empty:
+        return df, audit_module.concept_index(pd.DataFrame())
+    _, df_receptors = load_catalogs()
+    df = audit_module.fill_receptor_rfcs(df, df_receptors)
+    return df, audit_module.concept_index(audit_module.attach_concept_uuids(load_conceptos(), df))
+
+
+@dataset_cache.tenant_cached
+def load_ppd(company_id, tipos=None, dates=None):
+    """
+    Reconciled PPD invoices of the window (load_enriched) indexed by normalized uuid, so the
+    flujo view's per-invoice lookup is one hash probe. None without reconciled payments.
+    """
+    df, _ = load_enriched(company_id, tipos, dates)
+    if df is None or 'pago_estatus' not in df.columns or 'metodo_pago' not in df.columns:
+        return None
+    ppd = df[(df['metodo_pago'].astype(str).str.upper() == 'PPD') & df['pago_estatus'].notna()]
+    return ppd.set_index(pd.Index(payments.normalize_uuid(ppd['uuid']), name=None))
+
+
+@dataset_cache.tenant_cached
+def load_rollup(company_id):
+    """Monthly rollup written by the migration (same source order as load_data); None if there is none."""
+    mongo_uri = os.getenv("MONGO_URI")
+    if mongo_uri:
+        try:
+            rollup = rollups.load(company_id, db=mongo_pool.get_db(os.getenv("DB_NAME", "cfdi_db"), uri=mongo_uri))
+            if rollup is not None:
+                return rollup
+        except Exception as e:
+            pass
+    try:
+        return rollups.load(company_id)
+    except Exception as e:
+        return None
+
+
+@dataset_cache.tenant_cached
+def load_payroll(company_id):
+    """Gold nómina dataset written by the migration (same source order as load_data); None if there is none."""
+    mongo_uri = os.getenv("MONGO_URI")
+    if mongo_uri:
+        try:
+            rows = payroll.load(company_id, db=mongo_pool.get_db(os.getenv("DB_NAME", "cfdi_db"), uri=mongo_uri))
+            if rows is not None:
+                return rows
+        except Exception as e:
+            pass
+    try:
+        return payroll.load(company_id)
+    except Exception as e:
+        return None
 
 
-    return df
+@dataset_cache.tenant_cached
+def load_concept_lines(company_id):
+    """Concept-level tax lines written by the migration (same source order as load_data); None if there are none."""
+    mongo_uri = os.getenv("MONGO_URI")
+    if mongo_uri:
+        try:
+            lines = concept_taxes.load(company_id, db=mongo_pool.get_db(os.getenv("DB_NAME", "cfdi_db"), uri=mongo_uri))
+            if lines is not None:
+                return lines
+        except Exception as e:
+            pass
+    try:
+        return concept_taxes.load(company_id)
+    except Exception as e:
+        return None
 
 
 @st.cache_data(ttl=600)
 def load_conceptos():
     """Loads the concepts catalog for detailed invoice visualization."""
-    path = os.path.join(os.getenv("DATA_DIR", "./data"), "cfdi_conceptos.csv")
-    if os.path.exists(path):
-        try:
-            return pd.read_csv(path, encoding='utf-8')
-        except:
-             try:
-                 return pd.read_csv(path, encoding='latin-1')
-             except:
-                 return pd.DataFrame()
-    return pd.DataFrame()
+    try:
+        df = schema_registry.read_table('cfdi_conceptos', os.getenv("DATA_DIR", "./data"))
+    except Exception:
+        df = None
+    return df if df is not None else pd.DataFrame()
 
 # --- Load Catalogs (Moved here for logic continuity) ---
 @st.cache_data(ttl=600)
@@ -582,17 +651,15 @@ def load_catalogs():
     """Loads Emisors and Receptors for the Audit Module."""
     data_dir = os.getenv("DATA_DIR", "./data")
     
-    def load_safe(filename):
-        path = os.path.join(data_dir, filename)
-        if os.path.exists(path):
-            try: return pd.read_csv(path, encoding='utf-8')
-            except: 
-                try: return pd.read_csv(path, encoding='latin-1')
-                except: return pd.DataFrame()
-        return pd.DataFrame()
-
-    df_emisors = load_safe("cfdi_emisors.csv")
-    df_receptors = load_safe("cfdi_receptors.csv")
+    def load_safe(table):
+        try:
+            df = schema_registry.read_table(table, data_dir)
+        except Exception:
+            df = None
+        return df if df is not None else pd.DataFrame()
+
+    df_emisors = load_safe("cfdi_emisors")
+    df_receptors = load_safe("cfdi_receptors")
     return df_emisors, df_receptors
 
 # --- SECURITY UTILS ---
@@ -621,8 +688,7 @@ def check_login(cid, user, password):
                 "password_hash": "mock"
             }
 
-    client = pymongo.MongoClient(os.getenv("MONGO_URI"))
-    db = client[os.getenv("DB_NAME", "cfdi_db")]
+    db = mongo_pool.get_db(os.getenv("DB_NAME", "cfdi_db"), uri=os.getenv("MONGO_URI"))
     users_col = db["users"]
     user_doc = users_col.find_one({"company_id": cid, "username": user})
     if user_doc and user_doc["password_hash"] == hash_password(password):
@@ -671,54 +737,12 @@ if st.session_state.authenticated:
     # --- INJECT CSS & ASSETS ---
     render_futuristic_header()
 
-    # --- LOAD DATA ---
-    df = load_data(st.session_state.company_id)
-    df_conceptos = load_conceptos()
-
-    if df is not None and not df.empty:
-        # --- ENRICHMENT: JOIN WITH CATALOGS ---
-        # Fix missing Receptor RFC by joining with catalog
-        if 'receptor_id' in df.columns and not df_receptors.empty:
-            # Prepare receptor catalog for merge
-            cat_rec = df_receptors[['id', 'rfc']].rename(columns={'id': 'receptor_id', 'rfc': 'catalog_receptor_rfc'})
-            # Merge
-            df = df.merge(cat_rec, on='receptor_id', how='left')
-            # Fill receptor_rfc if it was missing or generic
-            if 'receptor_rfc' in df.columns:
-                 df['receptor_rfc'] = df['catalog_receptor_rfc'].fillna(df['receptor_rfc'])
-            else:
-                 df['receptor_rfc'] = df['catalog_receptor_rfc']
-            
-            # Clean up temporary column
-            df = df.drop(columns=['catalog_receptor_rfc'], errors='ignore')
-            
-            # Ensure no NaNs remain after merge (fallback to generic if catalog also fails)
-            df['receptor_rfc'] = df['receptor_rfc'].fillna(df['receptor'].fillna('XAXX010101000') if 'receptor' in df.columns else 'XAXX010101000')
-
-        # --- ENRICHMENT: MAP CONCEPTS TO UUID ---
-        # The concepts loaded from CSV use 'cfdi_id' which links to 'id' in gold_cfdi.
-        # But audit_module expects 'uuid' in concepts. We must map it.
-        if not df_conceptos.empty and 'cfdi_id' in df_conceptos.columns and 'id' in df.columns:
-            # Create mapping: id -> uuid
-            mapping = df[['id', 'uuid']].drop_duplicates().astype(str) # Ensure string types for matching
-            
-            # Ensure proper types for merge keys
-            df_conceptos['cfdi_id'] = df_conceptos['cfdi_id'].astype(str)
-            
-            # Merge to add uuid to concepts
-            df_conceptos = df_conceptos.merge(
-                mapping, 
-                left_on='cfdi_id', 
-                right_on='id', 
-                how='left'
-            )
-            # Cleanup
-            df_conceptos = df_conceptos.drop(columns=['id'], errors='ignore')
-
-
-    if df is None:
+    # --- FILTER OPTIONS (tipos and date span, answered without loading the history) ---
+    filter_options = load_filter_options(st.session_state.company_id)
+    if filter_options is None:
         st.error("SISTEMA OFFLINE: FUENTE DE DATOS INACCESIBLE.")
         st.stop()
+    tipo_opts, min_date, max_date = filter_options
 
     # --- CUSTOM FILTER SIDEBAR ---
     # This container is targeted by CSS to become the sidebar
@@ -730,8 +754,7 @@ if st.session_state.authenticated:
         st.markdown("---")
         
         # --- FILTERS CONTENT ---
-        if 'tipo' in df.columns:
-            tipo_opts = df['tipo'].unique()
+        if tipo_opts:
             selected_tipo = st.multiselect("Tipo Comprobante", tipo_opts, default=tipo_opts)
         else:
             selected_tipo = []
@@ -745,27 +768,50 @@ if st.session_state.authenticated:
         st.markdown("---")
         
         # Date Range Filter
-        if not df.empty and 'fecha_emision' in df.columns:
-            min_date = df['fecha_emision'].min().date()
-            max_date = df['fecha_emision'].max().date()
+        if min_date is not None:
             date_range = st.date_input("Rango de Fechas", value=(min_date, max_date), min_value=min_date, max_value=max_date)
         else:
             date_range = []
 
+    # --- LOAD DATA (only the window selected in the sidebar) ---
+    # The default selection (every tipo, full date span) reads the whole history
+    tipo_query = tuple(sorted(selected_tipo)) if selected_tipo and set(selected_tipo) != set(tipo_opts) else None
+    date_query = tuple(date_range) if len(date_range) == 2 and tuple(date_range) != (min_date, max_date) else None
+    df, concept_idx = load_enriched(st.session_state.company_id, tipo_query, date_query)
+    df_rollup = load_rollup(st.session_state.company_id)
+    df_payroll = load_payroll(st.session_state.company_id)
+
+    if df is None:
+        st.error("SISTEMA OFFLINE: FUENTE DE DATOS INACCESIBLE.")
+        st.stop()
+
     # --- APPLY FILTERS ---
+    # load_data already returns only the selected window; the mask is kept as a guard
     # Default mask (all true)
-    mask = pd.Series([True] * len(df))
+    mask = pd.Series(True, index=df.index)
     
     if selected_tipo:
         mask = mask & (df['tipo'].isin(selected_tipo))
         
-    # Apply Date Filter
+    # Apply Date Filter (datetime bounds: no per-row date objects on every rerun)
     if len(date_range) == 2:
         start_date, end_date = date_range
-        mask = mask & (df['fecha_emision'].dt.date >= start_date) & (df['fecha_emision'].dt.date <= end_date)
+        mask = mask & (df['fecha_emision'] >= pd.Timestamp(start_date)) & (df['fecha_emision'] < pd.Timestamp(end_date) + pd.Timedelta(days=1))
         
     df_filtered = df.loc[mask]
 
+    # Aggregate views are answered from the monthly rollup when the filters cover whole month groups
+    rollup_filtered = None
+    if df_rollup is not None:
+        start_date, end_date = date_range if len(date_range) == 2 else (None, None)
+        rollup_filtered = rollups.select(df_rollup, selected_tipo if selected_tipo else None, start_date, end_date)
+
+    # Payroll rows are monthly: keep the periods the date range touches
+    payroll_filtered = df_payroll
+    if df_payroll is not None and len(date_range) == 2:
+        first_period, last_period = (d.strftime('%Y-%m') for d in date_range)
+        payroll_filtered = df_payroll[(df_payroll['periodo'] >= first_period) & (df_payroll['periodo'] <= last_period)]
+
 
     # --- FIXED HEADER WRAPPER ---
     # Container for sticky header
@@ -1545,7 +1591,48 @@ if selected_module == "Configuración":
             st.rerun()
             
     st.divider()
-    st.info("Configuración del sistema - Módulo en desarrollo")
+    if selected_subtab == "conexiones":
+        # Pool shared by every session of this server process (see mongo_pool.py)
+        st.markdown('<div class="section-header">POOL DE CONEXIONES MONGODB</div>', unsafe_allow_html=True)
+        if not os.getenv("MONGO_URI"):
+            st.info("MONGO_URI no configurado: el tablero lee la capa gold local.")
+        else:
+            if st.button("Verificar conexión"):
+                health = mongo_pool.health(os.getenv("MONGO_URI"), force=True)
+            else:
+                health = mongo_pool.health(os.getenv("MONGO_URI"))
+            if health['ok']:
+                st.success(f"🟢 MongoDB disponible | ping {health['latency_ms']:.1f} ms")
+            else:
+                st.error(f"🔴 MongoDB no disponible | {health['error']}")
+
+            pool = mongo_pool.metrics()
+            p1, p2, p3, p4 = st.columns(4)
+            with p1: render_stat_element("Conexiones Abiertas", f"{pool['open']}", f"Máximo {pool['max_pool_size']} | Mínimo {pool['min_pool_size']}")
+            with p2: render_stat_element("En Uso", f"{pool['checked_out']}", f"Pico {pool['max_checked_out']}")
+            with p3: render_stat_element("Espera Promedio", f"{pool['wait_avg_ms']:.2f} ms", f"Máxima {pool['wait_max_ms']:.2f} ms")
+            with p4: render_stat_element("Fallos de Checkout", f"{pool['checkout_failures']}", f"Límite de espera {pool['wait_queue_timeout_ms']} ms", "#dc2626" if pool['checkout_failures'] else "var(--text-primary)")
+            st.caption(f"Checkouts: {pool['checkouts']:,} | Conexiones creadas: {pool['created']:,} | "
+                       f"cerradas: {pool['closed']:,} | Pools reiniciados: {pool['pool_clears']:,}")
+    elif selected_subtab == "cache":
+        # Tenant datasets shared by every session of this server process (see dataset_cache.py)
+        st.markdown('<div class="section-header">CACHÉ DE DATASETS</div>', unsafe_allow_html=True)
+        totals, entries = dataset_cache.stats()
+        k1, k2, k3, k4 = st.columns(4)
+        with k1: render_stat_element("Memoria en Uso", f"{totals['bytes'] / 1e6:,.1f} MB", f"Presupuesto {totals['budget_bytes'] / 1e6:,.0f} MB")
+        with k2: render_stat_element("Datasets", f"{totals['entries']}", f"Desalojados {totals['evictions']:,}")
+        with k3: render_stat_element("Tasa de Aciertos", f"{totals['hit_rate']:.1%}", f"{totals['hits']:,} aciertos | {totals['misses']:,} fallos")
+        with k4: render_stat_element("Invalidaciones", f"{totals['invalidations']:,}", f"Versión de datos: {dataset_cache.current_version(st.session_state.company_id) or 'sin sello'}")
+        if not entries.empty:
+            st.dataframe(entries.rename(columns={
+                'dataset': 'Dataset', 'company_id': 'Empresa', 'args': 'Filtros', 'mb': 'MB', 'hits': 'Aciertos',
+                'misses': 'Fallos', 'load_s': 'Carga (s)', 'version': 'Versión', 'age_s': 'Antigüedad (s)'
+            }), use_container_width=True, hide_index=True)
+        if st.button("Vaciar caché de la empresa"):
+            dataset_cache.clear(company_id=st.session_state.company_id)
+            st.rerun()
+    else:
+        st.info("Configuración del sistema - Módulo en desarrollo")
 
 elif selected_module == "Cuenta T":
     
@@ -1557,13 +1644,24 @@ elif selected_module == "Cuenta T":
         # --- SECCIÓN 1: VOLUMETRÍA Y SECCIÓN 2: ESTADÍSTICA (MISMO NIVEL VISUAL) ---
         st.markdown("<div class='section-header'>Volumetría y Control Operativo</div>", unsafe_allow_html=True)
 
-        # Robust filtering for 'Ingreso', 'I', 'egreso', 'E', etc.
-        ing_mask = df_filtered['tipo'].astype(str).str.upper().str.startswith('I')
-        egr_mask = df_filtered['tipo'].astype(str).str.upper().str.startswith('E')
-        ing = df_filtered.loc[ing_mask, 'total'].sum()
-        egr = df_filtered.loc[egr_mask, 'total'].sum()
-        vol = len(df_filtered)
-        avg = df_filtered['total'].mean() if vol > 0 else 0
+        if rollup_filtered is not None:
+            stats = rollups.summary(rollup_filtered)
+            by_tipo = rollups.sums_by(rollup_filtered, 'tipo')
+            tipo_upper = by_tipo.index.astype(str).str.upper()
+            ing = by_tipo[tipo_upper.str.startswith('I')].sum()
+            egr = by_tipo[tipo_upper.str.startswith('E')].sum()
+            vol = stats['count']
+            avg = stats['mean']
+            t_max, t_min, t_std = stats['max'], stats['min'], stats['std']
+        else:
+            # Robust filtering for 'Ingreso', 'I', 'egreso', 'E', etc.
+            ing_mask = df_filtered['tipo'].astype(str).str.upper().str.startswith('I')
+            egr_mask = df_filtered['tipo'].astype(str).str.upper().str.startswith('E')
+            ing = df_filtered.loc[ing_mask, 'total'].sum()
+            egr = df_filtered.loc[egr_mask, 'total'].sum()
+            vol = len(df_filtered)
+            avg = df_filtered['total'].mean() if vol > 0 else 0
+            t_max, t_min, t_std = df_filtered['total'].max(), df_filtered['total'].min(), df_filtered['total'].std()
 
         v1, v2, v3, v4 = st.columns(4)
         with v1: render_stat_element("Volumen CFDI", f"{vol:,}", "Total Transacciones", "var(--color-primary)")
@@ -1577,9 +1675,9 @@ elif selected_module == "Cuenta T":
         st.markdown("<div class='section-header'>Inteligencia Estadística y Distribución</div>", unsafe_allow_html=True)
 
         s1, s2, s3, s4 = st.columns(4)
-        with s1: render_stat_element("Monto Máximo", f"${df_filtered['total'].max():,.2f}", "Peak Value")
-        with s2: render_stat_element("Desviación Est.", f"${df_filtered['total'].std():,.2f}", "Sigma Variance")
-        with s3: render_stat_element("Rango Operativo", f"${df_filtered['total'].max() - df_filtered['total'].min():,.2f}", "Full Spread")
+        with s1: render_stat_element("Monto Máximo", f"${t_max:,.2f}", "Peak Value")
+        with s2: render_stat_element("Desviación Est.", f"${t_std:,.2f}", "Sigma Variance")
+        with s3: render_stat_element("Rango Operativo", f"${t_max - t_min:,.2f}", "Full Spread")
         with s4: render_stat_element("Promedio", f"${avg:,.2f}", "Mean Density")
 
         # LÍNEA DIVISORIA
@@ -1641,7 +1739,10 @@ elif selected_module == "Cuenta T":
         
         with c_cat1:
             if 'tipo' in df_filtered.columns:
-                df_tipo = df_filtered.groupby('tipo', observed=False)['total'].sum().reset_index()
+                if rollup_filtered is not None:
+                    df_tipo = rollups.sums_by(rollup_filtered, 'tipo').reset_index()
+                else:
+                    df_tipo = df_filtered.groupby('tipo', observed=False)['total'].sum().reset_index()
                 # Updated N/P to dark grey for visibility on light background
                 color_map = {'I': '#39d353', 'E': '#f85149', 'N': '#57606a', 'P': '#57606a'}
                 fig_tipo = px.bar(
@@ -1676,7 +1777,10 @@ elif selected_module == "Cuenta T":
                 title = "Uso de CFDI"
             
             if cat_col:
-                df_cat = df_filtered.groupby(cat_col, observed=False)['total'].sum().reset_index()
+                if rollup_filtered is not None:
+                    df_cat = rollups.sums_by(rollup_filtered, cat_col).reset_index()
+                else:
+                    df_cat = df_filtered.groupby(cat_col, observed=False)['total'].sum().reset_index()
                 fig_cat = px.pie(
                     df_cat, values='total', names=cat_col, 
                     title=title,
@@ -1751,7 +1855,10 @@ elif selected_module == "Cuenta T":
         if not df_filtered.empty:
             # Preparamos los datos semanalmente (o según filtro)
             time_agg_p = time_agg_code if 'time_agg_code' in locals() else 'W'
-            df_w = df_filtered.set_index('fecha_emision').resample(time_agg_p)['total'].sum().reset_index()
+            if time_agg_p == 'M' and rollup_filtered is not None:
+                df_w = rollups.monthly(rollup_filtered).rename_axis('fecha_emision').reset_index()
+            else:
+                df_w = df_filtered.set_index('fecha_emision').resample(time_agg_p)['total'].sum().reset_index()
 
             # Creamos la gráfica de área con mejoras visuales
             fig_area = px.area(
@@ -1803,7 +1910,10 @@ elif selected_module == "Cuenta T":
         
         st.markdown('<div class="section-header">CASCADA FINANCIERA</div>', unsafe_allow_html=True)
         
-        sums = df_filtered[['ventas_brutas', 'calc_traslados', 'calc_retenciones', 'descuento', 'ventas_netas_calc']].sum()
+        if rollup_filtered is not None:
+            sums = rollups.totals(rollup_filtered)
+        else:
+            sums = df_filtered[['ventas_brutas', 'calc_traslados', 'calc_retenciones', 'descuento', 'ventas_netas_calc']].sum()
         
         fig_water = go.Figure(go.Waterfall(
             orientation = "v",
@@ -1827,6 +1937,47 @@ elif selected_module == "Cuenta T":
         )
         st.plotly_chart(fig_water, use_container_width=True)
 
+    elif selected_subtab == "nomina":
+        st.markdown("<div class='section-header'>NÓMINA: PERCEPCIONES, DEDUCCIONES Y NETO</div>", unsafe_allow_html=True)
+
+        if payroll_filtered is None or payroll_filtered.empty:
+            st.info("No hay recibos de nómina para el periodo seleccionado. Ejecute la migración para generar el dataset de nómina.")
+        else:
+            periodos = payroll.by_period(payroll_filtered)
+            n1, n2, n3, n4, n5 = st.columns(5)
+            n1.metric("Empleados", f"{payroll_filtered['curp'].nunique():,}")
+            n2.metric("Recibos", f"{int(periodos['recibos'].sum()):,}")
+            n3.metric("Percepciones", f"${periodos['percepciones_total'].sum():,.2f}")
+            n4.metric("ISR Retenido", f"${periodos['isr_retenido'].sum():,.2f}")
+            n5.metric("Neto Pagado", f"${periodos['neto_pagado'].sum():,.2f}")
+
+            df_periodos = periodos.reset_index().melt(
+                id_vars='periodo', value_vars=['percepciones_gravado', 'percepciones_exento', 'deducciones_total', 'otros_pagos'],
+                var_name='concepto', value_name='monto'
+            )
+            fig_nomina = px.bar(
+                df_periodos, x='periodo', y='monto', color='concepto', barmode='group',
+                title="Nómina por Periodo", template="plotly_white",
+                color_discrete_map={'percepciones_gravado': '#0047ab', 'percepciones_exento': '#00f2ff',
+                                    'deducciones_total': '#f85149', 'otros_pagos': '#39d353'}
+            )
+            fig_nomina.update_layout(paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)', font=dict(color="black"),
+                                     xaxis=dict(tickfont=dict(color='black')), yaxis=dict(tickfont=dict(color='black')))
+            st.plotly_chart(fig_nomina, use_container_width=True)
+
+            st.markdown("#### Detalle por Empleado")
+            empleados = payroll.by_employee(payroll_filtered).reset_index()
+            st.dataframe(
+                empleados[['curp', 'nombre', 'num_empleado', 'departamento', 'puesto', 'recibos', 'dias_pagados',
+                           'percepciones_gravado', 'percepciones_exento', 'deducciones_total', 'isr_retenido', 'imss',
+                           'otros_pagos', 'subsidio_causado', 'neto_pagado']],
+                use_container_width=True,
+                hide_index=True,
+                column_config={col: st.column_config.NumberColumn(format="$%.2f") for col in
+                               ['percepciones_gravado', 'percepciones_exento', 'deducciones_total', 'isr_retenido', 'imss',
+                                'otros_pagos', 'subsidio_causado', 'neto_pagado']}
+            )
+
 
 
 
@@ -1837,32 +1988,6 @@ elif selected_module == "Riesgos":
     if df_filtered.empty:
         st.warning("SISTEMA SIN DATOS: No hay registros disponibles para el análisis de riesgos con los filtros actuales.")
     else:
-        # --- PHASE 2: RISK SCORING LOGIC ---
-        def calculate_risk_scores(df_raw):
-            # Group by Supplier
-            risk_df = df_raw.copy()
-            risk_df['is_round'] = (risk_df['total'] > 0) & (risk_df['total'] % 100 == 0)
-            risk_df['is_atypical'] = risk_df['fecha_emision'].dt.hour >= 22
-            risk_df['is_weekend'] = risk_df['fecha_emision'].dt.dayofweek >= 5
-            
-            agg = risk_df.groupby('emisor_nombre').agg({
-                'total': ['count', 'sum', 'std', 'mean'],
-                'is_round': 'sum',
-                'is_atypical': 'sum',
-                'is_weekend': 'sum'
-            })
-            agg.columns = ['count', 'total_sum', 'std', 'mean', 'round_count', 'atypical_count', 'weekend_count']
-            
-            # Risk Penalties
-            agg['pct_round'] = (agg['round_count'] / agg['count']) * 100
-            agg['pct_atypical'] = (agg['atypical_count'] / agg['count']) * 100
-            agg['pct_weekend'] = (agg['weekend_count'] / agg['count']) * 100
-            agg['cv'] = (agg['std'] / agg['mean']).fillna(0) # Coeff variation
-            
-            # Score (0-100)
-            agg['risk_score'] = (agg['pct_round'] * 0.4 + agg['pct_atypical'] * 0.2 + agg['pct_weekend'] * 0.2 + (agg['cv'] > 1.5).astype(int) * 20)
-            return agg.sort_values('risk_score', ascending=False)
-
         if selected_subtab == "anomalias":
 
             # 1. TRACEABILITY SANKEY DIAGRAM (MATERIALITY)
@@ -1916,7 +2041,7 @@ elif selected_module == "Riesgos":
             st.markdown('<div class="section-header">MATRIZ DE RIESGO POR PROVEEDOR</div>', unsafe_allow_html=True)
             st.caption("Ranking prescriptivo basado en comportamientos atípicos. Puntuación alta = Prioridad de Auditoría Directa.")
             
-            risk_summary = calculate_risk_scores(df_filtered)
+            risk_summary = audit_module.calculate_risk_scores(df_filtered)
             
             # Display high-risk suppliers
             c1, c2 = st.columns([2, 1])
@@ -1974,7 +2099,8 @@ elif selected_module == "Materialidad / REPSE":
             'cfdis': df, 
             'cfdi_emisors': df_emisors,
             'cfdi_receptors': df_receptors,
-            'cfdi_conceptos': df_conceptos
+            'cfdi_conceptos': concept_idx[0],
+            'concept_index': concept_idx
         }
         
         audit_module.render_invoice_module(data_lake)
@@ -1988,11 +2114,64 @@ elif selected_module == "Compliance":
          st.markdown("<div class='section-header'>VERIFICACIÓN DE TASA EFECTIVA</div>", unsafe_allow_html=True)
          st.caption("Ejecuta una validación algorítmica de la Tasa Efectiva por factura. Detecta discrepancias matemáticas entre la Base y el Impuesto Trasladado que los modelos automatizados del SAT marcan inmediatamente como 'inconsistencia de cálculo' o riesgo de evasión.")
          
-         if 'subtotal' in df_filtered.columns and 'calc_iva' in df_filtered.columns:
-             # Logic: Tasa = IVA / Subtotal
-             # Handle 0 division
+         df_lineas = load_concept_lines(st.session_state.company_id) if 'lineas_impuesto' in df_filtered.columns else None
+         if df_lineas is not None:
+             # Line-level validation: one vectorized pass over the tax lines of the filtered invoices
+             lineas = concept_taxes.validate_lines(df_lineas[df_lineas['uuid'].isin(df_filtered['uuid'])])
+             lineas['estado'] = np.select([lineas['tasa_atipica'], lineas['importe_inconsistente']],
+                                          ['Tasa atípica', 'Importe inconsistente'], default='Correcta')
+             anomalias = lineas[lineas['estado'] != 'Correcta']
+             mixtas = df_filtered[df_filtered['iva_tasas'] > 1]
+
+             m1, m2, m3, m4 = st.columns(4)
+             m1.metric("Facturas Analizadas", f"{len(df_filtered):,}")
+             m2.metric("Líneas Analizadas", f"{len(lineas):,}")
+             m3.metric("Facturas con Tasa Mixta", f"{len(mixtas):,}", help="Combinan conceptos a 16%, 8%, 0% o exentos; no es una anomalía.")
+             m4.metric("Facturas con Línea Atípica", f"{anomalias['uuid'].nunique():,}", delta="-Riesgo SAT" if not anomalias.empty else "OK", delta_color="inverse")
+
+             st.markdown("---")
+
+             c1, c2 = st.columns([2, 1])
+             with c1:
+                 fig_tasa = px.scatter(
+                     lineas[lineas['impuesto'] == concept_taxes.IVA],
+                     x='base',
+                     y='importe',
+                     color='estado',
+                     color_discrete_map={'Correcta': '#2ea043', 'Tasa atípica': '#f85149', 'Importe inconsistente': '#ffa600'},
+                     title="Dispersión de Tasas por Concepto: Base vs IVA (Rojo = Atípico)",
+                     template="plotly_white",
+                     hover_data=['uuid', 'clave_prod_serv', 'tasa_o_cuota', 'tipo']
+                 )
+                 fig_tasa.update_layout(paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)', font=dict(color="black"), xaxis=dict(tickfont=dict(color='black')), yaxis=dict(tickfont=dict(color='black')))
+                 st.plotly_chart(fig_tasa, use_container_width=True)
+
+             with c2:
+                 st.markdown("#### Detalle de Anomalías")
+                 if not anomalias.empty:
+                     st.dataframe(
+                         anomalias[['uuid', 'clave_prod_serv', 'tipo', 'impuesto', 'tipo_factor', 'tasa_o_cuota', 'base', 'importe', 'importe_esperado', 'estado']],
+                         use_container_width=True,
+                         hide_index=True,
+                         column_config={
+                             "tasa_o_cuota": st.column_config.NumberColumn("Tasa", format="%.6f"),
+                             "importe_esperado": st.column_config.NumberColumn("Importe Esperado", format="%.2f")
+                         }
+                     )
+                 else:
+                     st.success("Todas las líneas usan tasas de norma (16%, 8%, 0%, exento) y su importe cuadra con la base. Integridad Aritmética Verificada.")
+
+             if not mixtas.empty:
+                 st.markdown("#### Facturas con Tasa Mixta")
+                 st.dataframe(
+                     mixtas[['uuid', 'subtotal', 'calc_iva', 'iva_base_16', 'iva_base_8', 'iva_base_0', 'iva_base_exento', 'iva_base_otra']],
+                     use_container_width=True,
+                     hide_index=True
+                 )
+         elif 'subtotal' in df_filtered.columns and 'calc_iva' in df_filtered.columns:
+             # Gold without concept lines: Tasa = IVA / Subtotal per invoice
              df_tabs = df_filtered.copy()
-             df_tabs['tasa_calculada'] = df_tabs.apply(lambda x: x['calc_iva'] / x['subtotal'] if x['subtotal'] > 0 else 0, axis=1)
+             df_tabs['tasa_calculada'] = np.where(df_tabs['subtotal'] > 0, df_tabs['calc_iva'] / df_tabs['subtotal'].where(df_tabs['subtotal'] > 0), 0.0)
              
              # Identify specific tax rates + tolerance
              # 16% (0.16), 8% (0.08), 0% (0.0)
@@ -2057,8 +2236,20 @@ elif selected_module == "Compliance":
              else:
                 mask_rep = pd.Series([False]*len(df_filtered))
              
-             monto_ppd = df_filtered.loc[mask_ppd, 'total'].sum()
-             monto_rep = df_filtered.loc[mask_rep, 'total'].sum()
+             # Reconciled gold (payments.py): what each PPD invoice actually received
+             reconciled = 'pago_estatus' in df_filtered.columns and df_filtered['pago_estatus'].notna().any()
+             if reconciled:
+                 ppd = df_filtered[mask_ppd & df_filtered['pago_estatus'].notna()]
+                 monto_ppd = ppd['total'].sum()
+                 monto_rep = ppd['pago_monto_pagado'].sum()
+             elif rollup_filtered is not None:
+                 by_metodo = rollups.sums_by(rollup_filtered, 'metodo_pago')
+                 by_tipo = rollups.sums_by(rollup_filtered, 'tipo')
+                 monto_ppd = by_metodo[by_metodo.index.astype(str).str.upper() == 'PPD'].sum()
+                 monto_rep = by_tipo[by_tipo.index.astype(str).str.upper() == 'P'].sum()
+             else:
+                 monto_ppd = df_filtered.loc[mask_ppd, 'total'].sum()
+                 monto_rep = df_filtered.loc[mask_rep, 'total'].sum()
              
              gap = monto_ppd - monto_rep
              # Avoid div by zero
@@ -2105,6 +2296,44 @@ elif selected_module == "Compliance":
                  st.info("Nota: El monto de pagos excede lo facturado en PPD. Verifique posibles anticipos o pagos de periodos anteriores.")
              else:
                  st.success("Integridad de Flujo Perfecta. Todo lo facturado PPD tiene su complemento de pago.")
+
+             if reconciled:
+                 st.markdown("---")
+                 st.markdown("#### Facturas PPD con Saldo Pendiente")
+                 pendientes = ppd[ppd['pago_estatus'] != 'pagada'].sort_values('pago_saldo_insoluto', ascending=False)
+                 p1, p2, p3 = st.columns(3)
+                 p1.metric("Facturas sin Pago", f"{int((pendientes['pago_estatus'] == 'pendiente').sum()):,}")
+                 p2.metric("Pagadas Parcialmente", f"{int((pendientes['pago_estatus'] == 'parcial').sum()):,}")
+                 p3.metric("Saldo Insoluto", f"${pendientes['pago_saldo_insoluto'].sum():,.2f}")
+                 if not pendientes.empty:
+                     cols_pend = [c for c in ['uuid', 'fecha_emision', 'receptor_nombre', 'total', 'pago_monto_pagado', 'pago_saldo_insoluto',
+                                              'pago_num_pagos', 'pago_ultima_fecha', 'pago_estatus'] if c in pendientes.columns]
+                     st.dataframe(
+                         pendientes[cols_pend],
+                         use_container_width=True,
+                         hide_index=True,
+                         column_config={
+                             "total": st.column_config.NumberColumn("Total", format="$%.2f"),
+                             "pago_monto_pagado": st.column_config.NumberColumn("Pagado", format="$%.2f"),
+                             "pago_saldo_insoluto": st.column_config.NumberColumn("Saldo Insoluto", format="$%.2f"),
+                             "pago_num_pagos": st.column_config.NumberColumn("Pagos"),
+                             "pago_ultima_fecha": "Último Pago",
+                             "pago_estatus": "Estatus"
+                         }
+                     )
+                 else:
+                     st.success("Todas las facturas PPD del periodo están liquidadas.")
+
+                 # Per-invoice lookup: one probe into the uuid-indexed reconciliation
+                 uuid_query = st.text_input("Consultar factura PPD por UUID").strip().lower()
+                 if uuid_query:
+                     por_uuid = load_ppd(st.session_state.company_id, tipo_query, date_query)
+                     if por_uuid is not None and uuid_query in por_uuid.index:
+                         factura = por_uuid.loc[[uuid_query]].iloc[0]
+                         st.write(f"Estatus: **{factura['pago_estatus']}** | Total: ${factura['total']:,.2f} | Pagado: ${factura['pago_monto_pagado']:,.2f} | "
+                                  f"Saldo: ${factura['pago_saldo_insoluto']:,.2f} | Pagos: {int(factura['pago_num_pagos'])}")
+                     else:
+                         st.warning("UUID no encontrado entre las facturas PPD del periodo.")
                  
          else:
              st.warning("La columna 'metodo_pago' no está disponible para este análisis.")
@@ -1,7 +1,98 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
 import streamlit.components.v1 as components
 
+
+def calculate_risk_scores(df_raw):
+    """Per-supplier risk matrix (round amounts, atypical hours, weekends, dispersion) for the Riesgos view."""
+    # Group by Supplier
+    risk_df = df_raw.copy()
+    risk_df['is_round'] = (risk_df['total'] > 0) & (risk_df['total'] % 100 == 0)
+    risk_df['is_atypical'] = risk_df['fecha_emision'].dt.hour >= 22
+    risk_df['is_weekend'] = risk_df['fecha_emision'].dt.dayofweek >= 5
+
+    agg = risk_df.groupby('emisor_nombre').agg({
+        'total': ['count', 'sum', 'std', 'mean'],
+        'is_round': 'sum',
+        'is_atypical': 'sum',
+        'is_weekend': 'sum'
+    })
+    agg.columns = ['count', 'total_sum', 'std', 'mean', 'round_count', 'atypical_count', 'weekend_count']
+
+    # Risk Penalties
+    agg['pct_round'] = (agg['round_count'] / agg['count']) * 100
+    agg['pct_atypical'] = (agg['atypical_count'] / agg['count']) * 100
+    agg['pct_weekend'] = (agg['weekend_count'] / agg['count']) * 100
+    agg['cv'] = (agg['std'] / agg['mean']).fillna(0) # Coeff variation
+
+    # Score (0-100)
+    agg['risk_score'] = (agg['pct_round'] * 0.4 + agg['pct_atypical'] * 0.2 + agg['pct_weekend'] * 0.2 + (agg['cv'] > 1.5).astype(int) * 20)
+    return agg.sort_values('risk_score', ascending=False)
+
+
+def fill_receptor_rfcs(df, df_receptors):
+    """
+    Fills receptor_rfc from the receptor catalog (receptor_id -> rfc), keeping the gold value
+    where the catalog has none and the generic RFC as the last fallback.
+    """
+    if 'receptor_id' in df.columns and not df_receptors.empty:
+        catalog = df_receptors.drop_duplicates('id').set_index('id')['rfc']
+        catalog_rfc = df['receptor_id'].map(catalog)
+        if 'receptor_rfc' in df.columns:
+            df['receptor_rfc'] = catalog_rfc.fillna(df['receptor_rfc'])
+        else:
+            df['receptor_rfc'] = catalog_rfc
+        # Ensure no NaNs remain (fallback to generic if catalog also fails)
+        df['receptor_rfc'] = df['receptor_rfc'].fillna(df['receptor'].fillna('XAXX010101000') if 'receptor' in df.columns else 'XAXX010101000')
+    return df
+
+
+def attach_concept_uuids(df_conceptos, df):
+    """
+    The concepts of the invoices in `df` with their invoice uuid (they link to the gold records
+    through cfdi_id), sorted by uuid, which is what render_invoice_html looks them up by.
+    """
+    if df_conceptos.empty or 'cfdi_id' not in df_conceptos.columns or 'id' not in df.columns:
+        return df_conceptos
+    # id -> uuid; numeric keys match whether the ids were read as numbers or text
+    mapping = pd.Series(df['uuid'].astype(str).to_numpy(), index=pd.to_numeric(df['id'], errors='coerce'))
+    mapping = mapping[~mapping.index.duplicated()]
+    uuids = pd.to_numeric(df_conceptos['cfdi_id'], errors='coerce').map(mapping)
+    concepts = df_conceptos.assign(uuid=uuids)[uuids.notna()]
+    return concepts.sort_values('uuid', kind='stable').reset_index(drop=True)
+
+
+def concept_index(concepts):
+    """
+    Drill-down index: (lines, offsets). `lines` holds the concepts grouped in contiguous uuid
+    slices and `offsets` maps each uuid to its [start, stop) rows, so an invoice's lines are
+    read with invoice_concepts in O(lines) instead of scanning the concept table.
+    """
+    offsets = pd.DataFrame({'start': pd.Series(dtype='int64'), 'stop': pd.Series(dtype='int64')})
+    if concepts.empty or 'uuid' not in concepts.columns:
+        return concepts, offsets
+    concepts = concepts[concepts['uuid'].notna()]
+    if not concepts['uuid'].is_monotonic_increasing:
+        concepts = concepts.sort_values('uuid', kind='stable')
+    concepts = concepts.reset_index(drop=True)
+    uuids = concepts['uuid'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, uuids[1:] != uuids[:-1]])
+    stops = np.r_[starts[1:], len(uuids)]
+    offsets = pd.DataFrame({'start': starts, 'stop': stops}, index=pd.Index(uuids[starts], name='uuid'))
+    return concepts, offsets
+
+
+def invoice_concepts(index, invoice_uuid):
+    """The concept lines of one invoice from a concept_index (empty if it has none)."""
+    lines, offsets = index
+    try:
+        i = offsets.index.get_loc(invoice_uuid)
+    except (KeyError, TypeError):
+        return lines.iloc[0:0]
+    return lines.iloc[offsets['start'].iat[i]:offsets['stop'].iat[i]]
+
+
 def render_invoice_module(data_lake):
     """
     Renders the Invoice Audit Module with Forensic Health Checks.
@@ -17,8 +108,11 @@ def render_invoice_module(data_lake):
     try:
         # Unir CFDI con Emisor y Receptor (Capa Gold) utilizando los nombres de columna actualizados
         # Nota: Ajustado a emisor_rfc / receptor_rfc según estructura de app.py
-        df_master = data_lake['cfdis'].copy()
-        df_conceptos = data_lake['cfdi_conceptos']
+        df_master = data_lake['cfdis'].copy(deep=False)
+        # Precomputed by the caller (cached with the enriched frames); built here otherwise
+        concepts = data_lake.get('concept_index')
+        if concepts is None:
+            concepts = concept_index(data_lake['cfdi_conceptos'])
     except Exception as e:
         st.error(f"Error processing data: {e}")
         return
@@ -68,7 +162,7 @@ def render_invoice_module(data_lake):
             (df_master['fecha_emision'].dt.year == now.year)
         )
 
-    df_filtered = df_master.loc[mask].copy()
+    df_filtered = df_master.loc[mask]
 
     # Results Table
     if not df_filtered.empty:
@@ -174,10 +268,7 @@ def render_invoice_module(data_lake):
              st.session_state.selected_invoice_idx = current_options[0]
              st.session_state['audit_selectbox_key'] = current_options[0]
         
-        invoice_options = df_filtered.apply(
-            lambda x: f"{x.get('fecha_emision', 'N/A')} | {x.get('emisor_nombre', 'N/A')} | ${x.get('total', 0):,.2f}", 
-            axis=1
-        )
+        invoice_options = invoice_labels(df_filtered)
         
         # Find the index position for the Selectbox
         try:
@@ -208,7 +299,7 @@ def render_invoice_module(data_lake):
                  render_forensic_alerts(row, df_master)
                  
              with col_invoice:
-                 render_invoice_html(row, df_conceptos)
+                 render_invoice_html(row, concepts)
                  with st.expander("🔍 DATA ESTRUCTURADA (JSON)"):
                     st.json(row.to_dict())
 
@@ -216,6 +307,14 @@ def render_invoice_module(data_lake):
         st.info("Sin registros coincidentes.")
 
 
+def invoice_labels(df):
+    """Selector label per invoice ("fecha | emisor | $total"), built column-wise instead of row by row."""
+    def text(col, missing):
+        return df[col].astype(str).fillna(missing) if col in df.columns else pd.Series('N/A', index=df.index)
+    totals = df['total'].map('{:,.2f}'.format) if 'total' in df.columns else pd.Series('0.00', index=df.index)
+    return text('fecha_emision', 'NaT') + ' | ' + text('emisor_nombre', 'nan') + ' | $' + totals
+
+
 def render_forensic_alerts(row, df_master):
     """Calculates and displays forensic risk indicators including Issuer Risk Score."""
     total = row.get('total', 0)
@@ -306,8 +405,8 @@ def render_forensic_alerts(row, df_master):
         st.success("🟢 No se detectaron anomalías estructurales inmediatas.")
 
 
-def render_invoice_html(row, df_conceptos):
-    """Generates the Corporate HTML Invoice with comma31.2 formatting."""
+def render_invoice_html(row, concepts):
+    """Generates the Corporate HTML Invoice with comma31.2 formatting (`concepts`: a concept_index)."""
     
     # Formatting helper for comma31.2
     def fmt(val):
@@ -315,12 +414,12 @@ def render_invoice_html(row, df_conceptos):
 
     concepts_subset = pd.DataFrame()
     invoice_uuid = row.get('uuid')
-    if pd.notnull(invoice_uuid) and 'uuid' in df_conceptos.columns:
-        concepts_subset = df_conceptos[df_conceptos['uuid'] == invoice_uuid]
+    if pd.notnull(invoice_uuid):
+        concepts_subset = invoice_concepts(concepts, invoice_uuid)
              
     rows_html = ""
     if not concepts_subset.empty:
-        for _, c in concepts_subset.iterrows():
+        for c in concepts_subset.to_dict('records'):
             rows_html += f"""
             <tr>
                 <td style="padding: 8px; border-bottom: 1px solid #eee;">{c.get('cantidad', 1)}</td>
@@ -0,0 +1,369 @@
+"""
+Pipeline and dashboard benchmarks.
+
+  - Tax aggregation: legacy merge/groupby chain vs the single-pass aggregation (--rows).
+  - Scale suite (--invoices): generates a synthetic lake with synthetic_data, runs the migration
+    in a fresh process (per-stage seconds and RSS from its manifest), then times the dashboard
+    computations on the published gold layer. Every run is appended to BENCHMARK_RESULTS with
+    the code version and compared with the previous run at the same scale.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import time
+import logging
+import multiprocessing
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+# Setup Logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Load Environment Variables
+load_dotenv()
+
+# Configuration
+BENCHMARK_RESULTS = os.getenv("BENCHMARK_RESULTS", os.path.join("benchmarks", "results.jsonl"))
+BENCHMARK_REGRESSION_PCT = float(os.getenv("BENCHMARK_REGRESSION_PCT", 20))   # Slower than the last run by more than this is flagged
+BENCHMARK_COMPANY_ID = "BENCH"
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 200000))
+
+
+def synthetic_tax_tables(rows, seed=42):
+    """Builds cfdis / impuestos / traslados / retenciones frames shaped like the Laravel export."""
+    rng = np.random.default_rng(seed)
+    n_cfdis = max(rows // 2, 1)
+
+    cfdis = pd.DataFrame({
+        'id': np.arange(1, n_cfdis + 1),
+        'subtotal': rng.gamma(2.0, 5000.0, n_cfdis).round(2),
+        'descuento': 0.0
+    })
+    impuestos = pd.DataFrame({
+        'id': np.arange(1, n_cfdis + 1),
+        'cfdi_id': cfdis['id'].to_numpy()
+    })
+    traslados = pd.DataFrame({
+        'id': np.arange(1, rows + 1),
+        'cfdi_comprobante_impuestos_id': rng.integers(1, n_cfdis + 1, rows),
+        # Same int-vs-string mix the CSV exports produce
+        'impuesto': rng.choice(np.array([2, 3, '002', '003'], dtype=object), rows, p=[0.6, 0.1, 0.25, 0.05]),
+        'importe': rng.gamma(2.0, 800.0, rows).round(2)
+    })
+    n_ret = max(rows // 10, 1)
+    retenciones = pd.DataFrame({
+        'id': np.arange(1, n_ret + 1),
+        'cfdi_comprobante_impuestos_id': rng.integers(1, n_cfdis + 1, n_ret),
+        'impuesto': rng.choice(np.array([1, 2, '001', '002'], dtype=object), n_ret),
+        'importe': rng.gamma(2.0, 100.0, n_ret).round(2)
+    })
+    return cfdis, impuestos, traslados, retenciones
+
+
+def legacy_tax_aggregation(cfdis, impuestos, traslados, retenciones):
+    """The previous merge/groupby chain from migration.main, kept as the benchmark baseline."""
+    traslados_merged = traslados.merge(impuestos[['id', 'cfdi_id']], left_on='cfdi_comprobante_impuestos_id', right_on='id', suffixes=('_tras', '_imp'))
+    total_traslados = traslados_merged.groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_traslados'})
+    cfdis = cfdis.merge(total_traslados, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_traslados': 0})
+    iva_tras = traslados_merged[traslados_merged['impuesto'].astype(str).str.contains('002', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_iva'})
+    ieps_tras = traslados_merged[traslados_merged['impuesto'].astype(str).str.contains('003', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ieps'})
+    cfdis = cfdis.merge(iva_tras, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_iva': 0})
+    cfdis = cfdis.merge(ieps_tras, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ieps': 0})
+
+    retenciones_merged = retenciones.merge(impuestos[['id', 'cfdi_id']], left_on='cfdi_comprobante_impuestos_id', right_on='id', suffixes=('_ret', '_imp'))
+    total_retenciones = retenciones_merged.groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_retenciones'})
+    cfdis = cfdis.merge(total_retenciones, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_retenciones': 0})
+    isr_ret = retenciones_merged[retenciones_merged['impuesto'].astype(str).str.contains('001', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ret_isr'})
+    iva_ret = retenciones_merged[retenciones_merged['impuesto'].astype(str).str.contains('002', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ret_iva'})
+    cfdis = cfdis.merge(isr_ret, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ret_isr': 0})
+    cfdis = cfdis.merge(iva_ret, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ret_iva': 0})
+    return cfdis
+
+
+def single_pass_tax_aggregation(cfdis, impuestos, traslados, retenciones):
+    import migration
+    taxes = migration.aggregate_taxes(impuestos, traslados, retenciones)
+    return migration.attach_taxes(cfdis, taxes)
+
+
+def timed(func, *args, repeat=3):
+    """Returns (best wall time in seconds, last result)."""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_tax_aggregation(rows, repeat=3):
+    logging.info(f"Generating synthetic tax tables ({rows:,} traslados)...")
+    tables = synthetic_tax_tables(rows)
+
+    legacy_time, legacy = timed(legacy_tax_aggregation, *tables, repeat=repeat)
+    single_time, single = timed(single_pass_tax_aggregation, *tables, repeat=repeat)
+
+    # Sanity check: totals must match (IVA/IEPS differ only where legacy missed int-typed codes)
+    legacy = legacy.set_index('id').sort_index()
+    single = single.set_index('id').sort_index()
+    for col in ['calc_traslados', 'calc_retenciones']:
+        if not np.allclose(legacy[col].to_numpy(), single[col].to_numpy()):
+            logging.error(f"Mismatch in {col} between legacy and single-pass aggregation")
+
+    print(f"\n--- TAX AGGREGATION BENCHMARK ({rows:,} traslados) ---")
+    print(f"Legacy merge/groupby chain : {legacy_time:8.3f} s")
+    print(f"Single-pass aggregation    : {single_time:8.3f} s")
+    print(f"Speedup                    : {legacy_time / single_time:8.1f}x")
+    print("------------------------------------------------------\n")
+    return {'rows': rows, 'legacy_s': legacy_time, 'single_pass_s': single_time}
+
+
+# --- Scale suite ---
+
+def bench_env(data_dir, company_id=BENCHMARK_COMPANY_ID):
+    """Environment of a benchmark migration: every output lives under `data_dir`, no Mongo."""
+    return {
+        'COMPANY_ID': company_id,
+        'DATA_DIR': data_dir,
+        'SOURCE_COMPANY_ID': '',
+        'MONGO_URI': '',
+        'GOLD_FORMAT': 'parquet',
+        'GOLD_DIR': os.path.join(data_dir, 'gold_cfdi'),
+        'ROLLUP_DIR': os.path.join(data_dir, 'gold_cfdi_monthly'),
+        'PAYROLL_DIR': os.path.join(data_dir, 'gold_nomina'),
+        'LINES_DIR': os.path.join(data_dir, 'gold_cfdi_concepto_impuestos'),
+        'FORENSICS_DIR': os.path.join(data_dir, 'forensics'),
+        'CHECKPOINT_DIR': os.path.join(data_dir, '.checkpoints'),
+        'ALERT_OUTBOX_PATH': os.path.join(data_dir, 'alert_outbox.sqlite'),
+    }
+
+
+def run_migration(data_dir, streaming, chunksize):
+    """
+    Worker entry point (fresh spawned process): runs the migration on the synthetic lake.
+    Returns {'ok', 'seconds', 'peak_rss_mb', 'stages'}. This module must not import migration
+    at the top: the spawned child re-imports it before the environment below is set.
+    """
+    os.environ.update(bench_env(data_dir))
+    logging.basicConfig(level=logging.WARNING, force=True)
+    import migration  # Imported after the environment is set: its config is read at import time
+    start = time.perf_counter()
+    ok = migration.main(incremental=False, streaming=streaming, chunksize=chunksize)
+    seconds = time.perf_counter() - start
+    import resource
+    manifest = migration.load_manifest(BENCHMARK_COMPANY_ID) if not streaming else None
+    stages = {name: {'seconds': m['seconds'], 'rss_mb': m['rss_mb']}
+              for name, m in (manifest or {}).get('stages', {}).items() if m.get('status') == 'ok'}
+    return {'ok': ok, 'seconds': seconds, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'stages': stages}
+
+
+def bench_pipeline(data_dir, streaming=False, chunksize=CHUNK_SIZE):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes=1, maxtasksperchild=1) as pool:
+        return pool.apply(run_migration, (data_dir, streaming, chunksize))
+
+
+def bench_dashboard(data_dir, repeat=3, company_id=BENCHMARK_COMPANY_ID):
+    """Best-of-`repeat` seconds of each dashboard computation on the published gold layer."""
+    import streamlit.logger
+    streamlit.logger.set_log_level('error')  # audit_module runs in Streamlit bare mode here
+    import gold_store
+    import rollups
+    import payroll
+    import concept_taxes
+    import schema_registry
+    import audit_module
+
+    env = bench_env(data_dir, company_id)
+    results = {}
+
+    def load_data():
+        return gold_store.dashboard_frame(gold_store.read_tenant(env['GOLD_DIR'], company_id, exclude=gold_store.GOLD_UNUSED_COLUMNS))
+
+    results['load_data'], df = timed(load_data, repeat=repeat)
+
+    def load_month():
+        # Sidebar narrowed to the latest month: the window is pushed down into the partitions
+        last = df['fecha_emision'].max().date()
+        dates = (last.replace(day=1), last)
+        return gold_store.dashboard_frame(gold_store.read_tenant(env['GOLD_DIR'], company_id, exclude=gold_store.GOLD_UNUSED_COLUMNS, dates=dates))
+
+    results['load_month'], _ = timed(load_month, repeat=repeat)
+
+    def rollup_views():
+        rows = rollups.select(rollups.load(company_id, rollup_dir=env['ROLLUP_DIR']))
+        return rollups.summary(rows), rollups.monthly(rows), rollups.sums_by(rows, 'tipo'), rollups.totals(rows)
+
+    results['rollup_views'], _ = timed(rollup_views, repeat=repeat)
+    results['risk_scores'], _ = timed(audit_module.calculate_risk_scores, df, repeat=repeat)
+
+    def receptor_rfcs():
+        return audit_module.fill_receptor_rfcs(df.copy(deep=False), schema_registry.read_table('cfdi_receptors', data_dir))
+
+    results['receptor_rfcs'], _ = timed(receptor_rfcs, repeat=repeat)
+
+    def concept_uuids():
+        return audit_module.concept_index(audit_module.attach_concept_uuids(schema_registry.read_table('cfdi_conceptos', data_dir), df))
+
+    results['concept_uuids'], concepts = timed(concept_uuids, repeat=repeat)
+    lake = {'cfdis': df, 'cfdi_emisors': pd.DataFrame(), 'cfdi_receptors': pd.DataFrame(),
+            'cfdi_conceptos': concepts[0], 'concept_index': concepts}
+    results['invoice_module'], _ = timed(audit_module.render_invoice_module, lake, repeat=repeat)
+
+    def payroll_views():
+        rows = payroll.load(company_id, payroll_dir=env['PAYROLL_DIR'])
+        return payroll.by_period(rows), payroll.by_employee(rows)
+
+    results['payroll_views'], _ = timed(payroll_views, repeat=repeat)
+
+    def concept_lines():
+        return concept_taxes.validate_lines(concept_taxes.load(company_id, lines_dir=env['LINES_DIR']))
+
+    results['concept_lines'], _ = timed(concept_lines, repeat=repeat)
+    return results, len(df)
+
+
+def code_version():
+    """Short commit hash of the working tree (suffixed -dirty with local changes), or 'unknown'."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here, capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def flatten_timings(record):
+    timings = {'generate': record['generate_s'], 'pipeline': record['pipeline']['seconds']}
+    timings.update({f"stage.{name}": m['seconds'] for name, m in record['pipeline']['stages'].items()})
+    if record.get('streaming'):
+        timings['pipeline.streaming'] = record['streaming']['seconds']
+    timings.update({f"dashboard.{name}": s for name, s in record['dashboard'].items()})
+    return timings
+
+
+def previous_record(results_path, invoices):
+    """Last recorded run at the same scale, or None."""
+    if not os.path.exists(results_path):
+        return None
+    last = None
+    with open(results_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('invoices') == invoices:
+                last = record
+    return last
+
+
+def record_result(record, results_path):
+    os.makedirs(os.path.dirname(results_path) or '.', exist_ok=True)
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+    logging.info(f"Benchmark recorded in {results_path}")
+
+
+def print_suite_report(record, previous=None, threshold=BENCHMARK_REGRESSION_PCT):
+    """Timings of this run next to the previous one at the same scale; returns the regressed keys."""
+    timings = flatten_timings(record)
+    before = flatten_timings(previous) if previous else {}
+    regressions = []
+    print(f"\n--- SCALE BENCHMARK ({record['invoices']:,} invoices, {record['version']}) ---")
+    if previous:
+        print(f"Compared with {previous['version']} ({previous['timestamp']})")
+    for key, seconds in timings.items():
+        line = f"{key:<28} {seconds:9.3f} s"
+        if key in before and before[key] > 0:
+            delta = (seconds - before[key]) / before[key] * 100
+            line += f"   {before[key]:9.3f} s  {delta:+7.1f}%"
+            # Sub-50 ms timings are too noisy to call regressions
+            if delta > threshold and seconds - before[key] > 0.05:
+                line += "  REGRESSION"
+                regressions.append(key)
+        print(line)
+    print(f"{'peak RSS (migration)':<28} {record['pipeline']['peak_rss_mb']:9.1f} MB")
+    print("------------------------------------------------------\n")
+    return regressions
+
+
+def bench_suite(invoices, data_dir=None, repeat=3, streaming=False, chunksize=CHUNK_SIZE,
+                results_path=BENCHMARK_RESULTS, record=True, seed=None):
+    """
+    Generates (or reuses) a synthetic lake of `invoices` CFDIs and benchmarks the pipeline and
+    the dashboard on it. Returns the result record.
+    """
+    import synthetic_data
+    keep = data_dir is not None
+    data_dir = data_dir or tempfile.mkdtemp(prefix="cfdi_bench_")
+    try:
+        start = time.perf_counter()
+        if not os.path.exists(os.path.join(data_dir, 'cfdis.csv')):
+            synthetic_data.generate(data_dir, invoices, seed=seed if seed is not None else synthetic_data.SYNTH_SEED)
+        generate_s = time.perf_counter() - start
+
+        for output in ('gold_cfdi', 'gold_cfdi_monthly', 'gold_nomina', 'gold_cfdi_concepto_impuestos', '.checkpoints'):
+            shutil.rmtree(os.path.join(data_dir, output), ignore_errors=True)
+        logging.info(f"Running the migration on {invoices:,} synthetic invoices...")
+        pipeline = bench_pipeline(data_dir)
+        if not pipeline['ok']:
+            raise RuntimeError("Benchmark migration failed")
+        streamed = None
+        if streaming:
+            logging.info("Running the streaming migration...")
+            streamed = bench_pipeline(data_dir, streaming=True, chunksize=chunksize)
+            streamed = {'seconds': streamed['seconds'], 'peak_rss_mb': streamed['peak_rss_mb']}
+
+        logging.info("Timing dashboard computations...")
+        dashboard, rows = bench_dashboard(data_dir, repeat=repeat)
+    finally:
+        if not keep:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    result = {
+        'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'version': code_version(),
+        'invoices': invoices,
+        'gold_rows': rows,
+        'python': sys.version.split()[0],
+        'pandas': pd.__version__,
+        'cpus': os.cpu_count(),
+        'generate_s': generate_s,
+        'pipeline': pipeline,
+        'streaming': streamed,
+        'dashboard': dashboard
+    }
+    previous = previous_record(results_path, invoices) if record else None
+    regressions = print_suite_report(result, previous)
+    result['regressions'] = regressions
+    if record:
+        record_result(result, results_path)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CFDI Pipeline Benchmarks")
+    parser.add_argument("--rows", type=int, default=5_000_000, help="Synthetic traslados rows")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions per implementation (best time is reported)")
+    parser.add_argument("--invoices", type=int, help="Run the scale suite on a synthetic lake of this many CFDIs instead")
+    parser.add_argument("--data-dir", help="Keep (or reuse) the synthetic lake here instead of a temp dir")
+    parser.add_argument("--streaming", action="store_true", help="Also time the streaming migration")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Rows per CSV chunk in streaming mode")
+    parser.add_argument("--seed", type=int, help="Synthetic data seed")
+    parser.add_argument("--results", default=BENCHMARK_RESULTS, help="JSON-lines file the suite results are appended to")
+    parser.add_argument("--no-record", action="store_true", help="Do not record or compare the suite results")
+    args = parser.parse_args()
+    if args.invoices:
+        result = bench_suite(args.invoices, args.data_dir, repeat=args.repeat, streaming=args.streaming,
+                             chunksize=args.chunk_size, results_path=args.results, record=not args.no_record, seed=args.seed)
+        sys.exit(1 if result['regressions'] else 0)
+    bench_tax_aggregation(args.rows, repeat=args.repeat)
@@ -0,0 +1,245 @@
+"""
+Concept-level tax gold table: one row per traslado / retención line of every concepto, written by
+migration.py and read by the dashboard's rate audit.
+
+cfdi_concepto_traslados / cfdi_concepto_retenciones -> cfdi_concepto_impuestos (cfdi_concepto_id)
+-> cfdi_conceptos (cfdi_id). Each line keeps base, impuesto, tipo_factor, tasa_o_cuota and importe,
+so rate checks are one vectorized pass over the lines instead of calc_iva / subtotal per invoice
+(which cannot tell a mixed-rate invoice from a wrong one). The per-invoice rate mix (IVA base per
+rate and counts of atypical / inconsistent lines) is attached to the gold CFDIs as well.
+
+Storage: the LINES_COLLECTION Mongo collection when the gold lives in Mongo, otherwise one
+Parquet file per tenant under LINES_DIR.
+"""
+import os
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configuration
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+LINES_COLLECTION = os.getenv("LINES_COLLECTION", "gold_cfdi_concepto_impuestos")
+LINES_DIR = os.getenv("LINES_DIR", os.path.join(DATA_DIR, "gold_cfdi_concepto_impuestos"))
+LINE_TAX_TOLERANCE = float(os.getenv("LINE_TAX_TOLERANCE", 0.01))  # |importe - base * tasa| allowed per line
+
+IVA = '002'
+# Legal IVA traslado rates (general, border region, zero rate) and the mix bucket each one feeds
+IVA_RATES = {0.16: 'iva_base_16', 0.08: 'iva_base_8', 0.0: 'iva_base_0'}
+
+TAX_ROW_COLUMNS = ['concepto_id', 'tipo', 'impuesto', 'tipo_factor', 'tasa_o_cuota', 'base', 'importe']
+LINE_COLUMNS = ['uuid', 'cfdi_id', 'concepto_id', 'clave_prod_serv', 'tipo', 'impuesto', 'tipo_factor', 'tasa_o_cuota', 'base', 'importe']
+LINE_SCHEMA = pa.schema([
+    ('uuid', pa.string()), ('cfdi_id', pa.int64()), ('concepto_id', pa.int64()), ('clave_prod_serv', pa.string()),
+    ('tipo', pa.string()), ('impuesto', pa.string()), ('tipo_factor', pa.string()),
+    ('tasa_o_cuota', pa.float64()), ('base', pa.float64()), ('importe', pa.float64())
+])
+MIX_COLUMNS = ['iva_base_16', 'iva_base_8', 'iva_base_0', 'iva_base_exento', 'iva_base_otra', 'iva_tasas',
+               'lineas_impuesto', 'lineas_tasa_atipica', 'lineas_importe_inconsistente']
+
+
+def _code(series):
+    """SAT impuesto codes as 3-digit strings (2, '2', '002' -> '002')."""
+    return series.astype(str).str.strip().str.replace(r'\.0$', '', regex=True).str.zfill(3).to_numpy(dtype=object)
+
+
+def _floats(series):
+    return pd.to_numeric(series, errors='coerce').to_numpy(dtype=float)
+
+
+def empty_lines():
+    return pd.DataFrame({col: pd.Series(dtype=field.type.to_pandas_dtype()) for col, field in zip(LINE_SCHEMA.names, LINE_SCHEMA)})
+
+
+def tax_rows(concepto_impuestos, traslados, retenciones):
+    """Traslado and retención rows (TAX_ROW_COLUMNS) tagged with the concepto they belong to."""
+    parts = []
+    if concepto_impuestos is not None and not concepto_impuestos.empty:
+        owners = concepto_impuestos.drop_duplicates('id')
+        owner_index = pd.Index(owners['id'].to_numpy())
+        owner_concepto = owners['cfdi_concepto_id'].to_numpy()
+        for tipo, frame in (('traslado', traslados), ('retencion', retenciones)):
+            if frame is None or frame.empty:
+                continue
+            pos = owner_index.get_indexer(frame['cfdi_concepto_impuestos_id'])
+            keep = pos >= 0
+            parts.append(pd.DataFrame({
+                'concepto_id': owner_concepto[pos[keep]],
+                'tipo': tipo,
+                'impuesto': _code(frame['impuesto'])[keep],
+                'tipo_factor': frame['tipo_factor'].astype(object).to_numpy()[keep],
+                'tasa_o_cuota': _floats(frame['tasa_o_cuota'])[keep],
+                'base': _floats(frame['base'])[keep],
+                'importe': _floats(frame['importe'])[keep]
+            }))
+    if not parts:
+        return pd.DataFrame(columns=TAX_ROW_COLUMNS)
+    return pd.concat(parts, ignore_index=True)
+
+
+def build_lines(conceptos, taxes, cfdis):
+    """Gold line rows (LINE_COLUMNS): every tax row joined to its concepto and to one of `cfdis`."""
+    if conceptos is None or taxes is None or taxes.empty or cfdis.empty:
+        return empty_lines()
+    conceptos = conceptos.drop_duplicates('id')
+    concepto_pos = pd.Index(conceptos['id'].to_numpy()).get_indexer(taxes['concepto_id'])
+    found = concepto_pos >= 0
+    cfdi_ids = np.full(len(taxes), -1, dtype='int64')
+    cfdi_ids[found] = conceptos['cfdi_id'].to_numpy(dtype='int64')[concepto_pos[found]]
+    cfdi_pos = pd.Index(cfdis['id'].to_numpy()).get_indexer(cfdi_ids)
+    keep = found & (cfdi_pos >= 0)
+
+    lines = pd.DataFrame({
+        'uuid': cfdis['uuid'].astype(object).to_numpy()[cfdi_pos[keep]],
+        'cfdi_id': cfdi_ids[keep],
+        'concepto_id': taxes['concepto_id'].to_numpy(dtype='int64')[keep],
+        'clave_prod_serv': conceptos['clave_prod_serv'].astype(object).to_numpy()[concepto_pos[keep]] if 'clave_prod_serv' in conceptos.columns else None
+    })
+    for col in TAX_ROW_COLUMNS[1:]:
+        lines[col] = taxes[col].to_numpy()[keep]
+    return lines[LINE_COLUMNS]
+
+
+def validate_lines(lines, tolerance=LINE_TAX_TOLERANCE):
+    """
+    Adds the per-line checks: importe_esperado (base * tasa, 0 for Exento), importe_inconsistente
+    (|importe - importe_esperado| > tolerance) and tasa_atipica (IVA traslado at a rate other than
+    16%, 8% or 0%). One vectorized pass, no per-invoice arithmetic.
+    """
+    factor = lines['tipo_factor'].astype(str).str.lower().to_numpy()
+    tasa = lines['tasa_o_cuota'].to_numpy(dtype=float)
+    base = lines['base'].to_numpy(dtype=float)
+    importe = lines['importe'].to_numpy(dtype=float)
+    exento = factor == 'exento'
+
+    esperado = np.where(exento, 0.0, np.nan_to_num(base) * np.nan_to_num(tasa))
+    inconsistente = ~exento & (np.abs(np.nan_to_num(importe) - esperado) > tolerance)
+    iva_tasa = (lines['tipo'].to_numpy() == 'traslado') & (lines['impuesto'].to_numpy() == IVA) & (factor == 'tasa')
+    legal = np.zeros(len(lines), dtype=bool)
+    for rate in IVA_RATES:
+        legal |= np.isclose(tasa, rate, atol=1e-6)
+    return lines.assign(importe_esperado=esperado, importe_inconsistente=inconsistente, tasa_atipica=iva_tasa & ~legal)
+
+
+def rate_mix(lines, tolerance=LINE_TAX_TOLERANCE):
+    """Per-invoice rate mix (MIX_COLUMNS) indexed by cfdi_id."""
+    if lines.empty:
+        return pd.DataFrame(columns=MIX_COLUMNS, index=pd.Index([], name='cfdi_id'), dtype=float)
+    checked = validate_lines(lines, tolerance)
+    factor = checked['tipo_factor'].astype(str).str.lower().to_numpy()
+    tasa = checked['tasa_o_cuota'].to_numpy(dtype=float)
+    base = np.nan_to_num(checked['base'].to_numpy(dtype=float))
+    iva = (checked['tipo'].to_numpy() == 'traslado') & (checked['impuesto'].to_numpy() == IVA)
+
+    frame = pd.DataFrame({'cfdi_id': checked['cfdi_id'].to_numpy()})
+    other = iva & (factor != 'exento')
+    for rate, col in IVA_RATES.items():
+        bucket = iva & (factor == 'tasa') & np.isclose(tasa, rate, atol=1e-6)
+        frame[col] = np.where(bucket, base, 0.0)
+        other &= ~bucket
+    frame['iva_base_exento'] = np.where(iva & (factor == 'exento'), base, 0.0)
+    frame['iva_base_otra'] = np.where(other, base, 0.0)
+    frame['lineas_impuesto'] = 1
+    frame['lineas_tasa_atipica'] = checked['tasa_atipica'].to_numpy().astype(int)
+    frame['lineas_importe_inconsistente'] = checked['importe_inconsistente'].to_numpy().astype(int)
+
+    mix = frame.groupby('cfdi_id', sort=False).sum()
+    # Distinct IVA treatments on the invoice (each legal rate, exento, anything else)
+    mix['iva_tasas'] = (mix[['iva_base_16', 'iva_base_8', 'iva_base_0', 'iva_base_exento', 'iva_base_otra']] > 0).sum(axis=1)
+    return mix[MIX_COLUMNS]
+
+
+def attach_rate_mix(cfdis, mix):
+    """Attaches the MIX_COLUMNS to the CFDIs (zeros for invoices without tax lines)."""
+    cfdis = cfdis.drop(columns=MIX_COLUMNS, errors='ignore')
+    pos = mix.index.get_indexer(cfdis['id'])
+    values = np.zeros((len(cfdis), len(MIX_COLUMNS)))
+    found = pos >= 0
+    values[found] = mix[MIX_COLUMNS].to_numpy(dtype=float)[pos[found]]
+    columns = {col: values[:, i] for i, col in enumerate(MIX_COLUMNS)}
+    for col in ('iva_tasas', 'lineas_impuesto', 'lineas_tasa_atipica', 'lineas_importe_inconsistente'):
+        columns[col] = columns[col].astype('int64')
+    return cfdis.assign(**columns)
+
+
+# --- Storage ---
+
+def lines_path(company_id, lines_dir=LINES_DIR):
+    return os.path.join(lines_dir, f"company_id={company_id}.parquet")
+
+
+def _to_arrow(frame):
+    frame = frame[LINE_COLUMNS].copy()
+    for col in ('uuid', 'clave_prod_serv', 'tipo', 'impuesto', 'tipo_factor'):
+        values = frame[col]
+        frame[col] = values.astype(str).astype(object).where(values.notna(), None)
+    return pa.Table.from_pandas(frame, schema=LINE_SCHEMA, preserve_index=False)
+
+
+def save(company_id, parts, db=None, replace_uuids=None, lines_dir=LINES_DIR):
+    """
+    Stores a tenant's tax lines (a frame or an iterable of frames). `replace_uuids=None`
+    replaces the whole tenant; otherwise only the lines of those CFDIs are replaced.
+    """
+    parts = [parts] if isinstance(parts, pd.DataFrame) else parts
+    written = 0
+    if db is not None:
+        collection = db[LINES_COLLECTION]
+        collection.create_index([('company_id', 1), ('uuid', 1)])
+        if replace_uuids is None:
+            collection.delete_many({'company_id': company_id})
+        else:
+            uuids = sorted(replace_uuids)
+            for start in range(0, len(uuids), 10000):
+                collection.delete_many({'company_id': company_id, 'uuid': {'$in': uuids[start:start + 10000]}})
+        for part in parts:
+            if part.empty:
+                continue
+            records = [{k: v for k, v in r.items() if not (v is None or (isinstance(v, float) and np.isnan(v)))}
+                       for r in part[LINE_COLUMNS].assign(company_id=company_id).to_dict(orient='records')]
+            collection.insert_many(records, ordered=False)
+            written += len(records)
+    else:
+        path = lines_path(company_id, lines_dir)
+        os.makedirs(lines_dir, exist_ok=True)
+        tmp = f"{path}.tmp"
+        with pq.ParquetWriter(tmp, LINE_SCHEMA) as writer:
+            if replace_uuids is not None and os.path.exists(path):
+                # Previous lines are streamed through row group by row group, minus the replaced CFDIs
+                replaced = pa.array(list(replace_uuids), type=pa.string())
+                for batch in pq.ParquetFile(path).iter_batches():
+                    table = pa.Table.from_batches([batch]).cast(LINE_SCHEMA)
+                    table = table.filter(pc.invert(pc.is_in(table['uuid'], value_set=replaced)))
+                    if table.num_rows:
+                        writer.write_table(table)
+                        written += table.num_rows
+            for part in parts:
+                if not part.empty:
+                    writer.write_table(_to_arrow(part))
+                    written += len(part)
+        os.replace(tmp, path)
+    logging.info(f"Concept tax lines: {written} lines stored for {company_id}" + (f" ({len(replace_uuids)} CFDIs refreshed)" if replace_uuids is not None else ""))
+
+
+def load(company_id, db=None, uuids=None, lines_dir=LINES_DIR):
+    """A tenant's tax lines (optionally only those of `uuids`), or None if it has none."""
+    if db is not None:
+        query = {'company_id': company_id}
+        if uuids is not None:
+            query['uuid'] = {'$in': list(uuids)}
+        rows = list(db[LINES_COLLECTION].find(query, {'_id': 0, 'company_id': 0}))
+        lines = pd.DataFrame(rows) if rows else None
+    else:
+        path = lines_path(company_id, lines_dir)
+        if not os.path.exists(path):
+            return None
+        filters = [('uuid', 'in', list(uuids))] if uuids is not None else None
+        lines = pq.read_table(path, filters=filters).to_pandas()
+    if lines is None or lines.empty:
+        return None
+    return lines
@@ -1,8 +1,8 @@
-import pymongo
 import hashlib
 import os
 import logging
 from dotenv import load_dotenv
+import mongo_pool
 
 # Load environment
 load_dotenv()
@@ -24,8 +24,7 @@ def create_admin():
     # Hide password in logs but check if it's correct
     logging.info(f"Connecting to MongoDB...")
 
-    client = pymongo.MongoClient(MONGO_URI)
-    db = client[DB_NAME]
+    db = mongo_pool.get_db(DB_NAME, uri=MONGO_URI)
     users_col = db["users"]
 
     # Define the first Company and Admin
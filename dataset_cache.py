@@ -0,0 +1,240 @@
+"""
+Process-wide, read-only cache of tenant datasets shared by every dashboard session.
+
+  - One in-memory copy per (loader, tenant, arguments), whatever the number of sessions;
+    callers get shallow copies, never a deserialized clone. The data is shared: callers may
+    add or reassign columns on what they receive, but must not mutate its values in place
+    (loc/iloc assignment, inplace=True, writes into .values).
+  - Entries are evicted least-recently-used first once the cache exceeds DATASET_CACHE_MB.
+  - Invalidation follows the tenant's data version, a stamp written by migration.py after
+    every successful load (Mongo or the local data dir). The stamp is re-read at most every
+    DATA_VERSION_CHECK_S seconds, so new data shows up within seconds of the ingestion.
+    Tenants without a stamp (gold written before it existed) expire after
+    DATASET_CACHE_UNVERSIONED_TTL_S like the old time-based cache.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import inspect
+import logging
+import threading
+import functools
+from collections import OrderedDict
+import pandas as pd
+from dotenv import load_dotenv
+import mongo_pool
+
+# Load Environment Variables
+load_dotenv()
+
+# Configuration
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+MONGO_URI = os.getenv("MONGO_URI")
+DB_NAME = os.getenv("DB_NAME", "cfdi_db")
+DATA_VERSION_COLLECTION = os.getenv("DATA_VERSION_COLLECTION", "data_versions")
+DATASET_CACHE_MB = float(os.getenv("DATASET_CACHE_MB", 1024))
+DATA_VERSION_CHECK_S = float(os.getenv("DATA_VERSION_CHECK_S", 5))
+DATASET_CACHE_UNVERSIONED_TTL_S = float(os.getenv("DATASET_CACHE_UNVERSIONED_TTL_S", 600))
+
+_lock = threading.Lock()
+_entries = OrderedDict()   # key -> entry dict, least recently used first
+_loading = {}              # key -> lock held while that key is being loaded
+_versions = {}             # company_id -> (version, checked_at)
+_totals = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'oversized': 0}
+
+
+# --- Data Version Stamp ---
+
+def version_path(company_id, data_dir=None):
+    return os.path.join(data_dir or DATA_DIR, f"data_version_{company_id}.json")
+
+
+def save_version(company_id, db=None, data_dir=None):
+    """Writes a new data version for the tenant (called by the migration once its load succeeded)."""
+    doc = {'company_id': company_id, 'version': uuid.uuid4().hex, 'published_at': pd.Timestamp.now().isoformat()}
+    if db is not None:
+        db[DATA_VERSION_COLLECTION].update_one({'company_id': company_id}, {'$set': doc}, upsert=True)
+    else:
+        with open(version_path(company_id, data_dir), 'w') as f:
+            json.dump(doc, f)
+    logging.info(f"Data version for {company_id}: {doc['version']}")
+    return doc['version']
+
+
+def load_version(company_id):
+    """The tenant's current data version (None if it has none), from Mongo when configured, else the data dir."""
+    if MONGO_URI:
+        try:
+            doc = mongo_pool.get_db(DB_NAME)[DATA_VERSION_COLLECTION].find_one({'company_id': company_id}, {'_id': 0, 'version': 1})
+            if doc is not None:
+                return doc['version']
+        except Exception as e:
+            logging.warning(f"Data version lookup failed for {company_id}: {e}")
+    path = version_path(company_id)
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                return json.load(f).get('version')
+        except (OSError, ValueError):
+            return None
+    return None
+
+
+def current_version(company_id):
+    """load_version, re-read at most every DATA_VERSION_CHECK_S seconds."""
+    version, checked_at = _versions.get(company_id, (None, None))
+    if checked_at is None or time.time() - checked_at >= DATA_VERSION_CHECK_S:
+        previous, version = version, load_version(company_id)
+        _versions[company_id] = (version, time.time())
+        if checked_at is not None and version != previous:
+            _drop_stale(company_id, version)
+    return version
+
+
+def _drop_stale(company_id, version):
+    """Releases every entry of the tenant loaded under another data version."""
+    with _lock:
+        stale = [k for k, e in _entries.items() if e['company_id'] == company_id and e['version'] != version]
+        for key in stale:
+            del _entries[key]
+        _totals['invalidations'] += len(stale)
+    if stale:
+        logging.info(f"Dataset cache: {len(stale)} entries of {company_id} invalidated by data version {version}")
+
+
+# --- Cache ---
+
+def nbytes(value):
+    """Approximate in-memory size of a cached value."""
+    if value is None:
+        return 0
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(nbytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def _share(value):
+    """What a caller receives: frames as shallow copies, so added or reassigned columns stay local to the session."""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy(deep=False)
+    if isinstance(value, tuple):
+        return tuple(_share(v) for v in value)
+    return value
+
+
+def _fresh(entry, version):
+    if entry['version'] is None and version is None:
+        return time.time() - entry['loaded_at'] < DATASET_CACHE_UNVERSIONED_TTL_S
+    return entry['version'] == version
+
+
+def _evict(budget):
+    """Drops least recently used entries until the cache fits `budget` bytes (caller holds the lock)."""
+    used = sum(e['bytes'] for e in _entries.values())
+    while _entries and used > budget:
+        key, entry = _entries.popitem(last=False)
+        used -= entry['bytes']
+        _totals['evictions'] += 1
+        logging.info(f"Dataset cache: evicted {entry['name']}({entry['company_id']}) {entry['bytes'] / 1e6:.1f} MB")
+
+
+def get(name, company_id, args, loader):
+    """
+    loader(company_id, *args) through the shared cache. Concurrent misses on the same key wait
+    for a single load; a tenant's entries are reloaded once its data version changes.
+    """
+    key = (name, company_id, args)
+    version = current_version(company_id)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and _fresh(entry, version):
+            _entries.move_to_end(key)
+            entry['hits'] += 1
+            _totals['hits'] += 1
+            return _share(entry['value'])
+        key_lock = _loading.setdefault(key, threading.Lock())
+
+    with key_lock:
+        # Another session may have loaded it while this one waited
+        with _lock:
+            entry = _entries.get(key)
+            if entry is not None and _fresh(entry, version):
+                _entries.move_to_end(key)
+                entry['hits'] += 1
+                _totals['hits'] += 1
+                return _share(entry['value'])
+            if entry is not None:
+                del _entries[key]
+                _totals['invalidations'] += 1
+
+        try:
+            start = time.perf_counter()
+            value = loader(company_id, *args)
+            seconds = time.perf_counter() - start
+            size = nbytes(value)
+            budget = DATASET_CACHE_MB * 1024 * 1024
+            with _lock:
+                _totals['misses'] += 1
+                misses = entry['misses'] + 1 if entry is not None else 1
+                if size > budget:
+                    _totals['oversized'] += 1
+                    logging.warning(f"Dataset cache: {name}({company_id}) is {size / 1e6:.1f} MB, over the {DATASET_CACHE_MB:.0f} MB budget; not cached")
+                else:
+                    _entries[key] = {
+                        'name': name, 'company_id': company_id, 'args': args, 'value': value, 'bytes': size,
+                        'version': version, 'loaded_at': time.time(), 'load_seconds': seconds, 'hits': 0, 'misses': misses
+                    }
+                    _evict(budget)
+        finally:
+            with _lock:
+                _loading.pop(key, None)
+    return _share(value)
+
+
+def tenant_cached(loader):
+    """
+    Decorator: routes loader(company_id, ...) through the shared cache. Arguments must be
+    hashable; defaults are filled in so load(cid) and load(cid, None) share one entry.
+    """
+    signature = inspect.signature(loader)
+
+    @functools.wraps(loader)
+    def wrapper(company_id, *args, **kwargs):
+        bound = signature.bind(company_id, *args, **kwargs)
+        bound.apply_defaults()
+        return get(loader.__name__, company_id, tuple(bound.arguments.values())[1:], loader)
+    wrapper.clear = lambda: clear(loader.__name__)
+    return wrapper
+
+
+def clear(name=None, company_id=None):
+    """Drops the entries of one loader and/or tenant (everything by default)."""
+    with _lock:
+        for key in [k for k in _entries if (name is None or k[0] == name) and (company_id is None or k[1] == company_id)]:
+            del _entries[key]
+        if company_id is None:
+            _versions.clear()
+        else:
+            _versions.pop(company_id, None)
+
+
+def stats():
+    """Cache totals and one row per entry (for the instrumentation page)."""
+    with _lock:
+        entries = [
+            {'dataset': e['name'], 'company_id': e['company_id'], 'args': repr(e['args']) if e['args'] else '',
+             'mb': e['bytes'] / 1e6, 'hits': e['hits'], 'misses': e['misses'], 'load_s': e['load_seconds'],
+             'version': e['version'] or '', 'age_s': time.time() - e['loaded_at']}
+            for e in reversed(_entries.values())
+        ]
+        totals = dict(_totals, entries=len(_entries), bytes=sum(e['bytes'] for e in _entries.values()),
+                      budget_bytes=int(DATASET_CACHE_MB * 1024 * 1024))
+    lookups = totals['hits'] + totals['misses']
+    totals['hit_rate'] = totals['hits'] / lookups if lookups else 0.0
+    return totals, pd.DataFrame(entries, columns=['dataset', 'company_id', 'args', 'mb', 'hits', 'misses', 'load_s', 'version', 'age_s'])
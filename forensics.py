@@ -0,0 +1,528 @@
+"""
+Forensic checks shared by the migration pipeline and the alert tests.
+
+Duplicate 'Tríada' (RFC emisor + Monto + Fecha):
+  - a persistent per-tenant triad index (FORENSICS_DIR/triad_index/<company_id>.sqlite)
+    so each batch is checked against the full history by probing only its own keys;
+  - near-duplicates (same emisor, amount within a tolerance, dates within a window) found
+    with a sorted-window join on (emisor, fecha) instead of comparing every pair.
+"""
+import os
+import json
+import glob
+import shutil
+import sqlite3
+import uuid as uuid_lib
+import logging
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+import alert_outbox
+
+load_dotenv()
+
+# Configuration
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+FORENSICS_DIR = os.getenv("FORENSICS_DIR", os.path.join(DATA_DIR, "forensics"))
+NEAR_DUP_ENABLED = os.getenv("NEAR_DUP_ENABLED", "true").lower() == "true"
+NEAR_DUP_WINDOW_DAYS = float(os.getenv("NEAR_DUP_WINDOW_DAYS", 3))
+NEAR_DUP_AMOUNT_TOL = float(os.getenv("NEAR_DUP_AMOUNT_TOL", 1.0))      # MXN
+NEAR_DUP_AMOUNT_PCT = float(os.getenv("NEAR_DUP_AMOUNT_PCT", 0.005))    # 0.5% of the larger amount
+MAX_PAIRS_PER_BLOCK = 5_000_000
+
+INDEX_COLUMNS = ['uuid', 'emisor', 'fecha_s', 'total', 'triad']
+PARTNER_FLAGS = ['is_duplicate', 'is_near_duplicate']
+
+
+# --- Triad keys ---
+
+def triad_frame(cfdis, emisor_rfc=None):
+    """
+    Normalized triad per CFDI: uuid, emisor (RFC, or emisor_id if no RFC), fecha_s (epoch seconds,
+    -1 if unparseable), total (rounded to cents) and its 64-bit hash `triad`.
+    `emisor_rfc` optionally maps emisor_id -> RFC when the frame is not enriched yet.
+    """
+    if 'emisor_rfc' in cfdis.columns:
+        emisor = cfdis['emisor_rfc']
+    elif emisor_rfc is not None:
+        emisor = cfdis['emisor_id'].map(emisor_rfc)
+    else:
+        emisor = cfdis['emisor_id']
+    fechas = pd.to_datetime(cfdis['fecha_emision'], errors='coerce')
+    frame = pd.DataFrame({
+        'uuid': cfdis['uuid'].astype(str).to_numpy() if 'uuid' in cfdis.columns else cfdis['id'].astype(str).to_numpy(),
+        'emisor': emisor.astype(str).str.strip().str.upper().to_numpy(),
+        'fecha_s': np.where(fechas.isna(), -1, fechas.to_numpy(dtype='datetime64[s]').astype('int64')),
+        'total': pd.to_numeric(cfdis['total'], errors='coerce').round(2).to_numpy()
+    })
+    cents = np.round(frame['total'].fillna(0).to_numpy() * 100).astype('int64')
+    keys = pd.DataFrame({'emisor': frame['emisor'], 'fecha_s': frame['fecha_s'], 'cents': cents})
+    frame['triad'] = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+    return frame
+
+
+# --- Persistent triad index ---
+# One SQLite file per tenant with a unique uuid index (a re-ingested CFDI replaces its previous
+# entry in place) and indexes on triad and (emisor, fecha_s). Each query is driven by a small
+# temporary table holding the batch keys (CROSS JOIN fixes that loop order), so neither lookups
+# nor appends depend on the size of the history. Triad hashes are stored as signed 64-bit
+# integers (SQLite INTEGER).
+
+INDEX_TABLE = """
+CREATE TABLE IF NOT EXISTS triads (
+    uuid TEXT NOT NULL,
+    emisor TEXT NOT NULL,
+    fecha_s INTEGER NOT NULL,
+    total REAL,
+    triad INTEGER NOT NULL
+);
+"""
+INDEX_KEYS = """
+CREATE UNIQUE INDEX IF NOT EXISTS idx_triads_uuid ON triads (uuid);
+CREATE INDEX IF NOT EXISTS idx_triads_triad ON triads (triad);
+CREATE INDEX IF NOT EXISTS idx_triads_emisor_fecha ON triads (emisor, fecha_s);
+"""
+
+
+def index_path(company_id):
+    return os.path.join(FORENSICS_DIR, "triad_index", f"{company_id}.sqlite")
+
+
+def legacy_index_dir(company_id):
+    """Parquet-parts layout of earlier versions (FORENSICS_DIR/triad_index/<company_id>/part-*.parquet)."""
+    return os.path.join(FORENSICS_DIR, "triad_index", str(company_id))
+
+
+def _import_legacy(company_id):
+    """One-time conversion of a Parquet-parts index into the SQLite index (latest part wins per uuid)."""
+    parts = sorted(glob.glob(os.path.join(legacy_index_dir(company_id), "part-*.parquet")))
+    if parts:
+        save_index(company_id, (pd.read_parquet(p, columns=INDEX_COLUMNS) for p in parts), replace=True)
+        shutil.rmtree(legacy_index_dir(company_id), ignore_errors=True)
+
+
+def has_index(company_id):
+    if not os.path.exists(index_path(company_id)):
+        _import_legacy(company_id)
+    return os.path.exists(index_path(company_id))
+
+
+def connect_index(company_id):
+    path = index_path(company_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(INDEX_TABLE + INDEX_KEYS)
+    return conn
+
+
+def _signed(triads):
+    return np.asarray(triads, dtype='uint64').view('int64').tolist()
+
+
+def _records(frame):
+    return zip(frame['uuid'].astype(str).tolist(), frame['emisor'].astype(str).tolist(),
+               frame['fecha_s'].astype('int64').tolist(),
+               frame['total'].astype('float64').replace({np.nan: None}).tolist(), _signed(frame['triad']))
+
+
+def _probe(conn, name, column, values):
+    """Fills a temporary single-column table with the batch keys a query joins against."""
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {name} ({column} PRIMARY KEY)")
+    conn.execute(f"DELETE FROM {name}")
+    conn.executemany(f"INSERT OR IGNORE INTO {name} VALUES (?)", ((v,) for v in values))
+
+
+def save_index(company_id, entries, replace=False):
+    """
+    Writes triad entries (a frame or an iterable of frames) into the tenant's index. Incremental
+    runs upsert them in one transaction (each uuid replaces its previous entry). `replace` (full
+    runs) bulk-loads a new index file, builds its indexes once and swaps it in.
+    """
+    frames = [entries] if isinstance(entries, pd.DataFrame) else entries
+    insert = "INSERT OR REPLACE INTO triads (uuid, emisor, fecha_s, total, triad) VALUES (?, ?, ?, ?, ?)"
+    rows = 0
+    if not replace:
+        has_index(company_id)  # Converts an earlier Parquet index before upserting into it
+        with connect_index(company_id) as conn:
+            for frame in frames:
+                if not frame.empty:
+                    conn.executemany(insert, _records(frame))
+                    rows += len(frame)
+        conn.close()
+        logging.info(f"Triad index for {company_id}: {rows} entries upserted")
+        return
+
+    path = index_path(company_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    stage = f"{path}.staging-{uuid_lib.uuid4().hex[:8]}"
+    try:
+        conn = sqlite3.connect(stage)
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.executescript(INDEX_TABLE)
+        with conn:
+            for frame in frames:
+                if not frame.empty:
+                    conn.executemany(insert, _records(frame))
+                    rows += len(frame)
+        # Indexes built once, in one sorted pass each; a uuid loaded twice keeps its latest entry
+        try:
+            conn.executescript(INDEX_KEYS)
+        except sqlite3.IntegrityError:
+            conn.execute("DELETE FROM triads WHERE rowid NOT IN (SELECT MAX(rowid) FROM triads GROUP BY uuid)")
+            conn.commit()
+            conn.executescript(INDEX_KEYS)
+        conn.close()
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        os.replace(stage, path)
+    finally:
+        if os.path.exists(stage):
+            os.remove(stage)
+    logging.info(f"Triad index for {company_id}: rebuilt with {rows} entries")
+
+
+# --- Exact duplicates ---
+
+def known_triads(company_id, triads, exclude_uuids):
+    """
+    Indexed CFDIs (uuid, fecha_s, triad) other than `exclude_uuids` (the batch being re-ingested)
+    whose triad is among `triads`. Only the given hashes are probed.
+    """
+    triads = np.unique(np.asarray(triads, dtype='uint64'))
+    empty = pd.DataFrame({'uuid': pd.Series(dtype=object), 'fecha_s': pd.Series(dtype='int64'), 'triad': pd.Series(dtype='uint64')})
+    if not len(triads) or not has_index(company_id):
+        return empty
+    with connect_index(company_id) as conn:
+        _probe(conn, 'probe_triads', 'triad', _signed(triads))
+        _probe(conn, 'probe_uuids', 'uuid', pd.Series(exclude_uuids).astype(str).tolist())
+        found = conn.execute(
+            "SELECT t.uuid, t.fecha_s, t.triad FROM probe_triads p CROSS JOIN triads t ON t.triad = p.triad "
+            "WHERE t.uuid NOT IN (SELECT uuid FROM probe_uuids)"
+        ).fetchall()
+    conn.close()
+    if not found:
+        return empty
+    known = pd.DataFrame(found, columns=['uuid', 'fecha_s', 'triad'])
+    known['triad'] = known['triad'].to_numpy(dtype='int64').view('uint64')
+    return known
+
+
+def exact_duplicates(batch, company_id=None):
+    """
+    Boolean mask over `batch` (a triad_frame): the triad repeats inside the batch or matches an
+    indexed CFDI of the tenant. Index lookups only cost O(batch) hash probes. Also returns the
+    matched indexed CFDIs (see known_triads), which are duplicates too.
+    """
+    dup = batch['triad'].duplicated(keep=False).to_numpy().copy()
+    history = None
+    if company_id is not None:
+        history = known_triads(company_id, batch['triad'], batch['uuid'])
+        if len(history):
+            dup |= np.isin(batch['triad'].to_numpy(dtype='uint64'), history['triad'].to_numpy(dtype='uint64'))
+    return dup, history
+
+
+# --- Near duplicates (sorted-window join) ---
+
+def near_duplicates(batch, history=None, window_days=NEAR_DUP_WINDOW_DAYS,
+                    amount_tol=NEAR_DUP_AMOUNT_TOL, amount_pct=NEAR_DUP_AMOUNT_PCT):
+    """
+    Pairs (uuid_a, uuid_b, ...) with the same emisor, dates within `window_days` and amounts within
+    max(amount_tol, amount_pct * larger amount), involving at least one batch row. Exact triad
+    matches are left to exact_duplicates().
+
+    Rows are sorted by (emisor, fecha); each row is only compared with the rows that follow it
+    inside its window, found with searchsorted, so the cost is O(n log n + candidate pairs).
+    """
+    frames = [batch.assign(_new=True)]
+    if history is not None and not history.empty:
+        frames.append(history.assign(_new=False))
+    rows = pd.concat(frames, ignore_index=True)
+    rows = rows[(rows['fecha_s'] >= 0) & rows['total'].notna()].drop_duplicates('uuid', keep='first')
+    empty = pd.DataFrame(columns=['uuid_a', 'uuid_b', 'emisor', 'fecha_a', 'fecha_b', 'total_a', 'total_b', 'diff_total', 'diff_days'])
+    if len(rows) < 2:
+        return empty
+
+    codes, _ = pd.factorize(rows['emisor'])
+    key = (codes.astype('int64') << 33) | rows['fecha_s'].to_numpy(dtype='int64')
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    cols = {c: rows[c].to_numpy()[order] for c in ['uuid', 'emisor', 'fecha_s', 'total', 'triad', '_new']}
+
+    window_s = int(window_days * 86400)
+    end = np.searchsorted(key, key + window_s, side='right')
+    counts = end - np.arange(len(key)) - 1
+
+    pairs = []
+    # Expand candidate pairs in blocks so dense emisors cannot blow up memory
+    block_start = 0
+    cum = np.cumsum(counts)
+    while block_start < len(key):
+        base = cum[block_start - 1] if block_start else 0
+        block_end = max(int(np.searchsorted(cum, base + MAX_PAIRS_PER_BLOCK, side='right')), block_start + 1)
+        block_end = min(block_end, len(key))
+        idx = np.arange(block_start, block_end)
+        c = counts[idx]
+        left = np.repeat(idx, c)
+        offsets = np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c)
+        right = left + 1 + offsets
+
+        ta, tb = cols['total'][left], cols['total'][right]
+        tol = np.maximum(amount_tol, amount_pct * np.maximum(np.abs(ta), np.abs(tb)))
+        keep = (np.abs(ta - tb) <= tol) & (cols['triad'][left] != cols['triad'][right]) & (cols['_new'][left] | cols['_new'][right])
+        left, right = left[keep], right[keep]
+        if len(left):
+            pairs.append(pd.DataFrame({
+                'uuid_a': cols['uuid'][left], 'uuid_b': cols['uuid'][right], 'emisor': cols['emisor'][left],
+                'fecha_a': pd.to_datetime(cols['fecha_s'][left], unit='s'), 'fecha_b': pd.to_datetime(cols['fecha_s'][right], unit='s'),
+                'total_a': cols['total'][left], 'total_b': cols['total'][right],
+                'diff_total': np.abs(cols['total'][left] - cols['total'][right]).round(2),
+                'diff_days': ((cols['fecha_s'][right] - cols['fecha_s'][left]) / 86400).round(2)
+            }))
+        block_start = block_end
+    return pd.concat(pairs, ignore_index=True) if pairs else empty
+
+
+def near_duplicate_history(company_id, batch, window_days=NEAR_DUP_WINDOW_DAYS):
+    """
+    Indexed CFDIs that can pair with the batch: for each batch emisor, its entries dated within
+    that emisor's batch dates +/- window (read through the (emisor, fecha_s) index).
+    """
+    empty = pd.DataFrame(columns=INDEX_COLUMNS)
+    valid = batch[batch['fecha_s'] >= 0]
+    if valid.empty or not has_index(company_id):
+        return empty
+    window_s = int(window_days * 86400)
+    ranges = valid.groupby('emisor')['fecha_s'].agg(['min', 'max'])
+    with connect_index(company_id) as conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS probe_ranges (emisor TEXT PRIMARY KEY, lo INTEGER, hi INTEGER)")
+        conn.execute("DELETE FROM probe_ranges")
+        conn.executemany("INSERT INTO probe_ranges VALUES (?, ?, ?)",
+                         zip(ranges.index.astype(str).tolist(), (ranges['min'] - window_s).tolist(), (ranges['max'] + window_s).tolist()))
+        rows = conn.execute(
+            "SELECT t.uuid, t.emisor, t.fecha_s, t.total, t.triad FROM probe_ranges r CROSS JOIN triads t "
+            "ON t.emisor = r.emisor AND t.fecha_s BETWEEN r.lo AND r.hi"
+        ).fetchall()
+    conn.close()
+    if not rows:
+        return empty
+    history = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+    history['total'] = history['total'].astype('float64')
+    history['triad'] = history['triad'].to_numpy(dtype='int64').view('uint64')
+    return history[~history['uuid'].isin(batch['uuid'])]
+
+
+# --- Pipeline entry point ---
+
+def partner_frame(exact=None, near=None):
+    """
+    Published CFDIs that a batch matched, one row per uuid: uuid, fecha_s and the flags to set
+    (is_duplicate for exact triad matches, is_near_duplicate for near-duplicate pairs).
+    """
+    frames = []
+    for matches, flag in ((exact, 'is_duplicate'), (near, 'is_near_duplicate')):
+        if matches is not None and not matches.empty:
+            frames.append(matches[['uuid', 'fecha_s']].assign(is_duplicate=flag == 'is_duplicate', is_near_duplicate=flag == 'is_near_duplicate'))
+    if not frames:
+        return pd.DataFrame(columns=['uuid', 'fecha_s'] + PARTNER_FLAGS)
+    partners = pd.concat(frames, ignore_index=True)
+    partners['uuid'] = partners['uuid'].astype(str)
+    return partners.groupby('uuid', as_index=False).agg({'fecha_s': 'first', 'is_duplicate': 'any', 'is_near_duplicate': 'any'})
+
+
+def mark_partners(cfdis, partners):
+    """Sets the partner flags on published `cfdis` rows; returns (cfdis, mask of the rows whose flags changed)."""
+    changed = np.zeros(len(cfdis), dtype=bool)
+    for flag in PARTNER_FLAGS:
+        if flag not in cfdis.columns:
+            cfdis[flag] = False
+        hit = (cfdis['uuid'].astype(str).isin(partners.loc[partners[flag], 'uuid']) & ~cfdis[flag].fillna(False).astype(bool)).to_numpy()
+        if hit.any():
+            cfdis.loc[hit, flag] = True
+            changed = changed | hit
+    return cfdis, changed
+
+
+def flag_duplicates(cfdis, company_id, incremental=False, near=NEAR_DUP_ENABLED):
+    """
+    Sets is_duplicate / is_near_duplicate on `cfdis`. In incremental runs the batch is also checked
+    against the tenant's triad index, and the published CFDIs it matched are returned as partners
+    (partner_frame) so they can be re-published flagged, as a full rebuild would.
+    Returns (cfdis, alerts, index entries to persist, partners).
+    """
+    batch = triad_frame(cfdis)
+    alerts = []
+
+    cfdis['is_duplicate'], exact = exact_duplicates(batch, company_id if incremental else None)
+    if cfdis['is_duplicate'].any():
+        show = [c for c in ['total', 'fecha_emision', 'emisor_rfc', 'emisor_id'] if c in cfdis.columns][:3]
+        alerts.append(f"Posibles Duplicados Detectados:\n{cfdis.loc[cfdis['is_duplicate'], show].head(10).to_string()}")
+
+    cfdis['is_near_duplicate'] = False
+    near_partners = None
+    if near:
+        history = near_duplicate_history(company_id, batch) if incremental else None
+        pairs = near_duplicates(batch, history)
+        if not pairs.empty:
+            paired = pd.concat([pairs['uuid_a'], pairs['uuid_b']])
+            cfdis['is_near_duplicate'] = batch['uuid'].isin(paired).to_numpy()
+            if history is not None:
+                near_partners = history[history['uuid'].isin(paired)]
+            alerts.append(
+                f"Posibles Duplicados Cercanos (±{NEAR_DUP_WINDOW_DAYS:g} días, ±{max(NEAR_DUP_AMOUNT_TOL, 0):,.2f} / {NEAR_DUP_AMOUNT_PCT:.1%}): "
+                f"{len(pairs)} pares\n{pairs.head(10).to_string()}"
+            )
+    return cfdis, alerts, batch, partner_frame(exact, near_partners)
+
+
+# --- Spike detection engine ---
+# Every rule is evaluated for the latest month against a rolling baseline of the `window`
+# months before it, either as a percentage increase over the baseline mean ('pct') or as a
+# z-score over the baseline ('zscore'). `by` splits the metric per tipo or per emisor.
+
+METRICS = ['total', 'retenciones', 'iva', 'cancelaciones', 'volumen']
+METRIC_LABELS = {
+    'total': 'Facturación', 'retenciones': 'Retenciones', 'iva': 'IVA',
+    'cancelaciones': 'Cancelaciones', 'volumen': 'Volumen de CFDIs'
+}
+CHART_TITLES = {'cancelaciones': "Tendencia de Facturas Canceladas"}
+
+DEFAULT_SPIKE_RULES = [
+    {'metric': 'retenciones', 'window': 1, 'method': 'pct', 'threshold': 0.20},
+    {'metric': 'cancelaciones', 'window': 1, 'method': 'pct', 'threshold': 0.20, 'chart': True},
+    {'metric': 'iva', 'window': 12, 'method': 'zscore', 'threshold': 3.0, 'min_periods': 3},
+    {'metric': 'total', 'by': 'tipo', 'window': 3, 'method': 'pct', 'threshold': 0.50},
+    {'metric': 'volumen', 'by': 'emisor', 'window': 12, 'method': 'zscore', 'threshold': 3.0, 'min_periods': 3, 'min_value': 10},
+]
+
+
+def load_spike_rules(path=os.getenv("SPIKE_RULES_FILE")):
+    """Spike rules from SPIKE_RULES_FILE (JSON list of rules) or the defaults."""
+    if path and os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return DEFAULT_SPIKE_RULES
+
+
+SPIKE_RULES = load_spike_rules()
+
+
+def monthly_metrics(cfdis):
+    """
+    One grouped pass over the CFDIs: additive monthly sums of every metric per (month, tipo, emisor).
+    Partial results (e.g. streaming partitions) can be combined with combine_metrics().
+    """
+    fechas = cfdis['fecha_dt'] if 'fecha_dt' in cfdis.columns else pd.to_datetime(cfdis['fecha_emision'], errors='coerce')
+    n = len(cfdis)
+
+    def column(name):
+        return pd.to_numeric(cfdis[name], errors='coerce').fillna(0).to_numpy() if name in cfdis.columns else np.zeros(n)
+
+    emisor = cfdis['emisor_rfc'] if 'emisor_rfc' in cfdis.columns else cfdis.get('emisor_id', pd.Series('N/A', index=cfdis.index))
+    estatus = cfdis['estatus'].astype(str).str.lower() if 'estatus' in cfdis.columns else pd.Series('', index=cfdis.index)
+    frame = pd.DataFrame({
+        'month_year': fechas.dt.to_period('M').to_numpy(),
+        'tipo': cfdis['tipo'].astype(str).to_numpy() if 'tipo' in cfdis.columns else 'n/a',
+        'emisor': emisor.astype(str).to_numpy(),
+        'total': column('total'),
+        'retenciones': column('calc_retenciones'),
+        'iva': column('calc_iva'),
+        'cancelaciones': estatus.str.contains('cancel', na=False).to_numpy(dtype='int64'),
+        'volumen': np.ones(n, dtype='int64')
+    })
+    frame = frame[frame['month_year'].notna()]
+    return frame.groupby(['month_year', 'tipo', 'emisor'], sort=False)[METRICS].sum()
+
+
+def combine_metrics(parts):
+    parts = [p for p in parts if p is not None and not p.empty]
+    if not parts:
+        return pd.DataFrame(columns=METRICS)
+    return pd.concat(parts).groupby(level=['month_year', 'tipo', 'emisor'], sort=False).sum()
+
+
+def metric_panel(monthly, by=None):
+    """Wide month x (metric, key) panel with every month of the range present (missing = 0)."""
+    levels = ['month_year'] + ([by] if by else [])
+    sums = monthly.groupby(level=levels).sum()
+    if by:
+        panel = sums.unstack(by, fill_value=0)
+    else:
+        panel = sums.copy()
+        panel.columns = pd.MultiIndex.from_product([sums.columns, ['']])
+    months = pd.period_range(panel.index.min(), panel.index.max(), freq='M')
+    return panel.reindex(months, fill_value=0).sort_index(axis=1)
+
+
+def evaluate_spikes(monthly, rules=None):
+    """
+    Evaluates every rule on the latest month. Rolling baselines are computed once per
+    (by, window, min_periods) over the whole panel, so all metrics and all emisors/tipos are
+    scored together. Returns a DataFrame of triggered findings.
+    """
+    rules = SPIKE_RULES if rules is None else rules
+    columns = ['metric', 'by', 'key', 'month', 'method', 'window', 'value', 'baseline', 'score', 'threshold', 'chart']
+    if monthly is None or monthly.empty:
+        return pd.DataFrame(columns=columns)
+
+    panels, baselines, findings = {}, {}, []
+    for rule in rules:
+        by, window, method = rule.get('by'), int(rule.get('window', 1)), rule.get('method', 'pct')
+        min_periods = int(rule.get('min_periods', window))
+        if by not in panels:
+            panels[by] = metric_panel(monthly, by)
+        panel = panels[by]
+        if len(panel) < min_periods + 1:
+            continue
+
+        key = (by, window, min_periods)
+        if key not in baselines:
+            history = panel.shift(1).rolling(window, min_periods=min_periods)
+            baselines[key] = (history.mean().iloc[-1], history.std(ddof=0).iloc[-1])
+        mean, std = baselines[key]
+
+        latest = panel.iloc[-1][rule['metric']]
+        mean, std = mean[rule['metric']], std[rule['metric']]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = (latest / mean - 1) if method == 'pct' else (latest - mean) / std
+        fired = (score > rule['threshold']) & (mean > 0) & (latest >= rule.get('min_value', 0))
+        if method == 'zscore':
+            fired &= std > 0
+
+        for series_key in fired[fired].index:
+            findings.append({
+                'metric': rule['metric'], 'by': by or '', 'key': series_key, 'month': panel.index[-1], 'method': method,
+                'window': window, 'value': float(latest[series_key]), 'baseline': float(mean[series_key]),
+                'score': float(score[series_key]), 'threshold': rule['threshold'], 'chart': bool(rule.get('chart'))
+            })
+    return pd.DataFrame(findings, columns=columns)
+
+
+def describe_spike(f):
+    label = METRIC_LABELS.get(f['metric'], f['metric'])
+    scope = f" ({f['by']} {f['key']})" if f['by'] else ""
+    if f['method'] == 'pct':
+        baseline = "" if f['window'] == 1 else f" vs promedio de {f['window']} meses"
+        return f"Incremento Atípico de {label}{scope}: {f['score']:.1%} de aumento{baseline} en {f['month']}"
+    return (f"Incremento Atípico de {label}{scope}: z={f['score']:.1f} vs últimos {f['window']} meses en {f['month']} "
+            f"({f['value']:,.2f} vs media {f['baseline']:,.2f})")
+
+
+def spike_alerts(monthly, rules=None):
+    """Alert texts for the triggered rules plus a chart spec (first rule flagged with 'chart') or None."""
+    findings = evaluate_spikes(monthly, rules)
+    alerts = [describe_spike(f) for f in findings.to_dict('records')]
+
+    chart = None
+    charted = findings[findings['chart']]
+    if not charted.empty:
+        f = charted.to_dict('records')[0]
+        panel = metric_panel(monthly, f['by'] or None)
+        series = panel[(f['metric'], f['key'] if f['by'] else '')]
+        title = CHART_TITLES.get(f['metric'], f"Tendencia de {METRIC_LABELS.get(f['metric'], f['metric'])}")
+        chart = alert_outbox.chart_spec(series, title, f"alerta_{f['metric']}.png")
+    return alerts, chart
@@ -0,0 +1,425 @@
+"""
+Partitioned Parquet gold layer, written by migration.py and read by the dashboard:
+
+    <gold_dir>/company_id=<tenant>/month=<YYYY-MM>/part-<n>.parquet
+
+A tenant is loaded by opening only its own directory, and only the requested columns
+are decoded from the column chunks.
+"""
+import os
+import glob
+import shutil
+import uuid as uuid_lib
+import logging
+import datetime
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import schema_registry
+
+PARTITION_COLS = ['company_id', 'month']
+UNKNOWN_MONTH = 'unknown'
+# Gold columns never used by the dashboard (file paths, raw metadata, audit timestamps)
+GOLD_UNUSED_COLUMNS = ['xml_path', 'pdf_path', 'xml_filename', 'metadata', 'confirmacion',
+                       'created_at', 'updated_at', 'deleted_at', 'id_rec', 'id_emi', 'fecha_dt']
+# Bookkeeping fields of the Mongo gold collection (document id, migration content hash)
+MONGO_INTERNAL_FIELDS = ['_id', '_content_hash']
+# Dashboard columns computed once by the migration (stored with the gold records)
+NUMERIC_COLUMNS = ['subtotal', 'total', 'descuento', 'calc_iva', 'calc_ieps', 'calc_ret_isr', 'calc_ret_iva', 'calc_retenciones', 'calc_traslados']
+PAYMENT_NUMERIC_COLUMNS = ['pago_monto_pagado', 'pago_saldo_insoluto', 'pago_num_pagos']
+DERIVED_COLUMNS = ['month', 'year', 'week', 'ventas_netas_calc']
+# Columns the migration adds to the cfdis schema besides the ones above (duplicate flags, sales, PPD status)
+GOLD_EXTRA_COLUMNS = ['is_duplicate', 'is_near_duplicate', 'month_year', 'ventas_brutas', 'ventas_netas',
+                      'pago_ultima_fecha', 'pago_estatus'] + PAYMENT_NUMERIC_COLUMNS
+# Mongo indexes behind the dashboard's windowed reads (tenant + date range, optionally by tipo)
+MONGO_INDEXES = [
+    [('company_id', 1), ('fecha_emision', 1)],
+    [('company_id', 1), ('tipo', 1), ('fecha_emision', 1)]
+]
+
+
+def tenant_dir(gold_dir, company_id):
+    return os.path.join(gold_dir, f"company_id={company_id}")
+
+
+def json_path(data_dir, company_id):
+    """The tenant's JSON gold file (GOLD_FORMAT=json); one per tenant, so tenants sharing DATA_DIR never overwrite each other."""
+    return os.path.join(data_dir, f"gold_cfdi_processed_{company_id}.json")
+
+
+def tenant_rows(df, company_id):
+    """Only `company_id`'s rows of a local gold frame."""
+    if 'company_id' not in df.columns:
+        return df
+    return df[df['company_id'].astype(str) == str(company_id)]
+
+
+def staging_dir(gold_dir, company_id):
+    """Private scratch dir next to the published partitions (same filesystem, so publish is a rename)."""
+    path = os.path.join(gold_dir, f".staging-{company_id}-{uuid_lib.uuid4().hex[:8]}")
+    os.makedirs(path)
+    return path
+
+
+def month_keys(cfdis):
+    """YYYY-MM partition key per row, taken from fecha_emision."""
+    fechas = pd.to_datetime(cfdis['fecha_emision'], errors='coerce')
+    return fechas.dt.strftime('%Y-%m').fillna(UNKNOWN_MONTH)
+
+
+def to_arrow(frame):
+    """Arrow table with partition columns removed and a stable per-file schema."""
+    frame = frame.drop(columns=PARTITION_COLS, errors='ignore')
+    for col in frame.columns:
+        if isinstance(frame[col].dtype, (pd.CategoricalDtype, pd.PeriodDtype)):
+            frame[col] = frame[col].astype(str).where(frame[col].notna(), None)
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    # Columns that are entirely empty in this slice would otherwise be typed 'null'
+    for i, field in enumerate(table.schema):
+        if pa.types.is_null(field.type):
+            table = table.set_column(i, pa.field(field.name, pa.string()), table.column(i).cast(pa.string()))
+    return table
+
+
+def write_parts(cfdis, stage, part=0):
+    """Writes `cfdis` into month partitions of a staging dir (one file per month per call)."""
+    months = month_keys(cfdis)
+    for month, rows in cfdis.groupby(months.to_numpy(), sort=False):
+        month_dir = os.path.join(stage, f"month={month}")
+        os.makedirs(month_dir, exist_ok=True)
+        pq.write_table(to_arrow(rows), os.path.join(month_dir, f"part-{part:05d}.parquet"))
+
+
+def _swap(src, dst):
+    """Replaces dst with src using renames; the old copy is removed afterwards."""
+    old = None
+    if os.path.exists(dst):
+        old = f"{dst}.old-{uuid_lib.uuid4().hex[:8]}"
+        os.rename(dst, old)
+    os.rename(src, dst)
+    if old:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def _read_files(files, columns=None, tipos=None, dates=None, base_dir=None):
+    """Reads parquet files as one frame; with `base_dir` the month partition key is restored as a column."""
+    if not files:
+        return None
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files], promote_options='permissive')
+    partitioning = None
+    if base_dir is not None:
+        partitioning = ds.partitioning(pa.schema([('month', pa.string())]), flavor='hive')
+        if 'month' not in schema.names:
+            schema = schema.append(pa.field('month', pa.string()))
+    if columns is not None:
+        columns = [c for c in columns if c in schema.names]
+    condition = None
+    if tipos is not None and 'tipo' in schema.names:
+        condition = ds.field('tipo').isin(list(tipos))
+    # Gold written before the derived columns stores fecha_emision as text: its date window is applied in memory
+    text_dates = (dates is not None and 'fecha_emision' in schema.names
+                  and not pa.types.is_timestamp(schema.field('fecha_emision').type))
+    read_columns = columns
+    if text_dates and columns is not None and 'fecha_emision' not in columns:
+        read_columns = columns + ['fecha_emision']
+    if dates is not None and 'fecha_emision' in schema.names and not text_dates:
+        low, high = date_bounds(*dates)
+        in_range = (ds.field('fecha_emision') >= low) & (ds.field('fecha_emision') < high)
+        condition = in_range if condition is None else condition & in_range
+    dataset = ds.dataset(files, schema=schema, format='parquet', partitioning=partitioning, partition_base_dir=base_dir)
+    df = dataset.to_table(columns=read_columns, filter=condition).to_pandas()
+    if text_dates:
+        df = filter_frame(df, dates=dates)
+        if read_columns is not columns:
+            df = df.drop(columns='fecha_emision')
+    return df
+
+
+def month_files(month_dir):
+    return sorted(glob.glob(os.path.join(month_dir, "*.parquet")))
+
+
+def publish(stage, gold_dir, company_id, incremental=False):
+    """
+    Publishes a staging dir for a tenant.
+    Full runs replace the tenant directory. Incremental runs only rewrite the months that
+    received rows or that still hold stale versions of the re-ingested UUIDs.
+    """
+    target = tenant_dir(gold_dir, company_id)
+    if not incremental or not os.path.exists(target):
+        _swap(stage, target)
+        return
+
+    staged = {os.path.basename(d): d for d in glob.glob(os.path.join(stage, "month=*"))}
+    delta_uuids = set()
+    for month_dir in staged.values():
+        delta_uuids.update(_read_files(month_files(month_dir), ['uuid'])['uuid'].astype(str))
+
+    existing = {os.path.basename(d): d for d in glob.glob(os.path.join(target, "month=*"))}
+    for name in sorted(set(staged) | set(existing)):
+        old_files = month_files(existing[name]) if name in existing else []
+        legacy = is_legacy(old_files)
+        if name not in staged and not legacy:
+            # Untouched month unless it holds a stale copy of a re-ingested CFDI
+            uuids = _read_files(old_files, ['uuid'])
+            if uuids is None or not uuids['uuid'].astype(str).isin(delta_uuids).any():
+                continue
+
+        frames = []
+        if old_files:
+            old = _read_files(old_files)
+            if legacy:
+                old = derive_columns(old)
+            frames.append(old[~old['uuid'].astype(str).isin(delta_uuids)])
+        if name in staged:
+            frames.append(_read_files(month_files(staged[name])))
+        merged = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+        month_path = os.path.join(target, name)
+        if merged.empty:
+            shutil.rmtree(month_path, ignore_errors=True)
+            continue
+        rebuilt = os.path.join(stage, f".rebuilt-{name}")
+        os.makedirs(rebuilt)
+        pq.write_table(to_arrow(merged), os.path.join(rebuilt, "part-00000.parquet"))
+        _swap(rebuilt, month_path)
+
+    shutil.rmtree(stage, ignore_errors=True)
+
+
+def is_legacy(files):
+    """True for partitions written before the derived columns (fecha_emision stored as text); rewritten on the next publish."""
+    for f in files:
+        schema = pq.read_schema(f)
+        if 'fecha_emision' in schema.names and not pa.types.is_timestamp(schema.field('fecha_emision').type):
+            return True
+    return False
+
+
+def discard(stage):
+    shutil.rmtree(stage, ignore_errors=True)
+
+
+def date_bounds(start, end):
+    """[low, high) datetime bounds of fecha_emision for the inclusive date range start..end."""
+    low = datetime.datetime.combine(start, datetime.time())
+    return low, datetime.datetime.combine(end, datetime.time()) + datetime.timedelta(days=1)
+
+
+def window_months(start, end):
+    """YYYY-MM partition keys covering the date range start..end."""
+    return [str(p) for p in pd.period_range(start, end, freq='M')]
+
+
+def mongo_query(company_id, tipos=None, dates=None):
+    """Mongo filter of one tenant's gold records, optionally restricted to `tipos` and a (start, end) date range."""
+    query = {'company_id': company_id}
+    if tipos is not None:
+        query['tipo'] = {'$in': list(tipos)}
+    if dates is not None:
+        low, high = date_bounds(*dates)
+        query['fecha_emision'] = {'$gte': low, '$lt': high}
+    return query
+
+
+def filter_frame(df, tipos=None, dates=None):
+    """
+    In-memory counterpart of mongo_query, for gold records that cannot be read windowed (the local
+    JSON export, text-dated Parquet written before the derived columns).
+    """
+    mask = pd.Series(True, index=df.index)
+    if tipos is not None and 'tipo' in df.columns:
+        mask &= df['tipo'].isin(list(tipos))
+    if dates is not None and 'fecha_emision' in df.columns:
+        low, high = date_bounds(*dates)
+        fechas = parse_fechas(df['fecha_emision'])
+        mask &= (fechas >= low) & (fechas < high)
+    return df if mask.all() else df[mask]
+
+
+def empty_frame(exclude=None):
+    """Zero-row frame with the gold columns (cfdis schema plus the migration's), for an empty dashboard window."""
+    columns = list(schema_registry.TABLE_SCHEMAS['cfdis']['dtypes']) + GOLD_EXTRA_COLUMNS
+    frame = pd.DataFrame({c: pd.Series(dtype=object) for c in columns if c not in set(exclude or [])})
+    return derive_columns(frame)
+
+
+def ensure_indexes(collection):
+    for keys in MONGO_INDEXES:
+        collection.create_index(keys)
+
+
+def read_tenant(gold_dir, company_id, columns=None, exclude=None, months=None, tipos=None, dates=None):
+    """
+    Reads one tenant's gold partitions (None if the tenant has no gold layer).
+    `columns` restricts the decoded columns; `exclude` drops columns by name instead;
+    `months` (YYYY-MM keys) restricts the partitions that are opened. `tipos` and a
+    (start, end) `dates` range filter the rows; the date range also prunes the months.
+    """
+    if dates is not None and months is None:
+        months = window_months(*dates)
+    target = tenant_dir(gold_dir, company_id)
+    if months is None:
+        files = sorted(glob.glob(os.path.join(target, "month=*", "*.parquet")))
+    else:
+        files = sorted(f for month in months for f in month_files(os.path.join(target, f"month={month}")))
+    if not files:
+        return None
+    if columns is None and exclude:
+        schema = pa.unify_schemas([pq.read_schema(f) for f in files], promote_options='permissive')
+        columns = [c for c in schema.names + ['month'] if c not in set(exclude)]
+    df = _read_files(files, columns, tipos, dates, base_dir=target)
+    df['company_id'] = company_id
+    logging.info(f"Gold layer: {len(df)} rows for {company_id} from {len(files)} partitions")
+    return df
+
+
+def read_mongo(collection, company_id, columns=None, exclude=None, batch_size=5000, tipos=None, dates=None):
+    """
+    Reads one tenant's gold records from Mongo (None if it has none). Only the requested
+    fields are sent by the server (`columns` to include, or `exclude` to drop, like read_tenant),
+    and only the rows matching `tipos` / the `dates` range (see mongo_query). The cursor
+    batches are appended field by field into column buffers, so no list of per-row dicts is
+    ever held and the DataFrame is built once from the columns.
+    """
+    if columns is not None:
+        projection = {c: 1 for c in columns}
+        projection['_id'] = 0
+    else:
+        projection = {c: 0 for c in set(exclude or []) | set(MONGO_INTERNAL_FIELDS)}
+    buffers, appends = {}, {}
+    n = 0
+    for doc in collection.find(mongo_query(company_id, tipos, dates), projection, batch_size=batch_size):
+        for key, value in doc.items():
+            append = appends.get(key)
+            if append is None:
+                # Field first seen at this row: earlier documents did not have it
+                buffers[key] = [None] * n
+                append = appends[key] = buffers[key].append
+            append(value)
+        n += 1
+        if len(doc) != len(buffers):
+            # The document lacks some known fields
+            for buffer in buffers.values():
+                if len(buffer) < n:
+                    buffer.append(None)
+    if n == 0:
+        return None
+    df = pd.DataFrame(buffers)
+    logging.info(f"Gold layer: {n} rows for {company_id} from Mongo ({len(buffers)} fields)")
+    return df
+
+
+def filter_options(df):
+    """(tipos, first date, last date) offered by the dashboard filters for a frame with tipo / fecha_emision."""
+    tipos = sorted(df['tipo'].dropna().astype(str).unique()) if 'tipo' in df.columns else []
+    fechas = pd.to_datetime(df['fecha_emision'], errors='coerce') if 'fecha_emision' in df.columns else pd.Series(dtype='datetime64[ns]')
+    if fechas.notna().any():
+        return tipos, fechas.min().date(), fechas.max().date()
+    return tipos, None, None
+
+
+def mongo_filter_options(collection, company_id):
+    """
+    filter_options for a tenant's Mongo gold records, answered from the (company_id, tipo,
+    fecha_emision) and (company_id, fecha_emision) indexes instead of reading the history.
+    None if the tenant has no records.
+    """
+    tipos = sorted(str(t) for t in collection.distinct('tipo', {'company_id': company_id}) if t is not None)
+    dated = {'company_id': company_id, 'fecha_emision': {'$type': 'date'}}
+    bounds = [next(collection.find(dated, {'fecha_emision': 1, '_id': 0}).sort('fecha_emision', direction).limit(1), None)
+              for direction in (1, -1)]
+    if not tipos and bounds[0] is None:
+        return None
+    if bounds[0] is None:
+        return tipos, None, None
+    first, last = (pd.to_datetime(doc['fecha_emision'], errors='coerce') for doc in bounds)
+    return tipos, (first.date() if pd.notna(first) else None), (last.date() if pd.notna(last) else None)
+
+
+def parse_fechas(series):
+    """
+    Native datetimes from fecha_emision: ISO strings and mixed types directly, numeric
+    epoch milliseconds (older Mongo exports) as a fallback; unparseable values become NaT.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    # Do NOT force numeric first, as it destroys ISO date strings
+    fechas = pd.to_datetime(series, errors='coerce')
+    if fechas.isna().any():
+        numeric_dates = pd.to_numeric(series, errors='coerce')
+        fechas = fechas.fillna(pd.to_datetime(numeric_dates, unit='ms', errors='coerce'))
+    return fechas
+
+
+def _by_day(fechas, key):
+    """Per-row period key of `fechas`, formatted once per distinct day (NaT -> None)."""
+    codes, days = pd.factorize(fechas.dt.normalize())
+    labels = np.append(key(pd.DatetimeIndex(days)).to_numpy(dtype=object), None)
+    return pd.Series(labels[codes], index=fechas.index)
+
+
+def derive_columns(df):
+    """
+    Typed and derived gold columns, computed once by the migration so the dashboard reads them
+    as stored: native fecha_emision, month / year / week keys, numeric money and tax columns,
+    ventas_netas_calc and the standard emisor/receptor RFC and name columns.
+    """
+    if 'fecha_emision' in df.columns:
+        fechas = parse_fechas(df['fecha_emision'])
+        df['fecha_emision'] = fechas
+        df['month'] = _by_day(fechas, lambda days: days.strftime('%Y-%m'))
+        df['year'] = fechas.dt.year.astype('Int64')
+        df['week'] = _by_day(fechas, lambda days: days.to_period('W').astype(str))
+
+    # Numeric columns (currency symbols removed), missing ones as 0
+    for col in NUMERIC_COLUMNS:
+        if col in df.columns:
+            if not pd.api.types.is_numeric_dtype(df[col]):
+                df[col] = df[col].astype(str).str.replace(r'[$,]', '', regex=True)
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+        else:
+            df[col] = 0.0
+    df['ventas_netas_calc'] = (df['subtotal'] + df['calc_iva']) - (df['calc_retenciones'] + df['descuento'])
+    # PPD reconciliation fields stay null outside PPD invoices
+    for col in PAYMENT_NUMERIC_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+
+    # Standard 'emisor_rfc' / 'receptor_rfc' columns from the common variations
+    # ('emisor' / 'receptor' sometimes hold the RFC)
+    for side in ('emisor', 'receptor'):
+        if f'{side}_rfc' not in df.columns:
+            if f'rfc_{side}' in df.columns:
+                df[f'{side}_rfc'] = df[f'rfc_{side}']
+            elif side in df.columns:
+                df[f'{side}_rfc'] = df[side]
+            else:
+                df[f'{side}_rfc'] = 'XAXX010101000'
+        if f'{side}_nombre' not in df.columns:
+            df[f'{side}_nombre'] = 'DESCONOCIDO'
+    return df
+
+
+def is_derived(df):
+    """True when the frame already carries the migration's typed and derived columns."""
+    return (all(col in df.columns for col in DERIVED_COLUMNS)
+            and 'fecha_emision' in df.columns and pd.api.types.is_datetime64_any_dtype(df['fecha_emision']))
+
+
+def dashboard_frame(df):
+    """
+    The gold records as used by the dashboard's load_data. Gold written by the migration is
+    already typed and derived and is only stripped of the rows without a valid date; older
+    gold and the local JSON export are derived here.
+    """
+    if df.empty:
+        return df
+    if not is_derived(df):
+        df = derive_columns(df)
+    if 'fecha_emision' in df.columns and df['fecha_emision'].isna().any():
+        df = df[df['fecha_emision'].notna()]
+    return df
@@ -1,13 +1,26 @@
 import pandas as pd
+import numpy as np
 import os
+import json
+import glob
+import math
+import argparse
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pymongo
 from dotenv import load_dotenv
-import smtplib
-from email.mime.image import MIMEImage
 import logging
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg') # non-interactive backend
+
+import schema_registry
+import gold_store
+import alert_outbox
+import forensics
+import rollups
+import payments
+import payroll
+import concept_taxes
+import dataset_cache
 
 # Setup Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,24 +33,57 @@ DATA_DIR = os.getenv("DATA_DIR", "./data")
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = os.getenv("DB_NAME", "cfdi_db")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "gold_cfdi")
+WATERMARK_COLLECTION = os.getenv("WATERMARK_COLLECTION", "ingestion_watermarks")
 
-# SMTP Config
-SMTP_SERVER = os.getenv("SMTP_SERVER")
-SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
-SMTP_USER = os.getenv("SMTP_USER")
-SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
-ALERT_RECEIVER = os.getenv("ALERT_RECEIVER")
+# Shared lake: only ingest CFDIs whose cfdis.company_id matches (unset = all rows belong to the tenant)
+SOURCE_COMPANY_ID = os.getenv("SOURCE_COMPANY_ID")
 
-def load_csv(filename):
-    path = os.path.join(DATA_DIR, filename)
-    if not os.path.exists(path):
-        logging.error(f"File not found: {path}")
-        return None
-    try:
-        # Try UTF-8 first, then Latin-1
-        return pd.read_csv(path, encoding='utf-8')
-    except UnicodeDecodeError:
-        return pd.read_csv(path, encoding='latin-1')
+# Incremental Mode: only reprocess CFDIs newer than the tenant watermark
+INCREMENTAL = os.getenv("INCREMENTAL", "false").lower() == "true"
+
+# Streaming Mode: bounded-memory chunked ingestion with on-disk hash partitions
+STREAMING = os.getenv("STREAMING", "false").lower() == "true"
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 200000))
+STREAM_BUCKET_MB = float(os.getenv("STREAM_BUCKET_MB", 64))
+SPILL_DIR = os.getenv("SPILL_DIR")  # Defaults to the system temp dir
+
+# Mongo Load: unchanged records (same content hash) are skipped, the rest go in parallel unordered batches
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 1000))
+UPSERT_WORKERS = int(os.getenv("UPSERT_WORKERS", 4))
+HASH_FIELD = "_content_hash"
+
+# Offline Gold Layer: 'parquet' (partitioned by company_id/month) or 'json' (one gold_cfdi_processed_<company_id>.json per tenant)
+GOLD_FORMAT = os.getenv("GOLD_FORMAT", "parquet").lower()
+GOLD_DIR = os.getenv("GOLD_DIR", os.path.join(DATA_DIR, "gold_cfdi"))
+
+# Stage Checkpoints: intermediate pipeline state per tenant (resume / single-stage re-runs)
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", os.path.join(DATA_DIR, ".checkpoints"))
+
+def load_csv(filename, usecols=None):
+    """Reads a lake CSV with its registered dtypes (see schema_registry)."""
+    table = schema_registry.table_for_file(filename)
+    if table is None:
+        path = os.path.join(DATA_DIR, filename)
+        if not os.path.exists(path):
+            logging.error(f"File not found: {path}")
+            return None
+        return pd.read_csv(path, encoding=schema_registry.detect_encoding(path), usecols=usecols)
+    return schema_registry.read_table(table, DATA_DIR, usecols=usecols)
+
+def iter_csv(filename, chunksize=CHUNK_SIZE, usecols=None):
+    """Yields the CSV in chunks of `chunksize` rows (nothing if the file is missing)."""
+    table = schema_registry.table_for_file(filename)
+    if table is None:
+        path = os.path.join(DATA_DIR, filename)
+        if not os.path.exists(path):
+            logging.error(f"File not found: {path}")
+            return
+        with pd.read_csv(path, encoding=schema_registry.detect_encoding(path), usecols=usecols, chunksize=chunksize) as reader:
+            yield from reader
+        return
+    chunks = schema_registry.read_table(table, DATA_DIR, usecols=usecols, chunksize=chunksize)
+    if chunks is not None:
+        yield from chunks
 
 def clean_money_column(series):
     """Cleans money columns potentially having currency symbols."""
@@ -46,152 +92,217 @@ def clean_money_column(series):
         return series.astype(float)
     return series.astype(str).str.replace(r'[$,]', '', regex=True).astype(float)
 
-def send_alert(subject, body, image_path=None):
-    if not all([SMTP_SERVER, SMTP_USER, SMTP_PASSWORD, ALERT_RECEIVER]):
-        logging.warning("SMTP credentials missing. Skipping email alert.")
-        print(f"--- FAKE EMAIL ALERT ---\nSubject: {subject}\nBody: {body}\nChart Attached: {image_path}\n------------------------")
-        return
+def normalize_text(series):
+    """Lowercases/strips a text column; categoricals are normalized once per category, not per row."""
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return series.astype(str).str.lower().str.strip()
+    # Same result as astype(str): missing values become the 'nan' label
+    labels = series.cat.categories.astype(str).str.lower().str.strip().append(pd.Index(['nan']))
+    codes = series.cat.codes.to_numpy().copy()
+    codes[codes < 0] = len(labels) - 1
+    uniques, inverse = np.unique(labels.to_numpy(dtype=object), return_inverse=True)
+    return pd.Series(pd.Categorical.from_codes(inverse[codes], categories=uniques), index=series.index, name=series.name)
 
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = SMTP_USER
-        msg['To'] = ALERT_RECEIVER
-        msg['Subject'] = subject
-        
-        # Attach HTML body to support inline images if needed, but for now just plain text + attachment
-        msg.attach(MIMEText(body, 'plain'))
-
-        if image_path and os.path.exists(image_path):
-            with open(image_path, 'rb') as f:
-                img_data = f.read()
-                image = MIMEImage(img_data, name=os.path.basename(image_path))
-                msg.attach(image)
-            logging.info(f"Image attached: {image_path}")
-
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SMTP_USER, SMTP_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        logging.info(f"Alert sent: {subject}")
-    except Exception as e:
-        logging.error(f"Failed to send alert: {e}")
-
-def create_trend_chart(series, title, filename):
-    try:
-        plt.figure(figsize=(10, 6))
-        series.plot(kind='bar', color='#00f2ff', edgecolor='black')
-        plt.title(title, fontsize=14, fontweight='bold', color='black')
-        plt.ylabel('Volumen', fontsize=12)
-        plt.xlabel('Periodo (Mes)', fontsize=12)
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-        plt.tight_layout()
-        chart_path = os.path.join(os.getcwd(), filename)
-        plt.savefig(chart_path)
-        plt.close()
-        return chart_path
-    except Exception as e:
-        logging.error(f"Failed to create chart: {e}")
-        return None
+# Tax Aggregation: SAT impuesto codes (c_Impuesto) and the calc_* columns they feed
+TAX_CODES = {1: 'isr', 2: 'iva', 3: 'ieps'}
+CALC_TAX_COLUMNS = ['calc_traslados', 'calc_iva', 'calc_ieps', 'calc_retenciones', 'calc_ret_isr', 'calc_ret_iva']
 
-def main():
-    logging.info("Starting Migration Pipeline...")
+def tax_code_array(series):
+    """Maps impuesto codes (2, 2.0, '2', '002') to small ints (0 = unknown), parsing each distinct value once."""
+    codes, uniques = pd.factorize(series)
+    parsed = pd.to_numeric(pd.Series(uniques, dtype=object).astype(str).str.strip(), errors='coerce')
+    parsed = parsed.where(parsed.isin(list(TAX_CODES.keys())), 0).to_numpy(dtype='int64')
+    out = np.zeros(len(codes), dtype='int64')
+    valid = codes >= 0
+    out[valid] = parsed[codes[valid]]
+    return out
 
-    # 1. Load Data
-    cfdis = load_csv("cfdis.csv")
-    impuestos = load_csv("cfdi_comprobante_impuestos.csv")
-    traslados = load_csv("cfdi_comprobante_traslados.csv")
-    retenciones = load_csv("cfdi_comprobante_retenciones.csv")
-    receptors = load_csv("cfdi_receptors.csv")
-    emisors = load_csv("cfdi_emisors.csv")
+def aggregate_taxes(impuestos, traslados, retenciones):
+    """
+    Single-pass tax aggregation. Traslados and retenciones are located in impuestos and folded
+    into one (impuestos row x [tipo, impuesto]) matrix with a single np.bincount, from which every
+    calc_* column is derived. Returns a frame indexed by cfdi_id; sums are additive across partial inputs.
+    """
+    empty = pd.DataFrame(columns=CALC_TAX_COLUMNS, dtype=float, index=pd.Index([], name='cfdi_id'))
+    if impuestos is None or impuestos.empty:
+        return empty
 
-    if cfdis is None: 
-        logging.critical("CRITICAL: cfdis.csv missing. Aborting.")
+    imp_index = pd.Index(impuestos['id'].to_numpy())
+    imp_cfdi = impuestos['cfdi_id'].to_numpy()
+    if not imp_index.is_unique:
+        first = ~imp_index.duplicated()
+        imp_index, imp_cfdi = imp_index[first], imp_cfdi[first]
+    n_imp = len(imp_index)
+
+    # Slot layout: 0-3 traslados, 4-7 retenciones; offset = impuesto code (0 = other)
+    keys, slots, importes = [], [], []
+    for kind, frame in ((0, traslados), (1, retenciones)):
+        if frame is None or frame.empty:
+            continue
+        pos = imp_index.get_indexer(frame['cfdi_comprobante_impuestos_id'])
+        keep = pos >= 0
+        keys.append(pos[keep])
+        slots.append(kind * 4 + tax_code_array(frame['impuesto'])[keep])
+        importes.append(np.nan_to_num(frame['importe'].to_numpy(dtype=float)[keep]))
+
+    if not keys:
+        return empty
+
+    # One pass over every tax row: (impuestos row x slot) sums
+    matrix = np.bincount(
+        np.concatenate(keys) * 8 + np.concatenate(slots),
+        weights=np.concatenate(importes),
+        minlength=n_imp * 8
+    ).reshape(n_imp, 8)
+
+    taxes = pd.DataFrame({
+        'calc_traslados': matrix[:, 0:4].sum(axis=1),
+        'calc_iva': matrix[:, 2],
+        'calc_ieps': matrix[:, 3],
+        'calc_retenciones': matrix[:, 4:8].sum(axis=1),
+        'calc_ret_isr': matrix[:, 5],
+        'calc_ret_iva': matrix[:, 6]
+    }, index=pd.Index(imp_cfdi, name='cfdi_id'))
+
+    # Normally one impuestos row per CFDI; fold the rare multi-row case
+    if not taxes.index.is_unique:
+        taxes = taxes.groupby(level=0).sum()
+    return taxes
+
+def attach_taxes(cfdis, taxes):
+    """Attaches the aggregated calc_* columns to the CFDIs with a single join."""
+    cfdis = cfdis.drop(columns=CALC_TAX_COLUMNS, errors='ignore')
+    pos = taxes.index.get_indexer(cfdis['id'])
+    values = np.zeros((len(cfdis), len(CALC_TAX_COLUMNS)))
+    found = pos >= 0
+    values[found] = taxes[CALC_TAX_COLUMNS].to_numpy()[pos[found]]
+    return cfdis.assign(**{col: values[:, i] for i, col in enumerate(CALC_TAX_COLUMNS)})
+
+def watermark_column(cfdis):
+    """Returns the change-tracking column used for the watermark (updated_at, else created_at)."""
+    for col in ['updated_at', 'created_at']:
+        if col in cfdis.columns:
+            return col
+    return None
+
+def load_watermark(company_id, db=None):
+    """Loads the last ingested watermark for a tenant from Mongo or the local data dir."""
+    if db is not None:
+        doc = db[WATERMARK_COLLECTION].find_one({'company_id': company_id}, {'_id': 0})
+        return doc
+
+    path = os.path.join(DATA_DIR, f"watermark_{company_id}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_watermark(company_id, cfdis, db=None):
+    """
+    Persists the tenant watermark: the max change timestamp plus the xml_hash of the
+    CFDIs sitting exactly on that timestamp (so ties are not reprocessed or skipped).
+    """
+    col = watermark_column(cfdis)
+    if col is None or cfdis.empty:
         return
 
-    # 2. Data Cleaning & Pre-processing
-    logging.info("Cleaning Data...")
-    
+    ts = pd.to_datetime(cfdis[col], errors='coerce')
+    if ts.isna().all():
+        return
+    max_ts = ts.max()
+    boundary = cfdis.loc[ts == max_ts]
+    boundary_hashes = boundary['xml_hash'].dropna().astype(str).tolist() if 'xml_hash' in cfdis.columns else []
+
+    doc = {
+        'company_id': company_id,
+        'column': col,
+        'updated_at': max_ts.isoformat(),
+        'boundary_hashes': boundary_hashes,
+        'saved_at': pd.Timestamp.now().isoformat()
+    }
+
+    if db is not None:
+        db[WATERMARK_COLLECTION].update_one({'company_id': company_id}, {'$set': doc}, upsert=True)
+    else:
+        path = os.path.join(DATA_DIR, f"watermark_{company_id}.json")
+        with open(path, 'w') as f:
+            json.dump(doc, f)
+    logging.info(f"Watermark saved for {company_id}: {doc['updated_at']} ({len(boundary_hashes)} boundary hashes)")
+
+def filter_incremental(cfdis, watermark, include_uuids=None):
+    """
+    Keeps only CFDIs that are new or changed since the watermark, plus the ones whose uuid is in
+    `include_uuids` (invoices settled by a new payment complement).
+    """
+    col = watermark_column(cfdis)
+    if not watermark or col is None:
+        return cfdis
+
+    ts = pd.to_datetime(cfdis[col], errors='coerce')
+    wm_ts = pd.Timestamp(watermark['updated_at'])
+    newer = ts > wm_ts
+
+    # Rows on the boundary timestamp are only new if their xml_hash was not seen yet
+    on_boundary = ts == wm_ts
+    if 'xml_hash' in cfdis.columns:
+        seen = set(watermark.get('boundary_hashes', []))
+        on_boundary = on_boundary & ~cfdis['xml_hash'].astype(str).isin(seen)
+
+    # Rows without a parseable timestamp are always reprocessed
+    keep = newer | on_boundary | ts.isna()
+    if include_uuids:
+        keep |= payments.normalize_uuid(cfdis['uuid']).isin(include_uuids).fillna(False).to_numpy(dtype=bool)
+    return cfdis[keep]
+
+def filter_source_company(cfdis, source_company_id=SOURCE_COMPANY_ID):
+    """Keeps the rows of one company when several companies share the same CSV lake."""
+    if not source_company_id or 'company_id' not in cfdis.columns:
+        return cfdis
+    return cfdis[cfdis['company_id'].astype(str) == str(source_company_id)].copy()
+
+def filter_children(impuestos, traslados, retenciones, cfdi_ids):
+    """Restricts the tax tables to the rows that belong to the given CFDIs."""
+    if impuestos is None:
+        return impuestos, traslados, retenciones
+    impuestos = impuestos[impuestos['cfdi_id'].isin(cfdi_ids)]
+    if traslados is not None:
+        traslados = traslados[traslados['cfdi_comprobante_impuestos_id'].isin(impuestos['id'])]
+    if retenciones is not None:
+        retenciones = retenciones[retenciones['cfdi_comprobante_impuestos_id'].isin(impuestos['id'])]
+    return impuestos, traslados, retenciones
+
+def merge_local_gold(delta, output_file, company_id):
+    """Replaces the delta records inside the tenant's existing local gold file (incremental mode)."""
+    if not os.path.exists(output_file):
+        return delta
+    existing = gold_store.tenant_rows(pd.read_json(output_file, orient='records', dtype=False), company_id)
+    key = 'uuid' if 'uuid' in delta.columns and 'uuid' in existing.columns else 'id'
+    existing = existing[~existing[key].isin(delta[key])]
+    return pd.concat([existing, delta], ignore_index=True)
+
+def clean_cfdis(cfdis):
+    """Normalizes text columns and casts money columns."""
     # Normalize text columns
     text_cols = ['tipo', 'moneda', 'forma_pago', 'metodo_pago', 'estatus']
     for col in text_cols:
         if col in cfdis.columns:
-            cfdis[col] = cfdis[col].astype(str).str.lower().str.strip()
+            cfdis[col] = normalize_text(cfdis[col])
 
     # Cast Money Columns
     money_cols = ['subtotal', 'descuento', 'total']
     for col in money_cols:
         if col in cfdis.columns:
             cfdis[col] = clean_money_column(cfdis[col])
-            
-    # Clean Taxes Money Columns
-    if traslados is not None:
-        traslados['importe'] = clean_money_column(traslados['importe'])
-    if retenciones is not None:
-        retenciones['importe'] = clean_money_column(retenciones['importe'])
-
-    # 3. Calculate Taxes Aggregates per CFDI
-    # Logic: cfdis.id -> impuestos.cfdi_id (impuestos.id) -> traslados/retenciones.cfdi_comprobante_impuestos_id
-    
-    cfdi_taxes = pd.DataFrame({'cfdi_id': cfdis['id'].unique()})
-    
-    if impuestos is not None and traslados is not None:
-        # Traslados Aggregate
-        # Join traslados with impuestos to get cfdi_id
-        traslados_merged = traslados.merge(
-            impuestos[['id', 'cfdi_id']], 
-            left_on='cfdi_comprobante_impuestos_id', 
-            right_on='id', 
-            suffixes=('_tras', '_imp')
-        )
-        
-        # Calculate Total Traslados per CFDI
-        total_traslados = traslados_merged.groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_traslados'})
-        cfdis = cfdis.merge(total_traslados, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_traslados': 0})
-        
-        # Calculate IVA vs IEPS
-        iva_tras = traslados_merged[traslados_merged['impuesto'].astype(str).str.contains('002', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_iva'})
-        ieps_tras = traslados_merged[traslados_merged['impuesto'].astype(str).str.contains('003', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ieps'})
-        
-        cfdis = cfdis.merge(iva_tras, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_iva': 0})
-        cfdis = cfdis.merge(ieps_tras, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ieps': 0})
-
-    else:
-        cfdis['calc_traslados'] = 0
-        cfdis['calc_iva'] = 0
-        cfdis['calc_ieps'] = 0
-
-    if impuestos is not None and retenciones is not None:
-        # Retenciones Aggregate
-        retenciones_merged = retenciones.merge(
-            impuestos[['id', 'cfdi_id']],
-            left_on='cfdi_comprobante_impuestos_id',
-            right_on='id',
-            suffixes=('_ret', '_imp')
-        )
-        
-        total_retenciones = retenciones_merged.groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_retenciones'})
-        cfdis = cfdis.merge(total_retenciones, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_retenciones': 0})
-        
-        # ISR vs IVA Ret
-        isr_ret = retenciones_merged[retenciones_merged['impuesto'].astype(str).str.contains('001', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ret_isr'})
-        iva_ret = retenciones_merged[retenciones_merged['impuesto'].astype(str).str.contains('002', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ret_iva'})
-        
-        cfdis = cfdis.merge(isr_ret, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ret_isr': 0})
-        cfdis = cfdis.merge(iva_ret, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ret_iva': 0})
-
-    else:
-        cfdis['calc_retenciones'] = 0
-        cfdis['calc_ret_isr'] = 0
-        cfdis['calc_ret_iva'] = 0
+    return cfdis
 
-    # --- NEW: Inject Company ID for Multi-tenancy ---
-    # Default to a value from ENV or argument
-    COMPANY_ID = os.getenv("COMPANY_ID", "DEFAULT_TENANT")
-    cfdis['company_id'] = COMPANY_ID
-    logging.info(f"Targeting Company ID: {COMPANY_ID}")
+def clean_tax_table(taxes):
+    """Casts the importe column of a traslados/retenciones table."""
+    if taxes is not None:
+        taxes['importe'] = clean_money_column(taxes['importe'])
+    return taxes
 
-    # 4. Enrich with Names
+def enrich_names(cfdis, receptors, emisors):
+    """Joins receptor/emisor names and the emisor RFC from the catalogs."""
     if receptors is not None:
         # Assuming 'receptor_id' in cfdis maps to 'id' in receptors
         # Check column names in receptors. usually id, nombre/razon_social
@@ -210,115 +321,816 @@ def main():
         
         emisors_clean = emisors[cols_to_keep].rename(columns={name_col: 'emisor_nombre', rfc_col: 'emisor_rfc'})
         cfdis = cfdis.merge(emisors_clean, left_on='emisor_id', right_on='id', how='left', suffixes=('', '_emi'))
+    return cfdis
 
-    # 5. Financial Calculations
+def compute_financials(cfdis):
     # Formula: $Neto = [Subtotal + Traslados] - [Retenciones + Descuentos]$
     cfdis['ventas_brutas'] = cfdis['subtotal']
     cfdis['ventas_netas'] = (cfdis['subtotal'] + cfdis['calc_traslados']) - (cfdis['calc_retenciones'] + cfdis['descuento'])
-    
-    logging.info(f"Processed {len(cfdis)} records.")
-    
-    # 6. Forensics & Alerts
-    alerts = []
-    
-    # Check for Duplicates (Tríada: RFC + Monto + Fecha)
-    # Using 'emisor_id' (proxy for RFC if RFC missing) or 'emisor_rfc'
+    return cfdis
+
+def triad_columns(cfdis):
+    """Duplicate 'Tríada' key: Monto + Fecha + RFC (emisor_id as proxy if RFC missing)."""
     group_cols = ['total', 'fecha_emision']
     if 'emisor_rfc' in cfdis.columns:
         group_cols.append('emisor_rfc')
     else:
         group_cols.append('emisor_id')
-        
-    duplicates = cfdis[cfdis.duplicated(subset=group_cols, keep=False)]
-    if not duplicates.empty:
-        alert_msg = f"Posibles Duplicados Detectados:\n{duplicates[group_cols].head(10).to_string()}"
-        alerts.append(alert_msg)
-        cfdis['is_duplicate'] = cfdis.duplicated(subset=group_cols, keep=False)
+    return group_cols
+
+def add_period_columns(cfdis):
+    """Native fecha_emision plus the derived dashboard columns (gold_store.derive_columns) and month_year."""
+    cfdis = gold_store.derive_columns(cfdis)
+    cfdis['month_year'] = cfdis['fecha_emision'].dt.to_period('M')
+    return cfdis
+
+def dispatch_alerts(alerts, chart_to_send):
+    """Queues the alerts in the outbox; delivery (chart rendering, SMTP) happens in the alert worker."""
+    if alerts:
+        try:
+            alert_outbox.enqueue("Alertas Forenses CFDI", "\n\n".join(alerts), chart=chart_to_send)
+        except Exception as e:
+            logging.error(f"Failed to queue alert: {e}")
+
+def month_set(cfdis):
+    """YYYY-MM months of the rows with a valid fecha_emision."""
+    months = gold_store.month_keys(cfdis)
+    return set(months[months != gold_store.UNKNOWN_MONTH])
+
+def published_months(company_id, uuids, db=None):
+    """Months holding the currently published versions of `uuids` (their rollup rows go stale when they change)."""
+    keys = pd.Series(uuids).astype(str).unique().tolist()
+    if db is not None:
+        docs = []
+        chunk = UPSERT_BATCH_SIZE * 10
+        for start in range(0, len(keys), chunk):
+            docs.extend(db[COLLECTION_NAME].find({'uuid': {'$in': keys[start:start + chunk]}}, {'fecha_emision': 1, '_id': 0}))
+        published = pd.DataFrame(docs, columns=['fecha_emision'])
+    elif GOLD_FORMAT == 'parquet':
+        published = gold_store.read_tenant(GOLD_DIR, company_id, columns=['uuid', 'fecha_emision'])
+        if published is not None:
+            published = published[published['uuid'].astype(str).isin(keys)]
     else:
-        cfdis['is_duplicate'] = False
+        output_file = gold_store.json_path(DATA_DIR, company_id)
+        published = None
+        if os.path.exists(output_file):
+            published = gold_store.tenant_rows(pd.read_json(output_file, orient='records', dtype=False), company_id)
+            published = published[published['uuid'].astype(str).isin(keys)]
+    return month_set(published) if published is not None and not published.empty else set()
 
-    # Check Retention Spike > 20% vs previous month
-    # Convert date
-    cfdis['fecha_dt'] = pd.to_datetime(cfdis['fecha_emision'], errors='coerce')
-    cfdis['month_year'] = cfdis['fecha_dt'].dt.to_period('M')
-    
-    monthly_ret = cfdis.groupby('month_year')['calc_retenciones'].sum().sort_index()
-    monthly_pct_change = monthly_ret.pct_change()
+def published_rows(company_id, months, db=None):
+    """The tenant's published gold rows for `months`, limited to the columns the rollup needs."""
+    if db is not None:
+        projection = dict({col: 1 for col in rollups.SOURCE_COLUMNS}, _id=0)
+        docs = list(db[COLLECTION_NAME].find({'company_id': company_id, 'month_year': {'$in': months}}, projection))
+        return pd.DataFrame(docs)
+    if GOLD_FORMAT == 'parquet':
+        return gold_store.read_tenant(GOLD_DIR, company_id, columns=rollups.SOURCE_COLUMNS, months=months)
+    output_file = gold_store.json_path(DATA_DIR, company_id)
+    if not os.path.exists(output_file):
+        return None
+    gold = gold_store.tenant_rows(pd.read_json(output_file, orient='records', dtype=False), company_id)
+    return gold[gold_store.month_keys(gold).isin(months)]
+
+def flag_partners(company_id, partners, db=None, stage=None, part=0):
+    """
+    Re-publishes the published CFDIs an incremental batch matched (forensics.partner_frame) with their
+    duplicate flags set, as a full rebuild would flag them: Mongo updates them in place; the Parquet
+    gold stages them next to the batch (read from the months they were indexed in), so the publish
+    replaces their previous copies. Returns True if any record changed.
+    """
+    if partners is None or partners.empty:
+        return False
+    if db is not None:
+        changed = 0
+        chunk = UPSERT_BATCH_SIZE * 10
+        for flag in forensics.PARTNER_FLAGS:
+            uuids = partners.loc[partners[flag], 'uuid'].tolist()
+            for start in range(0, len(uuids), chunk):
+                query = {'company_id': company_id, 'uuid': {'$in': uuids[start:start + chunk]}, flag: {'$ne': True}}
+                changed += db[COLLECTION_NAME].update_many(query, {'$set': {flag: True}}).modified_count
+    else:
+        fecha_s = pd.to_numeric(partners['fecha_s'], errors='coerce')
+        months = pd.to_datetime(fecha_s.where(fecha_s >= 0), unit='s').dt.strftime('%Y-%m').fillna(gold_store.UNKNOWN_MONTH)
+        published = gold_store.read_tenant(GOLD_DIR, company_id, months=months.unique().tolist())
+        if published is None:
+            return False
+        published = published[published['uuid'].astype(str).isin(partners['uuid'])].copy()
+        if not gold_store.is_derived(published):
+            published = gold_store.derive_columns(published)
+        published, flagged = forensics.mark_partners(published, partners)
+        if flagged.any():
+            gold_store.write_parts(published[flagged], stage, part=part)
+        changed = int(flagged.sum())
+    logging.info(f"Duplicate partners: {changed} published CFDIs re-flagged")
+    return changed > 0
+
+def update_rollup(company_id, rollup, db=None, months=None):
+    """
+    Stores the tenant's monthly rollup. Full runs store `rollup` as built; incremental runs
+    rebuild the touched `months` from the published gold (other months are left as they are).
+    """
+    if months is not None:
+        months = sorted(months)
+        rollup = rollups.build(published_rows(company_id, months, db)) if months else rollups.empty_rollup()
+    rollups.save(company_id, rollup, db, months=months)
+
+def update_payroll(company_id, rows, db=None, periods=None):
+    """Stores the tenant's payroll rows (only the rebuilt `periods` on incremental runs; nothing if none changed)."""
+    if periods is None or periods:
+        payroll.save(company_id, rows, db, periods=periods)
+
+def content_hashes(cfdis):
+    """Stable per-record content hash (hex) over every gold column."""
+    values = cfdis[sorted(cfdis.columns)]
+    return pd.Series(pd.util.hash_pandas_object(values, index=False).to_numpy(), index=cfdis.index).map('{:016x}'.format)
+
+def stored_hashes(collection, unique_field, keys, chunk=UPSERT_BATCH_SIZE * 10):
+    """Fetches {key: content hash} for the keys already present in the collection."""
+    found = {}
+    for start in range(0, len(keys), chunk):
+        cursor = collection.find({unique_field: {'$in': keys[start:start + chunk]}}, {unique_field: 1, HASH_FIELD: 1, '_id': 0})
+        for doc in cursor:
+            found[doc[unique_field]] = doc.get(HASH_FIELD)
+    return found
+
+def write_batch(collection, operations):
+    """Runs one unordered bulk_write; returns (result, latency seconds)."""
+    start = time.perf_counter()
+    result = collection.bulk_write(operations, ordered=False)
+    return result, time.perf_counter() - start
+
+def upsert_gold(collection, cfdis, batch_size=UPSERT_BATCH_SIZE, workers=UPSERT_WORKERS):
+    """
+    Upserts the gold records into Mongo keyed by uuid (or id).
+    Records whose content hash matches the stored one are skipped; the rest are sent as
+    unordered batches of `batch_size`, `workers` batches at a time over the shared client.
+    """
+    # For simplicity, we define 'uuid' as unique index if it exists, else 'id'
+    unique_field = 'uuid' if 'uuid' in cfdis.columns else 'id'
     
-    # Check latest month
-    if not monthly_pct_change.empty:
-        latest_change = monthly_pct_change.iloc[-1]
-        if latest_change > 0.20:
-            alerts.append(f"Incremento Atípico de Retenciones: {latest_change:.1%} de aumento en {monthly_ret.index[-1]}")
-
-    # --- NEW: Check Cancelled CFDI Spike > 20% vs previous month ---
-    chart_to_send = None
-    if 'estatus' in cfdis.columns:
-        cancelled_mask = cfdis['estatus'].astype(str).str.lower().str.contains('cancel', na=False)
-        monthly_cancelled = cfdis[cancelled_mask].groupby('month_year').size().sort_index()
-        
-        if not monthly_cancelled.empty:
-            cancelled_pct_change = monthly_cancelled.pct_change()
-            if not cancelled_pct_change.empty:
-                latest_cancel_change = cancelled_pct_change.iloc[-1]
-                if latest_cancel_change > 0.20:
-                    alerts.append(f"Incremento Atípico de Cancelaciones: {latest_cancel_change:.1%} de aumento en {monthly_cancelled.index[-1]}")
-                    # Create chart for cancellation trend
-                    chart_to_send = create_trend_chart(monthly_cancelled, "Tendencia de Facturas Canceladas", "alerta_cancelaciones.png")
-
-    # Send Alerts
-    if alerts:
-        send_alert("Alertas Forenses CFDI", "\n\n".join(alerts), image_path=chart_to_send)
-        if chart_to_send and os.path.exists(chart_to_send):
+    # Create Unique Index to prevent duplicates
+    collection.create_index([(unique_field, pymongo.ASCENDING)], unique=True)
+
+    # Periods are not BSON-encodable
+    cfdis = cfdis.copy()
+    for col in cfdis.columns:
+        if isinstance(cfdis[col].dtype, pd.PeriodDtype):
+            cfdis[col] = cfdis[col].astype(str)
+
+    # 1. Change detection against the stored hashes
+    hashes = content_hashes(cfdis)
+    keys = cfdis[unique_field].tolist()
+    stored = stored_hashes(collection, unique_field, keys)
+    changed = np.array([stored.get(k) != h for k, h in zip(keys, hashes)], dtype=bool)
+    skipped = int((~changed).sum())
+    cfdis = cfdis[changed].assign(**{HASH_FIELD: hashes[changed]})
+
+    if cfdis.empty:
+        logging.info(f"MongoDB Write: nothing to do ({skipped} records unchanged).")
+        return {'upserted': 0, 'modified': 0, 'skipped': skipped, 'batches': 0}
+
+    # 2. Build operations for the changed records only
+    operations = []
+    for record in cfdis.to_dict(orient='records'):
+        # NaN fields are removed so Mongo does not keep stale values
+        clean_record = {k: v for k, v in record.items() if pd.notnull(v)}
+        update = {'$set': clean_record}
+        missing = {k: '' for k in record if k not in clean_record}
+        if missing:
+            update['$unset'] = missing
+        operations.append(pymongo.UpdateOne({unique_field: clean_record[unique_field]}, update, upsert=True))
+    batches = [operations[i:i + batch_size] for i in range(0, len(operations), batch_size)]
+
+    # 3. Parallel unordered batches
+    stats = {'upserted': 0, 'modified': 0, 'skipped': skipped, 'batches': len(batches)}
+    errors = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(write_batch, collection, batch) for batch in batches]
+        for n, (future, batch) in enumerate(zip(futures, batches), start=1):
             try:
-                os.remove(chart_to_send)
-            except:
-                pass
+                result, latency = future.result()
+            except Exception as e:
+                logging.error(f"MongoDB batch {n}/{len(batches)} failed: {e}")
+                errors.append(e)
+                continue
+            stats['upserted'] += result.upserted_count
+            stats['modified'] += result.modified_count
+            logging.info(f"MongoDB batch {n}/{len(batches)}: {len(batch)} ops in {latency * 1000:.0f} ms ({len(batch) / max(latency, 1e-9):,.0f} docs/s)")
+    elapsed = time.perf_counter() - start
+
+    logging.info(f"MongoDB Write: {stats['upserted']} upserted, {stats['modified']} modified, {skipped} unchanged skipped "
+                 f"({len(operations)} ops in {elapsed:.2f} s, {len(operations) / max(elapsed, 1e-9):,.0f} docs/s).")
+    if errors:
+        raise errors[0]
+    return stats
+
+def stream_bucket_count(filenames):
+    """Number of hash partitions so that each bucket holds roughly STREAM_BUCKET_MB of CSV."""
+    total_bytes = sum(os.path.getsize(os.path.join(DATA_DIR, f)) for f in filenames if os.path.exists(os.path.join(DATA_DIR, f)))
+    return max(1, math.ceil(total_bytes / (STREAM_BUCKET_MB * 1024 * 1024)))
+
+def spill_partitions(frame, key, n_buckets, spill_dir, table, part):
+    """Writes the rows of `frame` to on-disk hash partitions (key % n_buckets)."""
+    os.makedirs(os.path.join(spill_dir, table), exist_ok=True)
+    buckets = pd.to_numeric(frame[key], errors='coerce').fillna(-1).astype('int64') % n_buckets
+    for bucket, rows in frame.groupby(buckets.to_numpy(), sort=False):
+        rows.to_pickle(os.path.join(spill_dir, table, f"{bucket:05d}_{part:06d}.pkl"))
+
+def read_partition(spill_dir, table, bucket):
+    """Reads every spilled piece of one hash partition (None if the bucket is empty)."""
+    pieces = sorted(glob.glob(os.path.join(spill_dir, table, f"{bucket:05d}_*.pkl")))
+    if not pieces:
+        return None
+    return pd.concat([pd.read_pickle(p) for p in pieces], ignore_index=True)
+
+def run_streaming(company_id, db=None, incremental=False, chunksize=CHUNK_SIZE):
+    """
+    Bounded-memory variant of main() for very large tenants (grace hash join):
+      1. cfdis, impuestos, traslados and retenciones are read in chunks and spilled to
+         on-disk hash partitions (CFDIs by id, tax tables by impuestos id).
+      2. Each tax partition is folded with aggregate_taxes and re-spilled by cfdi_id.
+      3. Each CFDI partition is joined with its partial tax sums, enriched and emitted
+         to Mongo or the local gold file, while the forensic accumulators are updated.
+    Peak memory is bounded by one partition; only an 8-byte triad hash per CFDI, the
+    monthly accumulators and the payment index (one row per paid invoice) are kept for the whole run.
+    """
+    tax_files = ["cfdis.csv", "cfdi_comprobante_impuestos.csv", "cfdi_comprobante_traslados.csv", "cfdi_comprobante_retenciones.csv"]
+    if not os.path.exists(os.path.join(DATA_DIR, "cfdis.csv")):
+        logging.critical("CRITICAL: cfdis.csv missing. Aborting.")
+        return False
+
+    # Catalogs are small and needed whole for the name/RFC joins
+    receptors = load_csv("cfdi_receptors.csv")
+    emisors = load_csv("cfdi_emisors.csv")
+    emisor_rfc = None
+    if emisors is not None:
+        rfc_col = next((c for c in emisors.columns if 'rfc' in c.lower()), None)
+        if rfc_col:
+            emisor_rfc = emisors.set_index('id')[rfc_col]
+
+    n_buckets = stream_bucket_count(tax_files)
+    watermark = load_watermark(company_id, db) if incremental else None
+    logging.info(f"Streaming ingestion: {n_buckets} partitions, chunks of {chunksize:,} rows")
+
+    # Narrow pass over cfdis.csv: the tenant's payment and nómina CFDIs over its whole history and,
+    # incrementally, the ones in the delta (their invoices / payroll periods are refreshed)
+    status_cols = ['id', 'company_id', 'uuid', 'tipo', 'cancelado', 'estatus', 'receptor_id', 'fecha_emision', 'created_at', 'updated_at', 'xml_hash']
+    status_parts, delta_parts = [], []
+    for chunk in iter_csv("cfdis.csv", chunksize, usecols=status_cols):
+        chunk = filter_source_company(chunk)
+        chunk = chunk[chunk['tipo'].astype(str).str.upper().isin(['P', 'N'])]
+        status_parts.append(chunk)
+        if incremental:
+            delta_parts.append(filter_incremental(chunk, watermark))
+    status = pd.concat(status_parts, ignore_index=True) if status_parts else None
+    delta_status = pd.concat(delta_parts, ignore_index=True) if delta_parts else None
+
+    documents = payments.load_documents(DATA_DIR)
+    payment_index = payments.reconcile(documents, payments.payment_cfdi_ids(status))
+    settled = payments.referenced_uuids(documents, payments.payment_cfdi_ids(delta_status, include_cancelled=True))
+    touched_nominas = payroll.nomina_cfdis(delta_status, include_cancelled=True)['id'].to_numpy() if incremental else None
+    payroll_rows, payroll_periods = payroll.build(payroll.nomina_cfdis(status), receptors, DATA_DIR, touched_ids=touched_nominas)
+    del status_parts, delta_parts, status, delta_status, documents
+
+    with tempfile.TemporaryDirectory(prefix="cfdi_stream_", dir=SPILL_DIR) as spill_dir:
+        # 1. Partition CFDIs (after cleaning) and the tax tables
+        triad_hashes = []
+        wm_rows = None
+        total_rows = 0
+        delta_rows = 0
+        for part, chunk in enumerate(iter_csv("cfdis.csv", chunksize)):
+            chunk = filter_source_company(chunk)
+            total_rows += len(chunk)
+            if incremental:
+                chunk = filter_incremental(chunk, watermark, include_uuids=settled)
+            if chunk.empty:
+                continue
+            chunk = clean_cfdis(chunk.copy())
+            delta_rows += len(chunk)
+
+            # Triad hash computed up front so duplicates are known before emitting
+            triad = forensics.triad_frame(chunk, emisor_rfc)
+            chunk['_triad'] = triad['triad'].to_numpy()
+            triad_hashes.append(chunk['_triad'].to_numpy())
+            triad.to_pickle(os.path.join(spill_dir, f"triad_{part:06d}.pkl"))
+
+            # Keep only the rows on the running max timestamp for the watermark
+            col = watermark_column(chunk)
+            if col:
+                keep = [c for c in [col, 'xml_hash'] if c in chunk.columns]
+                candidates = chunk[keep] if wm_rows is None else pd.concat([wm_rows, chunk[keep]])
+                ts = pd.to_datetime(candidates[col], errors='coerce')
+                wm_rows = candidates[ts == ts.max()]
+
+            spill_partitions(chunk, 'id', n_buckets, spill_dir, 'cfdis', part)
+
+        if incremental:
+            logging.info(f"Incremental delta: {delta_rows} of {total_rows} CFDIs changed since {watermark['updated_at'] if watermark else 'beginning'}")
+        if delta_rows == 0:
+            logging.info("No new or changed CFDIs. Nothing to do.")
+            return True
+
+        for part, chunk in enumerate(iter_csv("cfdi_comprobante_impuestos.csv", chunksize)):
+            spill_partitions(chunk[['id', 'cfdi_id']], 'id', n_buckets, spill_dir, 'impuestos', part)
+        for table, filename in (('traslados', "cfdi_comprobante_traslados.csv"), ('retenciones', "cfdi_comprobante_retenciones.csv")):
+            for part, chunk in enumerate(iter_csv(filename, chunksize)):
+                chunk = clean_tax_table(chunk[['cfdi_comprobante_impuestos_id', 'impuesto', 'importe']].copy())
+                spill_partitions(chunk, 'cfdi_comprobante_impuestos_id', n_buckets, spill_dir, table, part)
+
+        # Concept tax lines, partitioned by cfdi_id: conceptos directly, tax rows through the
+        # concepto_impuestos -> concepto -> cfdi id maps (two int columns per row held in memory)
+        owners = [c[['id', 'cfdi_concepto_id']] for c in iter_csv("cfdi_concepto_impuestos.csv", chunksize)]
+        owners = pd.concat(owners, ignore_index=True) if owners else None
+        concepto_cfdi = []
+        for part, chunk in enumerate(iter_csv("cfdi_conceptos.csv", chunksize, usecols=['id', 'cfdi_id', 'clave_prod_serv'])):
+            concepto_cfdi.append(chunk[['id', 'cfdi_id']])
+            spill_partitions(chunk, 'cfdi_id', n_buckets, spill_dir, 'conceptos', part)
+        concepto_cfdi = pd.concat(concepto_cfdi).drop_duplicates('id').set_index('id')['cfdi_id'] if concepto_cfdi else None
+        if owners is not None and concepto_cfdi is not None:
+            for table, filename in (('concepto_traslados', "cfdi_concepto_traslados.csv"), ('concepto_retenciones', "cfdi_concepto_retenciones.csv")):
+                for part, chunk in enumerate(iter_csv(filename, chunksize)):
+                    rows = concept_taxes.tax_rows(owners, *((chunk, None) if table == 'concepto_traslados' else (None, chunk)))
+                    pos = concepto_cfdi.index.get_indexer(rows['concepto_id'])
+                    rows = rows[pos >= 0].assign(cfdi_id=concepto_cfdi.to_numpy()[pos[pos >= 0]])
+                    spill_partitions(rows, 'cfdi_id', n_buckets, spill_dir, table, part)
+        del owners, concepto_cfdi
+
+        # 2. Fold partial tax aggregates per partition, re-partitioned by cfdi_id
+        for bucket in range(n_buckets):
+            impuestos = read_partition(spill_dir, 'impuestos', bucket)
+            traslados = read_partition(spill_dir, 'traslados', bucket)
+            retenciones = read_partition(spill_dir, 'retenciones', bucket)
+            taxes = aggregate_taxes(impuestos, traslados, retenciones)
+            if not taxes.empty:
+                spill_partitions(taxes.reset_index(), 'cfdi_id', n_buckets, spill_dir, 'taxes', bucket)
+
+        hashes, counts = np.unique(np.concatenate(triad_hashes), return_counts=True)
+        duplicate_hashes = hashes[counts > 1]
+        partners = None
+        if incremental:
+            # Delta triads that already exist in the tenant's index (other CFDIs)
+            triad_files = sorted(glob.glob(os.path.join(spill_dir, "triad_*.pkl")))
+            delta_uuids = pd.concat([pd.read_pickle(f)['uuid'] for f in triad_files], ignore_index=True)
+            known = forensics.known_triads(company_id, hashes, delta_uuids)
+            duplicate_hashes = np.union1d(duplicate_hashes, known['triad'].to_numpy(dtype='uint64'))
+            partners = forensics.partner_frame(known)
+            # Months whose rollup rows hold the previous versions (looked up before anything is loaded)
+            touched_months = published_months(company_id, delta_uuids, db)
+            del delta_uuids, known
+        del triad_hashes, hashes, counts
+
+        # 3. Join, enrich and emit each CFDI partition
+        output_file = gold_store.json_path(DATA_DIR, company_id)
+        stream_file = output_file + ".partial" if (db is None and incremental) else output_file
+        sink = None
+        stage = None
+        if db is None and GOLD_FORMAT == 'parquet':
+            stage = gold_store.staging_dir(GOLD_DIR, company_id)
+        elif db is None:
+            sink = open(stream_file, 'w')
+            sink.write('[')
+        wrote_any = False
+        monthly_parts = []
+        rollup_parts = []
+        duplicate_examples = []
+        processed = 0
+        written = db is None  # Mongo runs only count the records that actually changed
+
+        try:
+            for bucket in range(n_buckets):
+                cfdis = read_partition(spill_dir, 'cfdis', bucket)
+                if cfdis is None:
+                    continue
+                taxes = read_partition(spill_dir, 'taxes', bucket)
+                if taxes is None:
+                    taxes = pd.DataFrame(columns=['cfdi_id'] + CALC_TAX_COLUMNS)
+                taxes = taxes.groupby('cfdi_id')[CALC_TAX_COLUMNS].sum()
+
+                cfdis = attach_taxes(cfdis.sort_values('id'), taxes)
+                line_taxes = [read_partition(spill_dir, t, bucket) for t in ('concepto_traslados', 'concepto_retenciones')]
+                line_taxes = pd.concat([t for t in line_taxes if t is not None] or [pd.DataFrame(columns=concept_taxes.TAX_ROW_COLUMNS)], ignore_index=True)
+                lines = concept_taxes.build_lines(read_partition(spill_dir, 'conceptos', bucket), line_taxes, cfdis)
+                cfdis = concept_taxes.attach_rate_mix(cfdis, concept_taxes.rate_mix(lines))
+                lines.to_pickle(os.path.join(spill_dir, f"lines_{bucket:05d}.pkl"))
+                cfdis['company_id'] = company_id
+                cfdis = enrich_names(cfdis, receptors, emisors)
+                cfdis = compute_financials(cfdis)
+                cfdis = payments.attach_payments(cfdis, payment_index)
+
+                cfdis['is_duplicate'] = np.isin(cfdis.pop('_triad').to_numpy(), duplicate_hashes)
+                if cfdis['is_duplicate'].any() and len(duplicate_examples) < 10:
+                    duplicate_examples.append(cfdis.loc[cfdis['is_duplicate'], triad_columns(cfdis)].head(10))
+
+                cfdis = add_period_columns(cfdis)
+                monthly_parts.append(forensics.monthly_metrics(cfdis))
+                if incremental:
+                    touched_months |= month_set(cfdis)
+                else:
+                    rollup_parts.append(rollups.build(cfdis))
+
+                if stage is not None:
+                    gold_store.write_parts(cfdis, stage, part=bucket)
+                elif db is None:
+                    cfdis['month_year'] = cfdis['month_year'].astype(str)
+                    body = cfdis.to_json(orient='records', date_format='iso')[1:-1]
+                    if body:
+                        sink.write((',' if wrote_any else '') + body)
+                        wrote_any = True
+                else:
+                    stats = upsert_gold(db[COLLECTION_NAME], cfdis)
+                    written = written or stats['upserted'] + stats['modified'] > 0
+                processed += len(cfdis)
+            if db is not None:
+                written = flag_partners(company_id, partners, db) or written
+        except Exception:
+            if stage is not None:
+                gold_store.discard(stage)
+            raise
+        finally:
+            if sink is not None:
+                sink.write(']')
+                sink.close()
+
+        if db is not None:
+            gold_store.ensure_indexes(db[COLLECTION_NAME])
+
+        # Persist the triad index from the spilled per-chunk triads (one part per chunk)
+        triad_files = sorted(glob.glob(os.path.join(spill_dir, "triad_*.pkl")))
+        forensics.save_index(company_id, (pd.read_pickle(f) for f in triad_files), replace=not incremental)
+
+        # Concept tax lines of every emitted partition (incremental runs replace the delta's CFDIs)
+        replace_uuids = set(pd.concat([pd.read_pickle(f)['uuid'] for f in triad_files], ignore_index=True)) if incremental else None
+        line_files = sorted(glob.glob(os.path.join(spill_dir, "lines_*.pkl")))
+        concept_taxes.save(company_id, (pd.read_pickle(f) for f in line_files), db, replace_uuids=replace_uuids)
+
+    logging.info(f"Processed {processed} records.")
+
+    # 4. Forensics & Alerts from the streamed accumulators
+    alerts = []
+    if duplicate_examples:
+        examples = pd.concat(duplicate_examples).head(10)
+        alerts.append(f"Posibles Duplicados Detectados:\n{examples.to_string()}")
+    spike_alerts, chart_to_send = forensics.spike_alerts(forensics.combine_metrics(monthly_parts))
+    alerts.extend(spike_alerts)
+    dispatch_alerts(alerts, chart_to_send)
+
+    if stage is not None:
+        flag_partners(company_id, partners, stage=stage, part=n_buckets)
+        gold_store.publish(stage, GOLD_DIR, company_id, incremental=incremental)
+        logging.info(f"Gold partitions published to {gold_store.tenant_dir(GOLD_DIR, company_id)}")
+    elif db is None:
+        if stream_file != output_file:
+            merged = merge_local_gold(pd.read_json(stream_file, orient='records', dtype=False), output_file, company_id)
+            if partners is not None and not partners.empty:
+                merged, _ = forensics.mark_partners(merged, partners)
+            merged.to_json(output_file, orient='records', date_format='iso')
+            os.remove(stream_file)
+        logging.info(f"Data saved locally to {output_file}")
+    update_rollup(company_id, rollups.combine(rollup_parts), db, months=touched_months if incremental else None)
+    update_payroll(company_id, payroll_rows, db, payroll_periods)
+    if wm_rows is not None:
+        save_watermark(company_id, wm_rows, db)
+    if written:
+        dataset_cache.save_version(company_id, db, data_dir=DATA_DIR)
+    else:
+        logging.info("Gold records unchanged: data version kept.")
+    return True
+
+# --- Pipeline Stages ---
+# Each stage takes the pipeline state dict and returns it updated. States are checkpointed
+# to CHECKPOINT_DIR/<company_id>/ so a failed run can resume from the last good stage and
+# a single stage (e.g. alerts) can be re-run without recomputing the joins.
+
+def stage_extract(state, db=None):
+    """Reads the lake tables; in incremental mode keeps only the delta and its tax rows."""
+    cfdis = load_csv("cfdis.csv")
+    if cfdis is None:
+        logging.critical("CRITICAL: cfdis.csv missing. Aborting.")
+        raise FileNotFoundError(os.path.join(DATA_DIR, "cfdis.csv"))
+    impuestos = load_csv("cfdi_comprobante_impuestos.csv")
+    traslados = load_csv("cfdi_comprobante_traslados.csv")
+    retenciones = load_csv("cfdi_comprobante_retenciones.csv")
+    conceptos = load_csv("cfdi_conceptos.csv", usecols=['id', 'cfdi_id', 'clave_prod_serv'])
+    concepto_impuestos = load_csv("cfdi_concepto_impuestos.csv")
+
+    cfdis = filter_source_company(cfdis)
+    if cfdis.empty:
+        logging.warning(f"No CFDIs found for source company {SOURCE_COMPANY_ID}. Nothing to do.")
+        return dict(state, done=True)
+
+    # Payment complements and nóminas are taken from the whole tenant history, not just the delta
+    documents = payments.load_documents(DATA_DIR)
+    payment_ids = payments.payment_cfdi_ids(cfdis)
+    nomina_cfdis = payroll.nomina_cfdis(cfdis)
+    touched_nominas = None
+
+    # Incremental Mode: keep only new/changed CFDIs (and the invoices their payments settle) and their tax rows
+    if state['incremental']:
+        watermark = load_watermark(state['company_id'], db)
+        total_rows = len(cfdis)
+        delta = filter_incremental(cfdis, watermark)
+        settled = payments.referenced_uuids(documents, payments.payment_cfdi_ids(delta, include_cancelled=True))
+        touched_nominas = payroll.nomina_cfdis(delta, include_cancelled=True)['id'].to_numpy()
+        cfdis = filter_incremental(cfdis, watermark, include_uuids=settled) if settled else delta
+        impuestos, traslados, retenciones = filter_children(impuestos, traslados, retenciones, cfdis['id'])
+        logging.info(f"Incremental delta: {len(cfdis)} of {total_rows} CFDIs changed since {watermark['updated_at'] if watermark else 'beginning'}")
+        if cfdis.empty:
+            logging.info("No new or changed CFDIs. Nothing to do.")
+            return dict(state, done=True)
+        cfdis = cfdis.copy()
+
+    # Concept tax lines of the CFDIs being processed
+    line_taxes = None
+    if conceptos is not None:
+        conceptos = conceptos[conceptos['cfdi_id'].isin(cfdis['id'])]
+        if concepto_impuestos is not None:
+            concepto_impuestos = concepto_impuestos[concepto_impuestos['cfdi_concepto_id'].isin(conceptos['id'])]
+        line_taxes = concept_taxes.tax_rows(concepto_impuestos, load_csv("cfdi_concepto_traslados.csv"), load_csv("cfdi_concepto_retenciones.csv"))
+
+    return dict(state, cfdis=cfdis, impuestos=impuestos, traslados=traslados, retenciones=retenciones,
+                conceptos=conceptos, line_taxes=line_taxes,
+                receptors=load_csv("cfdi_receptors.csv"), emisors=load_csv("cfdi_emisors.csv"),
+                payment_index=payments.reconcile(documents, payment_ids),
+                nomina_cfdis=nomina_cfdis, touched_nominas=touched_nominas)
+
+def stage_payroll(state, db=None):
+    """Gold nómina dataset (totals per period and employee); stored by the publish stage."""
+    rows, periods = payroll.build(state['nomina_cfdis'], state['receptors'], DATA_DIR, touched_ids=state['touched_nominas'])
+    logging.info(f"Payroll: {len(rows)} period/employee rows" + (f" for {len(periods)} changed periods" if periods is not None else ""))
+    state = {k: v for k, v in state.items() if k not in ('nomina_cfdis', 'touched_nominas')}
+    return dict(state, payroll=rows, payroll_periods=periods)
+
+def stage_clean(state, db=None):
+    logging.info("Cleaning Data...")
+    return dict(state, cfdis=clean_cfdis(state['cfdis']),
+                traslados=clean_tax_table(state['traslados']), retenciones=clean_tax_table(state['retenciones']))
+
+def stage_taxes(state, db=None):
+    """Tax aggregates per CFDI: cfdis.id -> impuestos.cfdi_id (impuestos.id) -> traslados/retenciones."""
+    taxes = aggregate_taxes(state['impuestos'], state['traslados'], state['retenciones'])
+    cfdis = attach_taxes(state['cfdis'], taxes)
+
+    # Multi-tenancy: every gold record carries the tenant id
+    cfdis['company_id'] = state['company_id']
+    logging.info(f"Targeting Company ID: {state['company_id']}")
 
-    # 7. MongoDB Load
-    if not MONGO_URI:
+    # The raw tax tables are not needed past this point (keeps later checkpoints small)
+    state = {k: v for k, v in state.items() if k not in ('impuestos', 'traslados', 'retenciones')}
+    return dict(state, cfdis=cfdis)
+
+def stage_lines(state, db=None):
+    """Concept-level tax lines and the per-invoice rate mix; the lines are stored by the publish stage."""
+    lines = concept_taxes.build_lines(state['conceptos'], state['line_taxes'], state['cfdis'])
+    cfdis = concept_taxes.attach_rate_mix(state['cfdis'], concept_taxes.rate_mix(lines))
+    logging.info(f"Concept tax lines: {len(lines)} lines, {int((cfdis['iva_tasas'] > 1).sum())} CFDIs with mixed IVA rates")
+    state = {k: v for k, v in state.items() if k not in ('conceptos', 'line_taxes')}
+    return dict(state, cfdis=cfdis, lines=lines)
+
+def stage_enrich(state, db=None):
+    cfdis = enrich_names(state['cfdis'], state['receptors'], state['emisors'])
+    cfdis = compute_financials(cfdis)
+    logging.info(f"Processed {len(cfdis)} records.")
+    state = {k: v for k, v in state.items() if k not in ('receptors', 'emisors')}
+    return dict(state, cfdis=cfdis)
+
+def stage_payments(state, db=None):
+    """PPD reconciliation: pago_* fields of every PPD invoice from the payment index."""
+    cfdis = payments.attach_payments(state['cfdis'], state['payment_index'])
+    ppd = cfdis['pago_estatus'].notna()
+    logging.info(f"PPD reconciliation: {int(ppd.sum())} PPD invoices, {int((cfdis['pago_estatus'] != 'pagada')[ppd].sum())} with saldo pendiente")
+    state = {k: v for k, v in state.items() if k != 'payment_index'}
+    return dict(state, cfdis=cfdis)
+
+def stage_forensics(state, db=None):
+    """Duplicate triads (exact and near, checked against the tenant's triad index) and the monthly series behind the spike alerts."""
+    # Check for Duplicates (Tríada: RFC + Monto + Fecha)
+    cfdis, alerts, triad_entries, partners = forensics.flag_duplicates(state['cfdis'], state['company_id'], incremental=state['incremental'])
+
+    # Monthly metrics (per tipo / emisor) behind the spike rules
+    cfdis = add_period_columns(cfdis)
+    monthly = forensics.monthly_metrics(cfdis)
+    return dict(state, cfdis=cfdis, alerts=alerts, monthly=monthly, triad_entries=triad_entries, partners=partners)
+
+def stage_alerts(state, db=None):
+    """Rolling-window spike rules (forensics.SPIKE_RULES) and alert delivery."""
+    spike_alerts, chart_to_send = forensics.spike_alerts(state['monthly'])
+    dispatch_alerts(state['alerts'] + spike_alerts, chart_to_send)
+    return state
+
+def stage_publish(state, db=None):
+    """Loads the gold records (Mongo or the local gold layer), refreshes the monthly rollup and payroll and advances the watermark."""
+    cfdis, company_id, incremental = state['cfdis'], state['company_id'], state['incremental']
+    partners = state.get('partners')  # Published CFDIs the batch matched as (near) duplicates
+    # Incremental runs refresh the rollup of the delta's months and of the months its previous versions were in
+    touched_months = month_set(cfdis) | published_months(company_id, cfdis['uuid'], db) if incremental else None
+    written = db is None  # Mongo runs only count the records that actually changed
+    if db is None:
         logging.warning("No MongoDB URI provided. Skipping DB upload.")
-        # Save to JSON locally for verification/demo purposes
-        output_file = os.path.join(DATA_DIR, "gold_cfdi_processed.json")
-        # Convert period to string for JSON serialization
+        # Convert period to string for serialization
         if 'month_year' in cfdis.columns:
-            cfdis['month_year'] = cfdis['month_year'].astype(str)
-        cfdis.to_json(output_file, orient='records', date_format='iso')
-        logging.info(f"Data saved locally to {output_file}")
+            cfdis = cfdis.assign(month_year=cfdis['month_year'].astype(str))
+        if GOLD_FORMAT == 'parquet':
+            # Columnar gold layer partitioned by tenant and month
+            stage = gold_store.staging_dir(GOLD_DIR, company_id)
+            gold_store.write_parts(cfdis, stage)
+            flag_partners(company_id, partners, stage=stage, part=1)
+            gold_store.publish(stage, GOLD_DIR, company_id, incremental=incremental)
+            logging.info(f"Gold partitions published to {gold_store.tenant_dir(GOLD_DIR, company_id)}")
+        else:
+            # Save to JSON locally for verification/demo purposes
+            output_file = gold_store.json_path(DATA_DIR, company_id)
+            gold = merge_local_gold(cfdis, output_file, company_id) if incremental else cfdis
+            if partners is not None and not partners.empty:
+                gold, _ = forensics.mark_partners(gold, partners)
+            gold.to_json(output_file, orient='records', date_format='iso')
+            logging.info(f"Data saved locally to {output_file}")
     else:
         try:
-            client = pymongo.MongoClient(MONGO_URI)
-            db = client[DB_NAME]
-            collection = db[COLLECTION_NAME]
-            
-            # Convert to dict
-            records = cfdis.to_dict(orient='records')
-            
-            # Batch Insert/Upsert
-            # For simplicity, we define 'uuid' as unique index if it exists, else 'id'
-            unique_field = 'uuid' if 'uuid' in cfdis.columns else 'id'
-            
-            # Create Unique Index to prevent duplicates
-            collection.create_index([(unique_field, pymongo.ASCENDING)], unique=True)
-            
-            operations = []
-            for record in records:
-                # Filter out NaN values for Mongo
-                clean_record = {k: v for k, v in record.items() if pd.notnull(v)}
-                operations.append(
-                    pymongo.UpdateOne(
-                        {unique_field: clean_record[unique_field]},
-                        {'$set': clean_record},
-                        upsert=True
-                    )
-                )
-            
-            if operations:
-                result = collection.bulk_write(operations)
-                logging.info(f"MongoDB Write: {result.upserted_count} upserted, {result.modified_count} modified.")
-                
+            stats = upsert_gold(db[COLLECTION_NAME], cfdis)
+            written = stats['upserted'] + stats['modified'] > 0
+            written = flag_partners(company_id, partners, db) or written
+            gold_store.ensure_indexes(db[COLLECTION_NAME])
         except Exception as e:
             logging.error(f"MongoDB Error: {e}")
+            raise
+
+    # Only advance the rollup, the payroll, the tax lines, the triad index and the watermark once the load succeeded
+    update_rollup(company_id, None if incremental else rollups.build(cfdis), db, months=touched_months)
+    update_payroll(company_id, state['payroll'], db, state['payroll_periods'])
+    concept_taxes.save(company_id, state['lines'], db, replace_uuids=set(cfdis['uuid']) if incremental else None)
+    forensics.save_index(company_id, state['triad_entries'], replace=not incremental)
+    save_watermark(company_id, cfdis, db)
+    # New data version (only if a record changed): the dashboards' dataset caches reload this tenant
+    if written:
+        dataset_cache.save_version(company_id, db, data_dir=DATA_DIR)
+    else:
+        logging.info("Gold records unchanged: data version kept.")
+    return state
+
+# (name, function, checkpointed) in execution order; alerts/publish only have side effects
+STAGES = [
+    ('extract', stage_extract, True),
+    ('payroll', stage_payroll, True),
+    ('clean', stage_clean, True),
+    ('taxes', stage_taxes, True),
+    ('lines', stage_lines, True),
+    ('enrich', stage_enrich, True),
+    ('payments', stage_payments, True),
+    ('forensics', stage_forensics, True),
+    ('alerts', stage_alerts, False),
+    ('publish', stage_publish, False),
+]
+STAGE_NAMES = [name for name, _, _ in STAGES]
+
+def checkpoint_dir(company_id):
+    return os.path.join(CHECKPOINT_DIR, str(company_id))
+
+def load_manifest(company_id):
+    path = os.path.join(checkpoint_dir(company_id), "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(company_id, manifest):
+    path = os.path.join(checkpoint_dir(company_id), "manifest.json")
+    with open(path + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def save_checkpoint(company_id, stage, state):
+    path = os.path.join(checkpoint_dir(company_id), f"{stage}.pkl")
+    pd.to_pickle(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def load_checkpoint(company_id, before_stage):
+    """State saved by the last checkpointed stage that runs before `before_stage` (None = start fresh)."""
+    idx = STAGE_NAMES.index(before_stage)
+    for name, _, persisted in reversed(STAGES[:idx]):
+        path = os.path.join(checkpoint_dir(company_id), f"{name}.pkl")
+        if persisted:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Checkpoint for stage '{name}' not found; run the full pipeline first")
+            return pd.read_pickle(path)
+    return None
+
+def rss_mb():
+    """Current resident set size of this process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_pipeline(company_id, db=None, incremental=False, resume=False, only_stage=None):
+    """
+    Runs the stages for one tenant with checkpoints and per-stage metrics.
+      resume:     continue after the last stage that completed in the previous run
+      only_stage: re-run just this stage from the checkpoint of the stages before it
+    Returns True on success, False if a stage failed.
+    """
+    os.makedirs(checkpoint_dir(company_id), exist_ok=True)
+    previous = load_manifest(company_id)
+
+    if only_stage or resume:
+        if previous is None:
+            logging.error(f"No previous run recorded for {company_id}; run the full pipeline first.")
+            return False
+        incremental = previous['incremental']
+        if only_stage:
+            start = STAGE_NAMES.index(only_stage)
+            end = start + 1
+        else:
+            completed = [name for name in STAGE_NAMES if previous['stages'].get(name, {}).get('status') == 'ok']
+            start = STAGE_NAMES.index(completed[-1]) + 1 if completed else 0
+            end = len(STAGES)
+            if start >= end:
+                logging.info(f"Previous run for {company_id} already completed. Nothing to resume.")
+                return True
+        state = load_checkpoint(company_id, STAGE_NAMES[start]) if start > 0 else None
+        manifest = previous
+    else:
+        start, end, state = 0, len(STAGES), None
+        manifest = {'company_id': company_id, 'incremental': incremental, 'started_at': pd.Timestamp.now().isoformat(), 'stages': {}}
+
+    if state is None:
+        state = {'company_id': company_id, 'incremental': incremental}
+    logging.info(f"Running stages: {', '.join(STAGE_NAMES[start:end])}")
+
+    ok = True
+    for name, func, persisted in STAGES[start:end]:
+        if state.get('done'):
+            manifest['stages'][name] = {'status': 'skipped'}
+            continue
+        rss_before = rss_mb()
+        t0 = time.perf_counter()
+        try:
+            state = func(state, db)
+        except Exception as e:
+            logging.error(f"Stage '{name}' failed: {e}")
+            manifest['stages'][name] = {'status': 'failed', 'error': f"{type(e).__name__}: {e}", 'seconds': round(time.perf_counter() - t0, 3)}
+            ok = False
+            break
+        metrics = {
+            'status': 'ok',
+            'seconds': round(time.perf_counter() - t0, 3),
+            'rss_mb': round(rss_mb(), 1),
+            'rss_delta_mb': round(rss_mb() - rss_before, 1),
+            'rows': len(state['cfdis']) if isinstance(state.get('cfdis'), pd.DataFrame) else None
+        }
+        if persisted:
+            save_checkpoint(company_id, name, state)
+        manifest['stages'][name] = metrics
+        logging.info(f"Stage '{name}': {metrics['seconds']:.2f} s, RSS {metrics['rss_mb']:.0f} MB ({metrics['rss_delta_mb']:+.0f} MB)")
+        save_manifest(company_id, manifest)
+
+    # Stages after a failure are left as they were so --resume picks up from there
+    save_manifest(company_id, manifest)
+    print_stage_report(manifest)
+    return ok
+
+def print_stage_report(manifest):
+    print(f"\n--- PIPELINE STAGES ({manifest['company_id']}) ---")
+    for name in STAGE_NAMES:
+        m = manifest['stages'].get(name)
+        if not m:
+            continue
+        if m['status'] == 'ok':
+            print(f"{name:<10} ok      {m['seconds']:8.2f} s  RSS {m['rss_mb']:8.1f} MB ({m['rss_delta_mb']:+.1f})  rows {m['rows'] if m['rows'] is not None else '-'}")
+        else:
+            print(f"{name:<10} {m['status']:<7} {m.get('error', '')}")
+    print("--------------------------------\n")
+
+def main(incremental=INCREMENTAL, streaming=STREAMING, chunksize=CHUNK_SIZE, resume=False, only_stage=None):
+    """Runs the pipeline for COMPANY_ID. Returns True on success, False if the run aborted or the load failed."""
+    logging.info(f"Starting Migration Pipeline ({'incremental' if incremental else 'full'}{', streaming' if streaming else ''})...")
+
+    COMPANY_ID = os.getenv("COMPANY_ID", "DEFAULT_TENANT")
+    db = None
+    if MONGO_URI:
+        client = pymongo.MongoClient(MONGO_URI)
+        db = client[DB_NAME]
+
+    if streaming:
+        if db is None:
+            logging.warning("No MongoDB URI provided. Streaming gold records to the local file.")
+        return run_streaming(COMPANY_ID, db, incremental=incremental, chunksize=chunksize)
+
+    return run_pipeline(COMPANY_ID, db, incremental=incremental, resume=resume, only_stage=only_stage)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="CFDI Gold Migration Pipeline")
+    parser.add_argument("--incremental", action="store_true", default=INCREMENTAL,
+                        help="Only reprocess CFDIs that are new or changed since the tenant watermark")
+    parser.add_argument("--streaming", action="store_true", default=STREAMING,
+                        help="Bounded-memory chunked ingestion for very large tenants")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Rows per CSV chunk in streaming mode")
+    parser.add_argument("--resume", action="store_true", help="Resume the previous run after its last successful stage")
+    parser.add_argument("--stage", choices=STAGE_NAMES, help="Re-run only this stage from the saved checkpoints")
+    args = parser.parse_args()
+    ok = main(incremental=args.incremental, streaming=args.streaming, chunksize=args.chunk_size,
+              resume=args.resume, only_stage=args.stage)
+    raise SystemExit(0 if ok else 1)
@@ -0,0 +1,187 @@
+"""
+Process-wide pooled MongoClient shared by the dashboard (load_data, check_login, ...) and the
+admin scripts.
+
+The client is created lazily on first use and then reused by every caller in the process,
+so Streamlit reruns and sessions share one connection pool instead of paying DNS SRV
+resolution, the TLS handshake and server selection on every cache miss or login. A pool
+listener keeps the metrics shown on the dashboard's instrumentation page (connections open
+and checked out, checkout wait times, failures).
+"""
+import os
+import time
+import logging
+import threading
+import pymongo
+from pymongo import monitoring
+from dotenv import load_dotenv
+
+# Load Environment Variables
+load_dotenv()
+
+# Configuration
+MONGO_URI = os.getenv("MONGO_URI")
+DB_NAME = os.getenv("DB_NAME", "cfdi_db")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_IDLE_MS = int(os.getenv("MONGO_MAX_IDLE_MS", 300000))                 # Idle connections are closed after this
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000))  # Max wait for a free connection
+MONGO_SERVER_SELECTION_MS = int(os.getenv("MONGO_SERVER_SELECTION_MS", 2000))
+MONGO_HEARTBEAT_MS = int(os.getenv("MONGO_HEARTBEAT_MS", 10000))                 # Server monitoring interval
+MONGO_HEALTH_TTL_S = float(os.getenv("MONGO_HEALTH_TTL_S", 30))                  # A successful ping is trusted this long
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection pool counters, updated from pymongo's pool events (any thread)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {
+                'open': 0, 'checked_out': 0, 'max_checked_out': 0, 'created': 0, 'closed': 0,
+                'checkouts': 0, 'checkout_failures': 0, 'pool_clears': 0,
+                'wait_total_ms': 0.0, 'wait_max_ms': 0.0
+            }
+
+    def _waited(self, event):
+        # pymongo >= 4.7 reports the checkout duration; older versions only the start event
+        duration = getattr(event, 'duration', None)
+        if duration is not None:
+            return duration * 1000
+        start = getattr(self.local, 'checkout_start', None)
+        return (time.perf_counter() - start) * 1000 if start is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        self.local.checkout_start = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        waited = self._waited(event)
+        with self.lock:
+            c = self.counters
+            c['checkouts'] += 1
+            c['checked_out'] += 1
+            c['max_checked_out'] = max(c['max_checked_out'], c['checked_out'])
+            c['wait_total_ms'] += waited
+            c['wait_max_ms'] = max(c['wait_max_ms'], waited)
+
+    def connection_check_out_failed(self, event):
+        waited = self._waited(event)
+        with self.lock:
+            self.counters['checkout_failures'] += 1
+            self.counters['wait_max_ms'] = max(self.counters['wait_max_ms'], waited)
+        logging.warning(f"MongoDB pool checkout failed ({event.reason}) after {waited:.0f} ms")
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.counters['checked_out'] = max(self.counters['checked_out'] - 1, 0)
+
+    def connection_created(self, event):
+        with self.lock:
+            self.counters['created'] += 1
+            self.counters['open'] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.counters['closed'] += 1
+            self.counters['open'] = max(self.counters['open'] - 1, 0)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.counters['pool_clears'] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def snapshot(self):
+        with self.lock:
+            c = dict(self.counters)
+        c['wait_avg_ms'] = c['wait_total_ms'] / c['checkouts'] if c['checkouts'] else 0.0
+        return c
+
+
+_metrics = PoolMetrics()
+_lock = threading.Lock()
+_clients = {}
+_health = {}
+
+
+def get_client(uri=None):
+    """The shared client for `uri` (MONGO_URI by default), created on first use."""
+    uri = uri or MONGO_URI
+    if not uri:
+        raise ValueError("MONGO_URI is not configured")
+    client = _clients.get(uri)
+    if client is None:
+        with _lock:
+            client = _clients.get(uri)
+            if client is None:
+                client = pymongo.MongoClient(
+                    uri,
+                    maxPoolSize=MONGO_MAX_POOL_SIZE,
+                    minPoolSize=MONGO_MIN_POOL_SIZE,
+                    maxIdleTimeMS=MONGO_MAX_IDLE_MS,
+                    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_MS,
+                    heartbeatFrequencyMS=MONGO_HEARTBEAT_MS,
+                    event_listeners=[_metrics]
+                )
+                _clients[uri] = client
+                logging.info(f"MongoDB pool created (maxPoolSize={MONGO_MAX_POOL_SIZE}, minPoolSize={MONGO_MIN_POOL_SIZE})")
+    return client
+
+
+def get_db(name=None, uri=None):
+    return get_client(uri)[name or DB_NAME]
+
+
+def health(uri=None, force=False):
+    """
+    Ping result for the shared client: {'ok', 'latency_ms', 'checked_at', 'error'}. A successful
+    ping is reused for MONGO_HEALTH_TTL_S seconds; failures are always re-checked.
+    """
+    uri = uri or MONGO_URI
+    last = _health.get(uri)
+    if not force and last and last['ok'] and time.time() - last['checked_at'] < MONGO_HEALTH_TTL_S:
+        return last
+    start = time.perf_counter()
+    try:
+        get_client(uri).admin.command('ping')
+        result = {'ok': True, 'latency_ms': (time.perf_counter() - start) * 1000, 'checked_at': time.time(), 'error': None}
+    except Exception as e:
+        result = {'ok': False, 'latency_ms': None, 'checked_at': time.time(), 'error': f"{type(e).__name__}: {e}"}
+    _health[uri] = result
+    return result
+
+
+def metrics():
+    """Pool counters plus the configured limits (for the instrumentation page)."""
+    snapshot = _metrics.snapshot()
+    snapshot.update(
+        clients=len(_clients),
+        max_pool_size=MONGO_MAX_POOL_SIZE,
+        min_pool_size=MONGO_MIN_POOL_SIZE,
+        wait_queue_timeout_ms=MONGO_WAIT_QUEUE_TIMEOUT_MS
+    )
+    return snapshot
+
+
+def close():
+    """Closes every shared client (scripts and tests); the next get_client creates a new one."""
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        _health.clear()
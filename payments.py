@@ -0,0 +1,135 @@
+"""
+PPD-to-payment reconciliation: matches every PPD invoice with the payment complements (REP)
+that settle it.
+
+cfdi_pago_documentos_relacionados.id_documento (the invoice UUID) -> cfdi_pago_detalles
+(fecha_pago) -> cfdi_pagos.cfdi_id (the tipo 'P' CFDI). Payments whose CFDI is cancelled or
+belongs to another company are ignored. The result is attached to the gold records as the
+pago_* fields, so the dashboard can list unpaid invoices without rescanning the REPs.
+"""
+import os
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+import schema_registry
+
+load_dotenv()
+
+# Configuration
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+PAYMENT_TOLERANCE = float(os.getenv("PAYMENT_TOLERANCE", 0.01))  # Saldo below this counts as paid
+
+PAYMENT_COLUMNS = ['pago_monto_pagado', 'pago_saldo_insoluto', 'pago_num_pagos', 'pago_ultima_fecha', 'pago_estatus']
+DOCUMENT_COLUMNS = ['uuid', 'payment_cfdi_id', 'fecha_pago', 'num_parcialidad', 'imp_pagado', 'imp_saldo_insoluto']
+
+
+def normalize_uuid(series):
+    """Lower-cased, trimmed UUIDs (REPs often carry them upper-cased)."""
+    return series.astype('string').str.strip().str.lower()
+
+
+def load_documents(data_dir=DATA_DIR):
+    """
+    One row per paid document (DOCUMENT_COLUMNS), or None when the lake has no payment
+    complements. payment_cfdi_id is the id of the tipo 'P' CFDI that carries the payment.
+    """
+    docs = schema_registry.read_table('cfdi_pago_documentos_relacionados', data_dir,
+                                      usecols=['cfdi_pago_detalle_id', 'id_documento', 'num_parcialidad', 'imp_pagado', 'imp_saldo_insoluto'])
+    detalles = schema_registry.read_table('cfdi_pago_detalles', data_dir, usecols=['id', 'cfdi_pago_id', 'fecha_pago'])
+    pagos = schema_registry.read_table('cfdi_pagos', data_dir, usecols=['id', 'cfdi_id'])
+    if docs is None or detalles is None or pagos is None:
+        return None
+
+    detalle_pos = pd.Index(detalles['id']).get_indexer(docs['cfdi_pago_detalle_id'])
+    found = detalle_pos >= 0
+    docs, detalle_pos = docs[found], detalle_pos[found]
+    pago_pos = pd.Index(pagos['id']).get_indexer(detalles['cfdi_pago_id'].to_numpy()[detalle_pos])
+    found = pago_pos >= 0
+
+    documents = pd.DataFrame({
+        'uuid': normalize_uuid(docs['id_documento']).to_numpy()[found],
+        'payment_cfdi_id': pagos['cfdi_id'].to_numpy()[pago_pos[found]],
+        'fecha_pago': pd.to_datetime(detalles['fecha_pago'].to_numpy()[detalle_pos[found]], errors='coerce'),
+        'num_parcialidad': docs['num_parcialidad'].to_numpy(dtype=float, na_value=np.nan)[found],
+        'imp_pagado': docs['imp_pagado'].to_numpy(dtype=float, na_value=np.nan)[found],
+        'imp_saldo_insoluto': docs['imp_saldo_insoluto'].to_numpy(dtype=float, na_value=np.nan)[found]
+    })
+    return documents[documents['uuid'].notna()].reset_index(drop=True)
+
+
+def payment_cfdi_ids(cfdis, include_cancelled=False):
+    """Ids of the tipo 'P' CFDIs that count as payments (not cancelled, unless `include_cancelled`)."""
+    if cfdis is None or 'tipo' not in cfdis.columns:
+        return np.array([], dtype='int64')
+    mask = cfdis['tipo'].astype(str).str.upper() == 'P'
+    if include_cancelled:
+        return cfdis.loc[mask, 'id'].to_numpy()
+    if 'cancelado' in cfdis.columns:
+        mask &= ~cfdis['cancelado'].astype(str).str.lower().isin(['t', 'true', '1'])
+    if 'estatus' in cfdis.columns:
+        mask &= cfdis['estatus'].astype(str).str.lower() != 'cancelado'
+    return cfdis.loc[mask, 'id'].to_numpy()
+
+
+def referenced_uuids(documents, payment_ids):
+    """Invoice UUIDs paid by the given payment CFDIs (incremental runs re-publish them)."""
+    if documents is None or len(payment_ids) == 0:
+        return set()
+    return set(documents.loc[documents['payment_cfdi_id'].isin(payment_ids), 'uuid'])
+
+
+def reconcile(documents, payment_ids):
+    """
+    Reconciliation index keyed by invoice UUID: amount paid, number of payments, last payment
+    date and the imp_saldo_insoluto reported by the latest payment (by fecha_pago, parcialidad).
+    """
+    columns = ['monto_pagado', 'num_pagos', 'ultima_fecha', 'saldo_insoluto']
+    if documents is None or documents.empty:
+        return pd.DataFrame(columns=columns, index=pd.Index([], name='uuid'))
+    rows = documents[documents['payment_cfdi_id'].isin(payment_ids)]
+    rows = rows.sort_values(['uuid', 'fecha_pago', 'num_parcialidad'], na_position='first', kind='stable')
+    grouped = rows.groupby('uuid', sort=False)
+    index = pd.DataFrame({
+        'monto_pagado': grouped['imp_pagado'].sum(),
+        'num_pagos': grouped.size(),
+        'ultima_fecha': grouped['fecha_pago'].max(),
+        'saldo_insoluto': grouped['imp_saldo_insoluto'].last()
+    })
+    index.index.name = 'uuid'
+    return index[columns]
+
+
+def attach_payments(cfdis, index, tolerance=PAYMENT_TOLERANCE):
+    """
+    Adds the pago_* fields to the PPD invoices (other rows get nulls). Each invoice is a single
+    hash probe into the index; invoices without payments keep their whole total as saldo.
+    """
+    cfdis = cfdis.drop(columns=PAYMENT_COLUMNS, errors='ignore')
+    n = len(cfdis)
+    is_ppd = (cfdis['metodo_pago'].astype(str).str.upper() == 'PPD').to_numpy() if 'metodo_pago' in cfdis.columns else np.zeros(n, dtype=bool)
+    pos = index.index.get_indexer(normalize_uuid(cfdis['uuid'])) if n else np.array([], dtype='int64')
+    paid = is_ppd & (pos >= 0)
+    hit = pos[paid]
+
+    total = pd.to_numeric(cfdis['total'], errors='coerce').to_numpy(dtype=float)
+    monto = np.where(is_ppd, 0.0, np.nan)
+    num = np.where(is_ppd, 0.0, np.nan)
+    saldo = np.where(is_ppd, total, np.nan)
+    ultima = np.full(n, np.datetime64('NaT'), dtype='datetime64[ns]')
+    monto[paid] = index['monto_pagado'].to_numpy(dtype=float)[hit]
+    num[paid] = index['num_pagos'].to_numpy(dtype=float)[hit]
+    ultima[paid] = index['ultima_fecha'].to_numpy(dtype='datetime64[ns]')[hit]
+    # A payment without saldo insoluto is settled against the invoice total
+    reported = index['saldo_insoluto'].to_numpy(dtype=float)[hit]
+    saldo[paid] = np.where(np.isnan(reported), total[paid] - monto[paid], reported)
+
+    estatus = np.where(saldo <= tolerance, 'pagada', np.where(num > 0, 'parcial', 'pendiente')).astype(object)
+    estatus[~is_ppd] = None
+    return cfdis.assign(
+        pago_monto_pagado=monto,
+        pago_saldo_insoluto=saldo,
+        pago_num_pagos=pd.array(np.where(is_ppd, num, np.nan), dtype='Int64'),
+        pago_ultima_fecha=pd.Series(ultima, index=cfdis.index).dt.strftime('%Y-%m-%dT%H:%M:%S'),
+        pago_estatus=estatus
+    )
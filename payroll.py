@@ -0,0 +1,235 @@
+"""
+Gold nómina dataset: payroll totals per period and employee, written by migration.py and read
+by the dashboard's payroll view.
+
+One row per (company_id, periodo, curp) built from cfdi_nominas and its percepciones,
+deducciones, otros pagos, receptor and emisor tables: receipts, days paid, gravado/exento
+percepciones, deducciones (ISR and IMSS broken out), otros pagos, subsidio causado and the net
+paid. Cancelled nómina CFDIs are left out. Period totals are sums of these rows, so the view
+never joins the six source tables.
+
+Storage: the PAYROLL_COLLECTION Mongo collection when the gold lives in Mongo, otherwise one
+Parquet file per tenant under PAYROLL_DIR.
+"""
+import os
+import logging
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+import schema_registry
+
+load_dotenv()
+
+# Configuration
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+PAYROLL_COLLECTION = os.getenv("PAYROLL_COLLECTION", "gold_nomina")
+PAYROLL_DIR = os.getenv("PAYROLL_DIR", os.path.join(DATA_DIR, "gold_nomina"))
+
+PAYROLL_KEYS = ['periodo', 'curp']
+ATTRIBUTES = ['rfc', 'nombre', 'num_empleado', 'departamento', 'puesto', 'periodicidad_pago', 'registro_patronal']
+MEASURES = ['recibos', 'dias_pagados', 'percepciones_gravado', 'percepciones_exento', 'percepciones_total',
+            'deducciones_total', 'isr_retenido', 'imss', 'otros_pagos', 'subsidio_causado', 'neto_pagado']
+# SAT c_TipoDeduccion codes broken out of the deducciones total
+DEDUCCION_ISR = '002'
+DEDUCCION_IMSS = '001'
+# cfdis columns needed to pick the tenant's nómina CFDIs
+CFDI_COLUMNS = ['id', 'tipo', 'cancelado', 'estatus', 'receptor_id', 'fecha_emision']
+
+
+def payroll_columns():
+    return PAYROLL_KEYS + ATTRIBUTES + MEASURES + ['fecha_pago_min', 'fecha_pago_max']
+
+
+def empty_payroll():
+    return pd.DataFrame(columns=payroll_columns())
+
+
+def nomina_cfdis(cfdis, include_cancelled=False):
+    """The tenant's tipo 'N' CFDIs (CFDI_COLUMNS), without the cancelled ones unless `include_cancelled`."""
+    if cfdis is None or 'tipo' not in cfdis.columns:
+        return pd.DataFrame(columns=CFDI_COLUMNS)
+    mask = cfdis['tipo'].astype(str).str.upper() == 'N'
+    if not include_cancelled:
+        if 'cancelado' in cfdis.columns:
+            mask &= ~cfdis['cancelado'].astype(str).str.lower().isin(['t', 'true', '1'])
+        if 'estatus' in cfdis.columns:
+            mask &= cfdis['estatus'].astype(str).str.lower() != 'cancelado'
+    return cfdis.loc[mask, [c for c in CFDI_COLUMNS if c in cfdis.columns]].reset_index(drop=True)
+
+
+def _code(series):
+    return series.astype(str).str.strip().str.zfill(3).to_numpy()
+
+
+def _sum_by(pos, values, n):
+    """Vectorized per-nómina sums: rows whose nómina is not selected (pos < 0) are dropped."""
+    keep = pos >= 0
+    return np.bincount(pos[keep], weights=np.nan_to_num(np.asarray(values, dtype=float)[keep]), minlength=n)
+
+
+def _first_by(pos, frame, columns, n):
+    """First child row per nómina (receptor / emisor tables hold one row per nómina)."""
+    out = pd.DataFrame(index=range(n), columns=columns, dtype=object)
+    if frame is None or frame.empty:
+        return out
+    keep = pos >= 0
+    rows = frame[keep].assign(_pos=pos[keep]).drop_duplicates('_pos')
+    for col in columns:
+        if col in rows.columns:
+            out.loc[rows['_pos'].to_numpy(), col] = rows[col].astype(object).to_numpy()
+    return out
+
+
+def build(cfdis, receptors=None, data_dir=DATA_DIR, touched_ids=None):
+    """
+    Payroll rows of the given nómina CFDIs (see nomina_cfdis). With `touched_ids` (nómina CFDI
+    ids changed in an incremental run) only the periods those CFDIs fall in are rebuilt.
+    Returns (payroll, periods): periods is None for a full build.
+    """
+    nominas = schema_registry.read_table('cfdi_nominas', data_dir,
+                                         usecols=['id', 'cfdi_id', 'tipo_nomina', 'fecha_pago', 'num_dias_pagados'])
+    if nominas is None:
+        return empty_payroll(), (set() if touched_ids is not None else None)
+    # Receipts without fecha_pago fall back to the CFDI's fecha_emision
+    cfdi_pos = pd.Index(cfdis['id']).get_indexer(nominas['cfdi_id'])
+    emision = pd.to_datetime(cfdis['fecha_emision'], errors='coerce').dt.strftime('%Y-%m').to_numpy(dtype=object)
+    fallback = pd.Series(np.where(cfdi_pos >= 0, emision[cfdi_pos], None), index=nominas.index)
+    nominas['periodo'] = pd.to_datetime(nominas['fecha_pago'], errors='coerce').dt.strftime('%Y-%m').fillna(fallback)
+
+    keep = cfdi_pos >= 0
+    periods = None
+    if touched_ids is not None:
+        periods = set(nominas.loc[nominas['cfdi_id'].isin(touched_ids), 'periodo'].dropna())
+        keep &= nominas['periodo'].isin(periods).to_numpy()
+
+    nominas = nominas[keep].reset_index(drop=True)
+    cfdi_rows = cfdis.iloc[cfdi_pos[keep]].reset_index(drop=True)
+    n = len(nominas)
+    if n == 0:
+        return empty_payroll(), periods
+
+    nomina_index = pd.Index(nominas['id'])
+
+    def child(table, usecols):
+        frame = schema_registry.read_table(table, data_dir, usecols=['cfdi_nomina_id'] + usecols)
+        if frame is None:
+            return None, np.array([], dtype='int64')
+        return frame, nomina_index.get_indexer(frame['cfdi_nomina_id'])
+
+    receipts = pd.DataFrame({'periodo': nominas['periodo'], 'recibos': 1,
+                             'dias_pagados': pd.to_numeric(nominas['num_dias_pagados'], errors='coerce').fillna(0).to_numpy()})
+
+    percepciones, pos = child('cfdi_nomina_percepciones', ['importe_gravado', 'importe_exento'])
+    receipts['percepciones_gravado'] = _sum_by(pos, percepciones['importe_gravado'], n) if percepciones is not None else 0.0
+    receipts['percepciones_exento'] = _sum_by(pos, percepciones['importe_exento'], n) if percepciones is not None else 0.0
+    receipts['percepciones_total'] = receipts['percepciones_gravado'] + receipts['percepciones_exento']
+
+    deducciones, pos = child('cfdi_nomina_deducciones', ['tipo_deduccion', 'importe'])
+    if deducciones is not None:
+        codes = _code(deducciones['tipo_deduccion'])
+        importe = deducciones['importe'].to_numpy(dtype=float, na_value=np.nan)
+        receipts['deducciones_total'] = _sum_by(pos, importe, n)
+        receipts['isr_retenido'] = _sum_by(pos, np.where(codes == DEDUCCION_ISR, importe, 0.0), n)
+        receipts['imss'] = _sum_by(pos, np.where(codes == DEDUCCION_IMSS, importe, 0.0), n)
+    else:
+        receipts['deducciones_total'] = receipts['isr_retenido'] = receipts['imss'] = 0.0
+
+    otros, pos = child('cfdi_nomina_otros_pagos', ['importe', 'subsidio_causado'])
+    receipts['otros_pagos'] = _sum_by(pos, otros['importe'], n) if otros is not None else 0.0
+    receipts['subsidio_causado'] = _sum_by(pos, otros['subsidio_causado'], n) if otros is not None else 0.0
+    receipts['neto_pagado'] = receipts['percepciones_total'] + receipts['otros_pagos'] - receipts['deducciones_total']
+
+    # Employee attributes
+    receptores, pos = child('cfdi_nomina_receptores', ['curp', 'num_empleado', 'departamento', 'puesto', 'periodicidad_pago'])
+    receipts = receipts.join(_first_by(pos, receptores, ['curp', 'num_empleado', 'departamento', 'puesto', 'periodicidad_pago'], n))
+    emisores, pos = child('cfdi_nomina_emisores', ['registro_patronal'])
+    receipts = receipts.join(_first_by(pos, emisores, ['registro_patronal'], n))
+    receipts['rfc'] = None
+    receipts['nombre'] = None
+    if receptors is not None and 'receptor_id' in cfdi_rows.columns:
+        catalog = receptors.drop_duplicates('id').set_index('id')
+        rec_pos = catalog.index.get_indexer(cfdi_rows['receptor_id'])
+        found = rec_pos >= 0
+        for col in ('rfc', 'nombre'):
+            if col in catalog.columns:
+                values = np.full(n, None, dtype=object)
+                values[found] = catalog[col].astype(object).to_numpy()[rec_pos[found]]
+                receipts[col] = values
+    # Receipts without a CURP are keyed by the employee's RFC
+    receipts['curp'] = receipts['curp'].fillna(receipts['rfc']).fillna('DESCONOCIDO')
+    receipts['fecha_pago'] = pd.to_datetime(nominas['fecha_pago'], errors='coerce')
+
+    aggs = {m: (m, 'sum') for m in MEASURES}
+    aggs.update({a: (a, 'first') for a in ATTRIBUTES})
+    aggs.update(fecha_pago_min=('fecha_pago', 'min'), fecha_pago_max=('fecha_pago', 'max'))
+    payroll = receipts.groupby(PAYROLL_KEYS, sort=True, dropna=False).agg(**aggs).reset_index()
+    payroll['recibos'] = payroll['recibos'].astype('int64')
+    return payroll[payroll_columns()], periods
+
+
+# --- Storage ---
+
+def payroll_path(company_id, payroll_dir=PAYROLL_DIR):
+    return os.path.join(payroll_dir, f"company_id={company_id}.parquet")
+
+
+def save(company_id, payroll, db=None, periods=None, payroll_dir=PAYROLL_DIR):
+    """
+    Stores a tenant's payroll rows. `periods=None` replaces the whole tenant; otherwise only the
+    rows of those periods are replaced (incremental runs).
+    """
+    if db is not None:
+        collection = db[PAYROLL_COLLECTION]
+        collection.create_index([('company_id', 1), ('periodo', 1)])
+        collection.create_index([('company_id', 1), ('curp', 1)])
+        query = {'company_id': company_id}
+        if periods is not None:
+            query['periodo'] = {'$in': sorted(periods)}
+        records = [{k: v for k, v in r.items() if not (v is None or (isinstance(v, float) and np.isnan(v)) or v is pd.NaT)}
+                   for r in payroll.assign(company_id=company_id).to_dict(orient='records')]
+        collection.delete_many(query)
+        if records:
+            collection.insert_many(records, ordered=False)
+    else:
+        path = payroll_path(company_id, payroll_dir)
+        os.makedirs(payroll_dir, exist_ok=True)
+        if periods is not None and os.path.exists(path):
+            existing = pd.read_parquet(path)
+            payroll = pd.concat([existing[~existing['periodo'].isin(periods)], payroll], ignore_index=True)
+            payroll = payroll.sort_values(PAYROLL_KEYS, kind='stable').reset_index(drop=True)
+        tmp = f"{path}.tmp"
+        payroll.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+    logging.info(f"Payroll: {len(payroll)} period/employee rows stored for {company_id}" + (f" ({len(periods)} periods refreshed)" if periods is not None else ""))
+
+
+def load(company_id, db=None, payroll_dir=PAYROLL_DIR):
+    """A tenant's payroll rows, or None if it has none."""
+    if db is not None:
+        rows = list(db[PAYROLL_COLLECTION].find({'company_id': company_id}, {'_id': 0, 'company_id': 0}))
+        payroll = pd.DataFrame(rows) if rows else None
+    else:
+        path = payroll_path(company_id, payroll_dir)
+        payroll = pd.read_parquet(path) if os.path.exists(path) else None
+    if payroll is None or payroll.empty:
+        return None
+    for col in ('fecha_pago_min', 'fecha_pago_max'):
+        payroll[col] = pd.to_datetime(payroll[col])
+    return payroll
+
+
+# --- Queries (dashboard) ---
+
+def by_period(payroll):
+    """Period totals (the payroll view's trend) with the number of employees paid."""
+    totals = payroll.groupby('periodo', sort=True)[MEASURES].sum()
+    totals['empleados'] = payroll.groupby('periodo', sort=True)['curp'].nunique()
+    return totals
+
+
+def by_employee(payroll):
+    """Totals per employee across the selected periods."""
+    totals = payroll.groupby('curp', sort=False).agg(
+        **{a: (a, 'last') for a in ATTRIBUTES}, **{m: (m, 'sum') for m in MEASURES})
+    return totals.sort_values('neto_pagado', ascending=False)
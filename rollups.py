@@ -0,0 +1,195 @@
+"""
+Pre-aggregated monthly rollup of the gold CFDIs, written by migration.py and read by the dashboard.
+
+One row per (company_id, month, tipo, metodo_pago, uso_cfdi, emisor_rfc) holding the invoice
+count, the sum and sum of squares of every money column, min/max of the total and the first/last
+fecha_emision of the group. Sums, counts, means, standard deviations and extremes of any
+combination of groups are derived from these rows, so aggregate views never need the invoices.
+
+Storage: the ROLLUP_COLLECTION Mongo collection when the gold lives in Mongo, otherwise one
+Parquet file per tenant under ROLLUP_DIR.
+"""
+import os
+import logging
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configuration
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+ROLLUP_COLLECTION = os.getenv("ROLLUP_COLLECTION", "gold_cfdi_monthly")
+ROLLUP_DIR = os.getenv("ROLLUP_DIR", os.path.join(DATA_DIR, "gold_cfdi_monthly"))
+
+DIMENSIONS = ['tipo', 'metodo_pago', 'uso_cfdi', 'emisor_rfc']
+ROLLUP_KEYS = ['month'] + DIMENSIONS
+MEASURES = ['total', 'subtotal', 'descuento', 'calc_iva', 'calc_traslados', 'calc_retenciones']
+# Gold columns needed to (re)build the rollup of published months
+SOURCE_COLUMNS = ['fecha_emision', 'receptor_uso_cfdi'] + DIMENSIONS + MEASURES
+
+
+def rollup_columns():
+    return (ROLLUP_KEYS + ['count']
+            + [f'{m}_sum' for m in MEASURES] + [f'{m}_sumsq' for m in MEASURES]
+            + ['total_min', 'total_max', 'fecha_min', 'fecha_max'])
+
+
+def empty_rollup():
+    return pd.DataFrame(columns=rollup_columns())
+
+
+def build(cfdis):
+    """Monthly rollup rows of a gold frame. CFDIs without a valid fecha_emision are left out (as in the dashboard)."""
+    if cfdis is None or cfdis.empty:
+        return empty_rollup()
+    fechas = pd.to_datetime(cfdis['fecha_emision'], errors='coerce')
+    valid = fechas.notna().to_numpy()
+    frame = pd.DataFrame({'fecha': fechas[valid], 'month': fechas[valid].dt.strftime('%Y-%m')})
+
+    source = {'uso_cfdi': 'receptor_uso_cfdi' if 'uso_cfdi' not in cfdis.columns else 'uso_cfdi'}
+    for col in DIMENSIONS:
+        name = source.get(col, col)
+        if name in cfdis.columns:
+            values = cfdis[name][valid]
+            frame[col] = values.astype(object).where(values.notna(), None)
+        else:
+            frame[col] = None
+    for col in MEASURES:
+        # Same coercion as the dashboard: unparseable or missing amounts count as 0
+        values = pd.to_numeric(cfdis[col][valid], errors='coerce').fillna(0) if col in cfdis.columns else 0.0
+        frame[col] = values
+        frame[f'{col}_sq'] = frame[col] ** 2
+
+    aggs = {'count': ('total', 'size')}
+    aggs.update({f'{m}_sum': (m, 'sum') for m in MEASURES})
+    aggs.update({f'{m}_sumsq': (f'{m}_sq', 'sum') for m in MEASURES})
+    aggs.update(total_min=('total', 'min'), total_max=('total', 'max'), fecha_min=('fecha', 'min'), fecha_max=('fecha', 'max'))
+    rollup = frame.groupby(ROLLUP_KEYS, dropna=False, sort=True).agg(**aggs).reset_index()
+    return rollup[rollup_columns()]
+
+
+def combine(parts):
+    """Merges rollups built from disjoint slices of the same tenant (e.g. streaming partitions)."""
+    parts = [p for p in parts if p is not None and not p.empty]
+    if not parts:
+        return empty_rollup()
+    rows = pd.concat(parts, ignore_index=True)
+    aggs = {col: 'sum' for col in rollup_columns() if col == 'count' or col.endswith('_sum') or col.endswith('_sumsq')}
+    aggs.update(total_min='min', fecha_min='min', total_max='max', fecha_max='max')
+    rollup = rows.groupby(ROLLUP_KEYS, dropna=False, sort=True).agg(aggs).reset_index()
+    return rollup[rollup_columns()]
+
+
+# --- Storage ---
+
+def rollup_path(company_id, rollup_dir=ROLLUP_DIR):
+    return os.path.join(rollup_dir, f"company_id={company_id}.parquet")
+
+
+def save(company_id, rollup, db=None, months=None, rollup_dir=ROLLUP_DIR):
+    """
+    Stores a tenant's rollup. `months=None` replaces the whole tenant; otherwise only the
+    rows of those months are replaced (incremental runs).
+    """
+    if db is not None:
+        collection = db[ROLLUP_COLLECTION]
+        collection.create_index([('company_id', 1), ('month', 1)])
+        query = {'company_id': company_id}
+        if months is not None:
+            query['month'] = {'$in': sorted(months)}
+        records = [{k: (None if isinstance(v, float) and np.isnan(v) else v) for k, v in r.items()}
+                   for r in rollup.assign(company_id=company_id).to_dict(orient='records')]
+        collection.delete_many(query)
+        if records:
+            collection.insert_many(records, ordered=False)
+    else:
+        path = rollup_path(company_id, rollup_dir)
+        os.makedirs(rollup_dir, exist_ok=True)
+        if months is not None and os.path.exists(path):
+            existing = pd.read_parquet(path)
+            rollup = pd.concat([existing[~existing['month'].isin(months)], rollup], ignore_index=True)
+            rollup = rollup.sort_values('month', kind='stable').reset_index(drop=True)
+        tmp = f"{path}.tmp"
+        rollup.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+    logging.info(f"Monthly rollup: {len(rollup)} rows stored for {company_id}" + (f" ({len(months)} months refreshed)" if months is not None else ""))
+
+
+def load(company_id, db=None, rollup_dir=ROLLUP_DIR):
+    """A tenant's rollup rows, or None if it has none."""
+    if db is not None:
+        rows = list(db[ROLLUP_COLLECTION].find({'company_id': company_id}, {'_id': 0, 'company_id': 0}))
+        rollup = pd.DataFrame(rows) if rows else None
+    else:
+        path = rollup_path(company_id, rollup_dir)
+        rollup = pd.read_parquet(path) if os.path.exists(path) else None
+    if rollup is None or rollup.empty:
+        return None
+    for col in ('fecha_min', 'fecha_max'):
+        rollup[col] = pd.to_datetime(rollup[col])
+    return rollup
+
+
+# --- Queries (dashboard) ---
+
+def select(rollup, tipos=None, start_date=None, end_date=None):
+    """
+    Rollup rows matching the dashboard filters, or None when the date range cuts through a
+    month group (the caller then falls back to the invoices).
+    """
+    if rollup is None:
+        return None
+    rows = rollup
+    if tipos is not None:
+        rows = rows[rows['tipo'].isin(list(tipos))]
+    if start_date is not None and end_date is not None:
+        first = rows['fecha_min'].dt.date
+        last = rows['fecha_max'].dt.date
+        inside = (first >= start_date) & (last <= end_date)
+        outside = (last < start_date) | (first > end_date)
+        if not (inside | outside).all():
+            return None
+        rows = rows[inside]
+    return rows
+
+
+def summary(rows):
+    """count, sum, mean, sample std, min and max of the invoice totals."""
+    n = int(rows['count'].sum())
+    s = float(rows['total_sum'].sum())
+    ss = float(rows['total_sumsq'].sum())
+    std = float(np.sqrt(max(ss - s * s / n, 0.0) / (n - 1))) if n > 1 else float('nan')
+    return {
+        'count': n,
+        'sum': s,
+        'mean': s / n if n else 0.0,
+        'std': std,
+        'min': float(rows['total_min'].min()) if n else float('nan'),
+        'max': float(rows['total_max'].max()) if n else float('nan')
+    }
+
+
+def sums_by(rows, column, measure='total'):
+    """Sum of a measure per dimension value (like df.groupby(column)[measure].sum())."""
+    return rows.groupby(column, sort=True)[f'{measure}_sum'].sum().rename(measure)
+
+
+def monthly(rows, measure='total'):
+    """Monthly sums indexed by month-end timestamps (like df.resample('M')[measure].sum())."""
+    series = rows.groupby('month')[f'{measure}_sum'].sum()
+    if series.empty:
+        return series.rename(measure)
+    periods = pd.PeriodIndex(series.index, freq='M')
+    series.index = periods.to_timestamp(how='end').normalize()
+    # resample() also emits the empty months in between
+    full = pd.period_range(periods.min(), periods.max(), freq='M').to_timestamp(how='end').normalize()
+    return series.reindex(full, fill_value=0).rename(measure)
+
+
+def totals(rows):
+    """Column sums of the gold money columns plus the dashboard's derived ventas columns."""
+    sums = pd.Series({m: float(rows[f'{m}_sum'].sum()) for m in MEASURES})
+    sums['ventas_brutas'] = sums['subtotal']
+    sums['ventas_netas_calc'] = (sums['subtotal'] + sums['calc_iva']) - (sums['calc_retenciones'] + sums['descuento'])
+    return sums
@@ -0,0 +1,322 @@
+"""
+Central schema registry for the CFDI data lake (data/*.csv, flat exports of the Laravel tables).
+
+Every loader reads through read_table() so pandas never has to infer types:
+  - dtypes: explicit numpy / pandas dtypes per column
+  - 'category' for low-cardinality SAT catalog fields (tipo, moneda, metodo_pago, ...)
+  - usecols: the columns the pipeline and dashboard actually use (blobs and seals are skipped)
+  - money: parsed natively as float64; only exports with currency symbols fall back to cleaning
+"""
+import os
+import codecs
+import logging
+import pandas as pd
+
+# --- Column type shorthands ---
+ID = 'int64'          # Primary keys / mandatory foreign keys
+OPT_ID = 'Int64'      # Nullable foreign keys
+MONEY = 'float64'     # Importes, bases, totales
+NUM = 'float64'       # Cantidades, tasas, tipos de cambio
+CAT = 'category'      # SAT catalog codes and low-cardinality flags
+TEXT = 'str'          # Free text, UUIDs, RFCs, folios and timestamps (kept verbatim)
+
+TABLE_SCHEMAS = {
+    'cfdis': {
+        'file': 'cfdis.csv',
+        'dtypes': {
+            'id': ID, 'company_id': OPT_ID, 'uuid': TEXT, 'direccion': CAT, 'tipo': CAT,
+            'serie': CAT, 'folio': TEXT, 'fecha_emision': TEXT, 'version': CAT,
+            'subtotal': MONEY, 'descuento': MONEY, 'total': MONEY, 'moneda': CAT, 'tipo_cambio': NUM,
+            'forma_pago': CAT, 'metodo_pago': CAT, 'exportacion': CAT, 'lugar_expedicion': CAT,
+            'confirmacion': TEXT, 'emisor_id': OPT_ID, 'receptor_id': OPT_ID, 'receptor_uso_cfdi': CAT,
+            'xml_path': TEXT, 'pdf_path': TEXT, 'xml_filename': TEXT, 'xml_hash': TEXT, 'xml_size': OPT_ID,
+            'cancelado': CAT, 'fecha_cancelacion': TEXT, 'motivo_cancelacion': CAT, 'estatus': CAT,
+            'metadata': TEXT, 'created_at': TEXT, 'updated_at': TEXT, 'deleted_at': TEXT, 'source': CAT
+        },
+        'money': ['subtotal', 'descuento', 'total'],
+        'dates': ['fecha_emision', 'fecha_cancelacion', 'created_at', 'updated_at', 'deleted_at'],
+        # Every column is carried into the gold layer
+        'usecols': None
+    },
+    'cfdi_emisors': {
+        'file': 'cfdi_emisors.csv',
+        'dtypes': {'id': ID, 'rfc': TEXT, 'nombre': TEXT, 'regimen_fiscal': CAT},
+        'money': [],
+        'usecols': ['id', 'rfc', 'nombre', 'regimen_fiscal']
+    },
+    'cfdi_receptors': {
+        'file': 'cfdi_receptors.csv',
+        'dtypes': {'id': ID, 'rfc': TEXT, 'nombre': TEXT, 'domicilio_fiscal_cp': CAT, 'regimen_fiscal': CAT, 'uso_cfdi_preferido': CAT},
+        'money': [],
+        'usecols': ['id', 'rfc', 'nombre', 'domicilio_fiscal_cp', 'regimen_fiscal', 'uso_cfdi_preferido']
+    },
+    'cfdi_conceptos': {
+        'file': 'cfdi_conceptos.csv',
+        'dtypes': {
+            'id': ID, 'cfdi_id': ID, 'clave_prod_serv': CAT, 'no_identificacion': TEXT, 'cantidad': NUM,
+            'clave_unidad': CAT, 'unidad': CAT, 'descripcion': TEXT, 'valor_unitario': MONEY,
+            'importe': MONEY, 'descuento': MONEY, 'objeto_impuesto': CAT
+        },
+        'money': ['valor_unitario', 'importe', 'descuento'],
+        'usecols': ['id', 'cfdi_id', 'clave_prod_serv', 'no_identificacion', 'cantidad', 'clave_unidad', 'unidad',
+                    'descripcion', 'valor_unitario', 'importe', 'descuento', 'objeto_impuesto']
+    },
+    'cfdi_comprobante_impuestos': {
+        'file': 'cfdi_comprobante_impuestos.csv',
+        'dtypes': {'id': ID, 'cfdi_id': ID, 'total_impuestos_trasladados': MONEY, 'total_impuestos_retenidos': MONEY},
+        'money': ['total_impuestos_trasladados', 'total_impuestos_retenidos'],
+        'usecols': ['id', 'cfdi_id', 'total_impuestos_trasladados', 'total_impuestos_retenidos']
+    },
+    'cfdi_comprobante_traslados': {
+        'file': 'cfdi_comprobante_traslados.csv',
+        'dtypes': {'id': ID, 'cfdi_comprobante_impuestos_id': ID, 'impuesto': CAT, 'tipo_factor': CAT, 'tasa_o_cuota': NUM, 'base': MONEY, 'importe': MONEY},
+        'money': ['base', 'importe'],
+        'usecols': ['id', 'cfdi_comprobante_impuestos_id', 'impuesto', 'tipo_factor', 'tasa_o_cuota', 'base', 'importe']
+    },
+    'cfdi_comprobante_retenciones': {
+        'file': 'cfdi_comprobante_retenciones.csv',
+        'dtypes': {'id': ID, 'cfdi_comprobante_impuestos_id': ID, 'impuesto': CAT, 'importe': MONEY},
+        'money': ['importe'],
+        'usecols': ['id', 'cfdi_comprobante_impuestos_id', 'impuesto', 'importe']
+    },
+    'cfdi_concepto_impuestos': {
+        'file': 'cfdi_concepto_impuestos.csv',
+        'dtypes': {'id': ID, 'cfdi_concepto_id': ID},
+        'money': [],
+        'usecols': ['id', 'cfdi_concepto_id']
+    },
+    'cfdi_concepto_traslados': {
+        'file': 'cfdi_concepto_traslados.csv',
+        'dtypes': {'id': ID, 'cfdi_concepto_impuestos_id': ID, 'base': MONEY, 'impuesto': CAT, 'tipo_factor': CAT, 'tasa_o_cuota': NUM, 'importe': MONEY},
+        'money': ['base', 'importe'],
+        'usecols': ['id', 'cfdi_concepto_impuestos_id', 'base', 'impuesto', 'tipo_factor', 'tasa_o_cuota', 'importe']
+    },
+    'cfdi_concepto_retenciones': {
+        'file': 'cfdi_concepto_retenciones.csv',
+        'dtypes': {'id': ID, 'cfdi_concepto_impuestos_id': ID, 'base': MONEY, 'impuesto': CAT, 'tipo_factor': CAT, 'tasa_o_cuota': NUM, 'importe': MONEY},
+        'money': ['base', 'importe'],
+        'usecols': ['id', 'cfdi_concepto_impuestos_id', 'base', 'impuesto', 'tipo_factor', 'tasa_o_cuota', 'importe']
+    },
+    'cfdi_relacionados': {
+        'file': 'cfdi_relacionados.csv',
+        'dtypes': {'id': ID, 'cfdi_id': ID, 'tipo_relacion': CAT, 'uuid_relacionado': TEXT, 'cfdi_relacionado_id': OPT_ID},
+        'money': [],
+        'usecols': ['id', 'cfdi_id', 'tipo_relacion', 'uuid_relacionado', 'cfdi_relacionado_id']
+    },
+    'timbre_fiscal_digitales': {
+        'file': 'timbre_fiscal_digitales.csv',
+        'dtypes': {'id': ID, 'cfdi_id': ID, 'version': CAT, 'uuid': TEXT, 'fecha_timbrado': TEXT, 'no_certificado_sat': CAT, 'rfc_prov_certif': CAT, 'leyenda': TEXT},
+        'money': [],
+        'dates': ['fecha_timbrado'],
+        # sello_cfdi / sello_sat are ~350 byte base64 blobs per row and unused downstream
+        'usecols': ['id', 'cfdi_id', 'version', 'uuid', 'fecha_timbrado', 'no_certificado_sat', 'rfc_prov_certif']
+    },
+    'cfdi_pagos': {
+        'file': 'cfdi_pagos.csv',
+        'dtypes': {'id': ID, 'cfdi_id': ID, 'version': CAT},
+        'money': [],
+        'usecols': ['id', 'cfdi_id', 'version']
+    },
+    'cfdi_pago_detalles': {
+        'file': 'cfdi_pago_detalles.csv',
+        'dtypes': {'id': ID, 'cfdi_pago_id': ID, 'fecha_pago': TEXT, 'forma_pago_p': CAT, 'moneda_p': CAT, 'tipo_cambio_p': NUM, 'monto': MONEY, 'num_operacion': TEXT},
+        'money': ['monto'],
+        'dates': ['fecha_pago'],
+        'usecols': ['id', 'cfdi_pago_id', 'fecha_pago', 'forma_pago_p', 'moneda_p', 'tipo_cambio_p', 'monto', 'num_operacion']
+    },
+    'cfdi_pago_documentos_relacionados': {
+        'file': 'cfdi_pago_documentos_relacionados.csv',
+        'dtypes': {
+            'id': ID, 'cfdi_pago_detalle_id': ID, 'id_documento': TEXT, 'cfdi_relacionado_id': OPT_ID,
+            'serie': CAT, 'folio': TEXT, 'moneda_dr': CAT, 'equivalencia_dr': NUM, 'num_parcialidad': OPT_ID,
+            'imp_saldo_ant': MONEY, 'imp_pagado': MONEY, 'imp_saldo_insoluto': MONEY, 'objeto_imp_dr': CAT
+        },
+        'money': ['imp_saldo_ant', 'imp_pagado', 'imp_saldo_insoluto'],
+        'usecols': ['id', 'cfdi_pago_detalle_id', 'id_documento', 'cfdi_relacionado_id', 'serie', 'folio', 'moneda_dr',
+                    'equivalencia_dr', 'num_parcialidad', 'imp_saldo_ant', 'imp_pagado', 'imp_saldo_insoluto', 'objeto_imp_dr']
+    },
+    'cfdi_pago_dr_impuestos': {
+        'file': 'cfdi_pago_dr_impuestos.csv',
+        'dtypes': {'id': ID, 'cfdi_pago_documento_relacionado_id': ID, 'base_dr': MONEY, 'impuesto_dr': CAT, 'tipo_factor_dr': CAT, 'tasa_o_cuota_dr': NUM, 'importe_dr': MONEY, 'tipo': CAT},
+        'money': ['base_dr', 'importe_dr'],
+        'usecols': ['id', 'cfdi_pago_documento_relacionado_id', 'base_dr', 'impuesto_dr', 'tipo_factor_dr', 'tasa_o_cuota_dr', 'importe_dr', 'tipo']
+    },
+    'cfdi_pago_totales': {
+        'file': 'cfdi_pago_totales.csv',
+        'dtypes': {
+            'id': ID, 'cfdi_pago_id': ID, 'total_retenciones_iva': MONEY, 'total_retenciones_isr': MONEY,
+            'total_retenciones_ieps': MONEY, 'total_traslados_base_iva16': MONEY, 'total_traslados_impuesto_iva16': MONEY,
+            'total_traslados_base_iva8': MONEY, 'total_traslados_impuesto_iva8': MONEY, 'total_traslados_base_iva0': MONEY,
+            'total_traslados_impuesto_iva0': MONEY, 'total_traslados_base_iva_exento': MONEY, 'monto_total_pagos': MONEY
+        },
+        'money': ['total_retenciones_iva', 'total_retenciones_isr', 'total_retenciones_ieps', 'total_traslados_base_iva16',
+                  'total_traslados_impuesto_iva16', 'total_traslados_base_iva8', 'total_traslados_impuesto_iva8',
+                  'total_traslados_base_iva0', 'total_traslados_impuesto_iva0', 'total_traslados_base_iva_exento', 'monto_total_pagos'],
+        'usecols': None
+    },
+    'cfdi_nominas': {
+        'file': 'cfdi_nominas.csv',
+        'dtypes': {
+            'id': ID, 'cfdi_id': ID, 'version': CAT, 'tipo_nomina': CAT, 'fecha_pago': TEXT,
+            'fecha_inicial_pago': TEXT, 'fecha_final_pago': TEXT, 'num_dias_pagados': NUM,
+            'total_percepciones': MONEY, 'total_deducciones': MONEY, 'total_otros_pagos': MONEY
+        },
+        'money': ['total_percepciones', 'total_deducciones', 'total_otros_pagos'],
+        'dates': ['fecha_pago', 'fecha_inicial_pago', 'fecha_final_pago'],
+        'usecols': ['id', 'cfdi_id', 'version', 'tipo_nomina', 'fecha_pago', 'fecha_inicial_pago', 'fecha_final_pago',
+                    'num_dias_pagados', 'total_percepciones', 'total_deducciones', 'total_otros_pagos']
+    },
+    'cfdi_nomina_percepciones': {
+        'file': 'cfdi_nomina_percepciones.csv',
+        'dtypes': {'id': ID, 'cfdi_nomina_id': ID, 'tipo_percepcion': CAT, 'clave': CAT, 'concepto': CAT, 'importe_gravado': MONEY, 'importe_exento': MONEY},
+        'money': ['importe_gravado', 'importe_exento'],
+        'usecols': ['id', 'cfdi_nomina_id', 'tipo_percepcion', 'clave', 'concepto', 'importe_gravado', 'importe_exento']
+    },
+    'cfdi_nomina_deducciones': {
+        'file': 'cfdi_nomina_deducciones.csv',
+        'dtypes': {'id': ID, 'cfdi_nomina_id': ID, 'tipo_deduccion': CAT, 'clave': CAT, 'concepto': CAT, 'importe': MONEY},
+        'money': ['importe'],
+        'usecols': ['id', 'cfdi_nomina_id', 'tipo_deduccion', 'clave', 'concepto', 'importe']
+    },
+    'cfdi_nomina_otros_pagos': {
+        'file': 'cfdi_nomina_otros_pagos.csv',
+        'dtypes': {'id': ID, 'cfdi_nomina_id': ID, 'tipo_otro_pago': CAT, 'clave': CAT, 'concepto': CAT, 'importe': MONEY, 'subsidio_causado': MONEY},
+        'money': ['importe', 'subsidio_causado'],
+        'usecols': ['id', 'cfdi_nomina_id', 'tipo_otro_pago', 'clave', 'concepto', 'importe', 'subsidio_causado']
+    },
+    'cfdi_nomina_receptores': {
+        'file': 'cfdi_nomina_receptores.csv',
+        'dtypes': {
+            'id': ID, 'cfdi_nomina_id': ID, 'curp': TEXT, 'num_seguridad_social': TEXT, 'fecha_inicio_rel_laboral': TEXT,
+            'antiguedad': TEXT, 'tipo_contrato': CAT, 'sindicalizado': CAT, 'tipo_jornada': CAT, 'tipo_regimen': CAT,
+            'num_empleado': TEXT, 'departamento': CAT, 'puesto': CAT, 'riesgo_puesto': CAT, 'periodicidad_pago': CAT,
+            'banco': CAT, 'salario_base_cot_apor': MONEY, 'salario_diario_integrado': MONEY, 'clave_ent_fed': CAT
+        },
+        'money': ['salario_base_cot_apor', 'salario_diario_integrado'],
+        # cuenta_bancaria is deliberately not loaded
+        'usecols': ['id', 'cfdi_nomina_id', 'curp', 'num_seguridad_social', 'fecha_inicio_rel_laboral', 'antiguedad',
+                    'tipo_contrato', 'sindicalizado', 'tipo_jornada', 'tipo_regimen', 'num_empleado', 'departamento',
+                    'puesto', 'riesgo_puesto', 'periodicidad_pago', 'banco', 'salario_base_cot_apor',
+                    'salario_diario_integrado', 'clave_ent_fed']
+    },
+    'cfdi_nomina_emisores': {
+        'file': 'cfdi_nomina_emisores.csv',
+        'dtypes': {'id': ID, 'cfdi_nomina_id': ID, 'curp': TEXT, 'registro_patronal': CAT, 'rfc_patron_origen': TEXT},
+        'money': [],
+        'usecols': ['id', 'cfdi_nomina_id', 'curp', 'registro_patronal', 'rfc_patron_origen']
+    },
+    'cfdi_nomina_horas_extra': {
+        'file': 'cfdi_nomina_horas_extra.csv',
+        'dtypes': {'id': ID, 'cfdi_nomina_id': ID, 'dias': NUM, 'tipo_horas': CAT, 'horas_extra': NUM, 'importe_pagado': MONEY},
+        'money': ['importe_pagado'],
+        'usecols': ['id', 'cfdi_nomina_id', 'dias', 'tipo_horas', 'horas_extra', 'importe_pagado']
+    },
+    'cfdi_nomina_incapacidades': {
+        'file': 'cfdi_nomina_incapacidades.csv',
+        'dtypes': {'id': ID, 'cfdi_nomina_id': ID, 'dias_incapacidad': NUM, 'tipo_incapacidad': CAT, 'importe_monetario': MONEY},
+        'money': ['importe_monetario'],
+        'usecols': ['id', 'cfdi_nomina_id', 'dias_incapacidad', 'tipo_incapacidad', 'importe_monetario']
+    },
+    'companies': {
+        'file': 'companies.csv',
+        'dtypes': {'id': ID, 'rfc': TEXT, 'razon_social': TEXT, 'nombre_comercial': TEXT, 'activo': CAT, 'plan': CAT, 'uuid': TEXT},
+        'money': [],
+        # certificado_* columns hold key material and are never loaded
+        'usecols': ['id', 'rfc', 'razon_social', 'nombre_comercial', 'activo', 'plan', 'uuid', 'deleted_at']
+    }
+}
+
+
+def detect_encoding(path, block_size=1 << 20):
+    """Streams the raw bytes once through an incremental UTF-8 decoder; falls back to Latin-1."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    decoder.decode(b'', final=True)
+                    return 'utf-8'
+                decoder.decode(block)
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+
+def table_for_file(filename):
+    """Maps a CSV filename (e.g. 'cfdis.csv') to its registry key, or None if unregistered."""
+    table = os.path.splitext(os.path.basename(filename))[0]
+    return table if table in TABLE_SCHEMAS else None
+
+
+def parse_money(series):
+    """Parses money text such as '$1,234.50' into float64."""
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype(float)
+    return pd.to_numeric(series.astype(str).str.replace(r'[$,\s]', '', regex=True), errors='coerce')
+
+
+def _read_options(table, path, encoding, usecols, relaxed=False):
+    schema = TABLE_SCHEMAS[table]
+    header = pd.read_csv(path, encoding=encoding, nrows=0).columns
+    wanted = usecols if usecols is not None else schema.get('usecols')
+    cols = [c for c in header if wanted is None or c in wanted]
+
+    dtypes = {c: t for c, t in schema['dtypes'].items() if c in cols}
+    if relaxed:
+        # Tolerant pass: nullable ints and money as text (cleaned afterwards)
+        dtypes = {c: ('Int64' if t == ID else t) for c, t in dtypes.items()}
+        for c in schema.get('money', []):
+            if c in dtypes:
+                dtypes[c] = TEXT
+    return {'usecols': cols, 'dtype': dtypes}
+
+
+def _finish(frame, table, relaxed):
+    if relaxed:
+        for c in TABLE_SCHEMAS[table].get('money', []):
+            if c in frame.columns:
+                frame[c] = parse_money(frame[c])
+    return frame
+
+
+def _iter_chunks(table, path, encoding, usecols, chunksize):
+    """Chunked reader that switches to the tolerant dtypes at the first chunk that fails to parse."""
+    consumed = 0
+    relaxed = False
+    while True:
+        opts = _read_options(table, path, encoding, usecols, relaxed=relaxed)
+        skip = range(1, consumed + 1) if consumed else None
+        try:
+            with pd.read_csv(path, encoding=encoding, chunksize=chunksize, skiprows=skip, **opts) as reader:
+                for chunk in reader:
+                    consumed += len(chunk)
+                    yield _finish(chunk, table, relaxed)
+            return
+        except (ValueError, TypeError) as e:
+            if relaxed:
+                raise
+            logging.warning(f"{TABLE_SCHEMAS[table]['file']}: strict dtypes failed after {consumed} rows ({e}); continuing with tolerant parsing")
+            relaxed = True
+
+
+def read_table(table, data_dir, usecols=None, chunksize=None):
+    """
+    Reads a lake table with its registered dtypes. Returns a DataFrame (or a chunk iterator
+    when `chunksize` is given), or None if the file does not exist.
+    """
+    schema = TABLE_SCHEMAS[table]
+    path = os.path.join(data_dir, schema['file'])
+    if not os.path.exists(path):
+        logging.error(f"File not found: {path}")
+        return None
+
+    encoding = detect_encoding(path)
+    if chunksize:
+        return _iter_chunks(table, path, encoding, usecols, chunksize)
+
+    try:
+        return pd.read_csv(path, encoding=encoding, **_read_options(table, path, encoding, usecols))
+    except (ValueError, TypeError) as e:
+        logging.warning(f"{schema['file']}: strict dtypes failed ({e}); retrying with tolerant parsing")
+        frame = pd.read_csv(path, encoding=encoding, **_read_options(table, path, encoding, usecols, relaxed=True))
+        return _finish(frame, table, relaxed=True)
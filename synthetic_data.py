@@ -0,0 +1,425 @@
+"""
+Synthetic CFDI lake generator for scale tests and benchmarks.
+
+Writes the same CSV tables the Laravel exports provide (column order from xml_ingest) with
+referentially consistent ids, for any number of invoices (10K to 10M):
+
+  - cfdis + timbres, emisor / receptor catalogs with Zipf-like supplier and client popularity
+  - conceptos with line taxes (IVA 16/8/0 %, occasional IVA/ISR retentions) whose sums are
+    the invoice-level comprobante taxes, so subtotal + traslados - retenciones = total
+  - PPD invoices settled (fully, partially or not at all) by tipo 'P' payment complements
+  - tipo 'N' payroll receipts for a fixed staff, with percepciones, ISR/IMSS deducciones and
+    subsidio
+
+Invoices are generated and appended in chunks, so memory stays flat whatever the scale.
+"""
+import os
+import csv
+import time
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from xml_ingest import TABLE_COLUMNS
+
+# Setup Logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Load Environment Variables
+load_dotenv()
+
+# Configuration
+SYNTH_CHUNK = int(os.getenv("SYNTH_CHUNK", 200000))   # Invoices generated and appended at a time
+SYNTH_SEED = int(os.getenv("SYNTH_SEED", 42))
+
+TENANT_RFC = 'SYN010101AB1'
+TENANT_NAME = 'EMPRESA SINTETICA SA DE CV'
+TIPOS = np.array(['I', 'E', 'P', 'N'])
+TIPO_WEIGHTS = [0.80, 0.05, 0.08, 0.07]
+IVA_RATES = np.array([0.16, 0.08, 0.0])
+IVA_WEIGHTS = [0.86, 0.04, 0.10]
+USOS_CFDI = np.array(['G03', 'G01', 'I04', 'G02', 'S01', 'CP01', 'CN01'])
+FORMAS_PAGO = np.array(['03', '04', '28', '01', '99'])
+CLAVES_PROD = np.array(['43232403', '82101603', '81112100', '80141600', '84111506', '78101800', '50202306', '15101514'])
+UNIDADES = np.array(['E48', 'H87', 'ACT', 'KGM', 'LTR'])
+DEPARTAMENTOS = np.array(['ADMINISTRACION', 'VENTAS', 'OPERACIONES', 'SOPORTE TECNICO', 'CONTABILIDAD'])
+RET_IVA_RATE = 0.106666
+RET_ISR_RATE = 0.10
+ALPHANUM = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'))
+LETTERS = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+
+
+# --- Helpers ---
+
+def random_strings(rng, n, length, alphabet=ALPHANUM):
+    """n random strings of `length` characters."""
+    if n == 0:
+        return np.array([], dtype=object)
+    chars = rng.choice(alphabet, size=(n, length))
+    return np.array([''.join(row) for row in chars], dtype=object)
+
+
+def random_uuids(rng, n):
+    """n random version-4 style UUIDs."""
+    hexes = rng.bytes(16 * n).hex()
+    return np.array([f"{h[:8]}-{h[8:12]}-4{h[13:16]}-a{h[17:20]}-{h[20:32]}"
+                     for h in (hexes[i:i + 32] for i in range(0, 32 * n, 32))], dtype=object)
+
+
+def zipf_choice(rng, n_items, size, exponent=1.1, offset=1):
+    """Ids offset..offset+n_items-1 drawn with Zipf-like popularity (a few very frequent)."""
+    weights = 1.0 / np.arange(1, n_items + 1) ** exponent
+    return rng.choice(n_items, size=size, p=weights / weights.sum()) + offset
+
+
+def money(values):
+    return np.round(values, 2)
+
+
+def fmt_dates(values, fmt='%Y-%m-%d %H:%M:%S'):
+    return pd.DatetimeIndex(values).strftime(fmt)
+
+
+def write_table(out_dir, table, frame, header):
+    """Appends a frame to <table>.csv with the export's column order (missing columns empty)."""
+    columns = TABLE_COLUMNS.get(table, list(frame.columns))
+    frame = frame.reindex(columns=columns)
+    frame.to_csv(os.path.join(out_dir, f"{table}.csv"), mode='w' if header else 'a', header=header,
+                 index=False, quoting=csv.QUOTE_MINIMAL)
+
+
+def spread(counts):
+    """(owner position per child, child position within its owner) for per-owner child counts."""
+    owners = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    return owners, np.arange(counts.sum()) - starts[owners]
+
+
+# --- Catalogs ---
+
+def build_parties(rng, n_emisors, n_receptors, n_employees, now):
+    """Emisor / receptor catalogs. Id 1 is the tenant in both; receptors 2.. are the employees."""
+    emisor_rfc = random_strings(rng, n_emisors, 3, LETTERS) + random_strings(rng, n_emisors, 9)
+    emisor_rfc[0] = TENANT_RFC
+    emisors = pd.DataFrame({
+        'id': np.arange(1, n_emisors + 1),
+        'rfc': emisor_rfc,
+        'nombre': [TENANT_NAME] + [f"PROVEEDOR {i:06d} SA DE CV" for i in range(2, n_emisors + 1)],
+        'regimen_fiscal': rng.choice(['601', '612', '626'], n_emisors, p=[0.8, 0.1, 0.1]),
+        'created_at': now, 'updated_at': now
+    })
+    # Employees are people: 13-character RFC and a CURP
+    rfc = random_strings(rng, n_receptors, 3, LETTERS) + random_strings(rng, n_receptors, 9)
+    people = (np.arange(n_receptors) >= 1) & (np.arange(n_receptors) <= n_employees)
+    rfc[people] = random_strings(rng, int(people.sum()), 4, LETTERS) + random_strings(rng, int(people.sum()), 9)
+    rfc[0] = TENANT_RFC
+    curp = np.full(n_receptors, None, dtype=object)
+    curp[1:n_employees + 1] = random_strings(rng, n_employees, 18)
+    names = np.array([f"CLIENTE {i:06d} SA DE CV" for i in range(1, n_receptors + 1)], dtype=object)
+    names[1:n_employees + 1] = [f"EMPLEADO {i:05d}" for i in range(1, n_employees + 1)]
+    names[0] = TENANT_NAME
+    receptors = pd.DataFrame({
+        'id': np.arange(1, n_receptors + 1),
+        'rfc': rfc,
+        'nombre': names,
+        'domicilio_fiscal_cp': rng.integers(1000, 99999, n_receptors).astype(str),
+        'regimen_fiscal': np.where(people, '605', '601'),
+        'curp': curp,
+        'created_at': now, 'updated_at': now
+    })
+    return emisors, receptors
+
+
+def build_staff(rng, n_employees):
+    """Fixed payroll staff: receptor id, CURP position, daily salary and department."""
+    return pd.DataFrame({
+        'receptor_id': np.arange(2, n_employees + 2),
+        'num_empleado': [f"{i:04d}" for i in range(1, n_employees + 1)],
+        'departamento': rng.choice(DEPARTAMENTOS, n_employees),
+        'salario_diario': money(rng.lognormal(6.0, 0.5, n_employees)),
+        'fecha_inicio': fmt_dates(pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 3000, n_employees), unit='D'), '%Y-%m-%d')
+    })
+
+
+# --- Invoices ---
+
+def build_chunk(rng, first_id, n, ids, staff, n_emisors, n_receptors, start, days, company_id, now):
+    """
+    One chunk of invoices and all their child rows. `ids` holds the next id of every child
+    table and is advanced in place. Returns {table: frame}.
+    """
+    tipo = rng.choice(TIPOS, n, p=TIPO_WEIGHTS)
+    is_i, is_e, is_p, is_n = (tipo == t for t in TIPOS)
+    cfdi_id = np.arange(first_id, first_id + n)
+    uuids = random_uuids(rng, n)
+
+    # Business hours most of the time, some late-night and weekend issuance
+    day = rng.integers(0, days, n)
+    hour = np.where(rng.random(n) < 0.93, rng.integers(8, 20, n), rng.integers(0, 24, n))
+    fecha = (start + pd.to_timedelta(day, unit='D') + pd.to_timedelta(hour, unit='h')
+             + pd.to_timedelta(rng.integers(0, 3600, n), unit='s')).to_numpy().copy()
+
+    # A third of the invoices are issued by the tenant (emitido), the rest received
+    emitido = (rng.random(n) < 0.33) | is_n
+    emisor_id = np.where(emitido, 1, zipf_choice(rng, n_emisors - 1, n, offset=2))
+    receptor_id = np.where(emitido, zipf_choice(rng, max(n_receptors - len(staff) - 1, 1), n, offset=len(staff) + 2), 1)
+
+    subtotal = np.where(rng.random(n) < 0.04, rng.integers(1, 50, n) * 1000.0, money(rng.lognormal(8.3, 1.3, n)))
+    descuento = np.where(rng.random(n) < 0.1, money(subtotal * rng.uniform(0, 0.1, n)), 0.0)
+    metodo = np.where(is_i | is_e, np.where(rng.random(n) < 0.1, 'PPD', 'PUE'), np.where(is_n, 'PUE', None)).astype(object)
+    cancelled = rng.random(n) < 0.02
+    frames = {}
+
+    # --- Conceptos and their taxes (I / E) ---
+    taxed = np.flatnonzero(is_i | is_e)
+    rate = rng.choice(IVA_RATES, len(taxed), p=IVA_WEIGHTS)
+    retained = rng.random(len(taxed)) < 0.05
+    n_lines = np.minimum(rng.geometric(0.55, len(taxed)), 8)
+    owner, _ = spread(n_lines)
+    weights = rng.random(owner.size) + 0.2
+    share = weights / np.bincount(owner, weights)[owner]
+    base = subtotal[taxed] - descuento[taxed]
+    importe = money(subtotal[taxed][owner] * share)
+    line_desc = money(descuento[taxed][owner] * share)
+    # Rounding leftovers go to the first line of each invoice
+    first = np.r_[0, np.cumsum(n_lines)[:-1]]
+    importe[first] += money(subtotal[taxed] - np.bincount(owner, importe, minlength=len(taxed)))
+    line_desc[first] += money(descuento[taxed] - np.bincount(owner, line_desc, minlength=len(taxed)))
+    line_base = importe - line_desc
+    mixed = rng.random(owner.size) < 0.03  # Some lines carry a different rate than the invoice
+    line_rate = np.where(mixed, rng.choice(IVA_RATES, owner.size), rate[owner])
+    line_iva = money(line_base * line_rate)
+    line_ret_iva = np.where(retained[owner], money(line_base * RET_IVA_RATE), 0.0)
+    line_ret_isr = np.where(retained[owner], money(line_base * RET_ISR_RATE), 0.0)
+    cantidad = rng.integers(1, 11, owner.size).astype(float)
+
+    concepto_id = np.arange(ids['cfdi_conceptos'], ids['cfdi_conceptos'] + owner.size)
+    ids['cfdi_conceptos'] += owner.size
+    frames['cfdi_conceptos'] = pd.DataFrame({
+        'id': concepto_id, 'cfdi_id': cfdi_id[taxed][owner],
+        'clave_prod_serv': rng.choice(CLAVES_PROD, owner.size), 'cantidad': cantidad,
+        'clave_unidad': rng.choice(UNIDADES, owner.size), 'unidad': 'Servicio',
+        'descripcion': [f"Concepto {c}" for c in rng.integers(1, 500, owner.size)],
+        'valor_unitario': np.round(importe / cantidad, 6), 'importe': importe, 'descuento': line_desc,
+        'objeto_impuesto': '02', 'created_at': now, 'updated_at': now
+    })
+    ci_id = np.arange(ids['cfdi_concepto_impuestos'], ids['cfdi_concepto_impuestos'] + owner.size)
+    ids['cfdi_concepto_impuestos'] += owner.size
+    frames['cfdi_concepto_impuestos'] = pd.DataFrame({'id': ci_id, 'cfdi_concepto_id': concepto_id, 'created_at': now, 'updated_at': now})
+    frames['cfdi_concepto_traslados'] = pd.DataFrame({
+        'id': np.arange(ids['cfdi_concepto_traslados'], ids['cfdi_concepto_traslados'] + owner.size),
+        'cfdi_concepto_impuestos_id': ci_id, 'base': line_base, 'impuesto': '002', 'tipo_factor': 'Tasa',
+        'tasa_o_cuota': line_rate, 'importe': line_iva, 'created_at': now, 'updated_at': now
+    })
+    ids['cfdi_concepto_traslados'] += owner.size
+    ret_lines = np.flatnonzero(retained[owner])
+    ret_owner = np.repeat(ret_lines, 2)
+    frames['cfdi_concepto_retenciones'] = pd.DataFrame({
+        'id': np.arange(ids['cfdi_concepto_retenciones'], ids['cfdi_concepto_retenciones'] + ret_owner.size),
+        'cfdi_concepto_impuestos_id': ci_id[ret_owner], 'base': line_base[ret_owner],
+        'impuesto': np.tile(['002', '001'], ret_lines.size), 'tipo_factor': 'Tasa',
+        'tasa_o_cuota': np.tile([RET_IVA_RATE, RET_ISR_RATE], ret_lines.size),
+        'importe': np.ravel(np.column_stack([line_ret_iva[ret_lines], line_ret_isr[ret_lines]])),
+        'created_at': now, 'updated_at': now
+    })
+    ids['cfdi_concepto_retenciones'] += ret_owner.size
+
+    # Invoice-level taxes are the sums of the line taxes
+    iva = money(np.bincount(owner, line_iva, minlength=len(taxed)))
+    ret_iva = money(np.bincount(owner, line_ret_iva, minlength=len(taxed)))
+    ret_isr = money(np.bincount(owner, line_ret_isr, minlength=len(taxed)))
+    imp_id = np.arange(ids['cfdi_comprobante_impuestos'], ids['cfdi_comprobante_impuestos'] + len(taxed))
+    ids['cfdi_comprobante_impuestos'] += len(taxed)
+    frames['cfdi_comprobante_impuestos'] = pd.DataFrame({
+        'id': imp_id, 'cfdi_id': cfdi_id[taxed], 'total_impuestos_trasladados': iva,
+        'total_impuestos_retenidos': np.where(retained, ret_iva + ret_isr, np.nan), 'created_at': now, 'updated_at': now
+    })
+    frames['cfdi_comprobante_traslados'] = pd.DataFrame({
+        'id': np.arange(ids['cfdi_comprobante_traslados'], ids['cfdi_comprobante_traslados'] + len(taxed)),
+        'cfdi_comprobante_impuestos_id': imp_id, 'impuesto': '002', 'tipo_factor': 'Tasa',
+        'tasa_o_cuota': rate, 'base': money(base), 'importe': iva, 'created_at': now, 'updated_at': now
+    })
+    ids['cfdi_comprobante_traslados'] += len(taxed)
+    ret_inv = np.repeat(np.flatnonzero(retained), 2)
+    frames['cfdi_comprobante_retenciones'] = pd.DataFrame({
+        'id': np.arange(ids['cfdi_comprobante_retenciones'], ids['cfdi_comprobante_retenciones'] + ret_inv.size),
+        'cfdi_comprobante_impuestos_id': imp_id[ret_inv], 'impuesto': np.tile(['002', '001'], ret_inv.size // 2),
+        'importe': np.ravel(np.column_stack([ret_iva[retained], ret_isr[retained]])), 'created_at': now, 'updated_at': now
+    })
+    ids['cfdi_comprobante_retenciones'] += ret_inv.size
+
+    total = np.zeros(n)
+    total[taxed] = money(base + iva - ret_iva - ret_isr)
+
+    # --- Payment complements (P) settling this chunk's PPD invoices ---
+    ppd = np.flatnonzero((metodo == 'PPD') & ~cancelled)
+    pays = np.flatnonzero(is_p)
+    paid = rng.choice(ppd, size=min(len(pays), len(ppd)), replace=False) if len(ppd) else np.array([], dtype=int)
+    pays = pays[:len(paid)]
+    subtotal[is_p] = descuento[is_p] = 0.0
+    metodo[is_p] = None
+    partial = rng.random(len(paid)) < 0.2
+    imp_pagado = np.where(partial, money(total[paid] * rng.uniform(0.2, 0.8, len(paid))), total[paid])
+    fecha_pago = fecha[paid] + pd.to_timedelta(rng.integers(1, 45, len(paid)), unit='D').to_numpy()
+    fecha[pays] = fecha_pago
+    pago_id = np.arange(ids['cfdi_pagos'], ids['cfdi_pagos'] + len(pays))
+    ids['cfdi_pagos'] += len(pays)
+    frames['cfdi_pagos'] = pd.DataFrame({'id': pago_id, 'cfdi_id': cfdi_id[pays], 'version': '2.0', 'created_at': now, 'updated_at': now})
+    detalle_id = np.arange(ids['cfdi_pago_detalles'], ids['cfdi_pago_detalles'] + len(pays))
+    ids['cfdi_pago_detalles'] += len(pays)
+    frames['cfdi_pago_detalles'] = pd.DataFrame({
+        'id': detalle_id, 'cfdi_pago_id': pago_id, 'fecha_pago': fmt_dates(fecha_pago),
+        'forma_pago_p': rng.choice(FORMAS_PAGO[:3], len(pays)), 'moneda_p': 'MXN', 'tipo_cambio_p': 1.0,
+        'monto': imp_pagado, 'created_at': now, 'updated_at': now
+    })
+    # Payment complements often carry the related UUID upper-cased
+    id_documento = uuids[paid].copy()
+    upper = rng.random(len(paid)) < 0.3
+    id_documento[upper] = [u.upper() for u in id_documento[upper]]
+    frames['cfdi_pago_documentos_relacionados'] = pd.DataFrame({
+        'id': np.arange(ids['cfdi_pago_documentos_relacionados'], ids['cfdi_pago_documentos_relacionados'] + len(pays)),
+        'cfdi_pago_detalle_id': detalle_id, 'id_documento': id_documento, 'cfdi_relacionado_id': cfdi_id[paid],
+        'moneda_dr': 'MXN', 'equivalencia_dr': 1.0, 'num_parcialidad': 1, 'imp_saldo_ant': total[paid],
+        'imp_pagado': imp_pagado, 'imp_saldo_insoluto': money(total[paid] - imp_pagado), 'objeto_imp_dr': '02',
+        'created_at': now, 'updated_at': now
+    })
+    ids['cfdi_pago_documentos_relacionados'] += len(pays)
+
+    # --- Payroll receipts (N): biweekly periods for the fixed staff ---
+    nom = np.flatnonzero(is_n)
+    employee = rng.integers(0, len(staff), len(nom))
+    receptor_id[nom] = staff['receptor_id'].to_numpy()[employee]
+    fin = pd.DatetimeIndex(fecha[nom]).normalize()
+    fin = fin - pd.to_timedelta(np.where(fin.day > 15, fin.day - 15, fin.day), unit='D')
+    dias = np.full(len(nom), 15.0)
+    sueldo = money(staff['salario_diario'].to_numpy()[employee] * dias)
+    exento = np.where(rng.random(len(nom)) < 0.3, money(sueldo * 0.05), 0.0)
+    isr = money(np.maximum(sueldo - 4000, 0) * 0.12)
+    imss = money(sueldo * 0.025)
+    subsidio = np.where(sueldo < 4000, 200.0, 0.0)
+    subtotal[nom] = money(sueldo + exento + subsidio)
+    descuento[nom] = money(isr + imss)
+    total[nom] = money(subtotal[nom] - descuento[nom])
+    nomina_id = np.arange(ids['cfdi_nominas'], ids['cfdi_nominas'] + len(nom))
+    ids['cfdi_nominas'] += len(nom)
+    frames['cfdi_nominas'] = pd.DataFrame({
+        'id': nomina_id, 'cfdi_id': cfdi_id[nom], 'version': '1.2', 'tipo_nomina': 'O',
+        'fecha_pago': fin.strftime('%Y-%m-%d'), 'fecha_inicial_pago': (fin - pd.Timedelta(days=14)).strftime('%Y-%m-%d'),
+        'fecha_final_pago': fin.strftime('%Y-%m-%d'), 'num_dias_pagados': dias,
+        'total_percepciones': money(sueldo + exento), 'total_deducciones': descuento[nom], 'total_otros_pagos': subsidio,
+        'created_at': now, 'updated_at': now
+    })
+    frames['cfdi_nomina_emisores'] = pd.DataFrame({
+        'id': np.arange(ids['cfdi_nomina_emisores'], ids['cfdi_nomina_emisores'] + len(nom)),
+        'cfdi_nomina_id': nomina_id, 'registro_patronal': 'Y0000000000', 'created_at': now, 'updated_at': now
+    })
+    ids['cfdi_nomina_emisores'] += len(nom)
+    frames['cfdi_nomina_receptores'] = pd.DataFrame({
+        'id': np.arange(ids['cfdi_nomina_receptores'], ids['cfdi_nomina_receptores'] + len(nom)),
+        'cfdi_nomina_id': nomina_id, 'curp': staff['curp'].to_numpy()[employee],
+        'fecha_inicio_rel_laboral': staff['fecha_inicio'].to_numpy()[employee], 'tipo_contrato': '01', 'sindicalizado': 'f',
+        'tipo_jornada': '01', 'tipo_regimen': '02', 'num_empleado': staff['num_empleado'].to_numpy()[employee],
+        'departamento': staff['departamento'].to_numpy()[employee], 'puesto': 'EMPLEADO', 'riesgo_puesto': '1',
+        'periodicidad_pago': '04', 'salario_base_cot_apor': staff['salario_diario'].to_numpy()[employee],
+        'salario_diario_integrado': staff['salario_diario'].to_numpy()[employee], 'clave_ent_fed': 'CMX',
+        'created_at': now, 'updated_at': now
+    })
+    ids['cfdi_nomina_receptores'] += len(nom)
+    frames['cfdi_nomina_percepciones'] = pd.DataFrame({
+        'id': np.arange(ids['cfdi_nomina_percepciones'], ids['cfdi_nomina_percepciones'] + len(nom)),
+        'cfdi_nomina_id': nomina_id, 'tipo_percepcion': '001', 'clave': '001', 'concepto': 'Sueldo',
+        'importe_gravado': sueldo, 'importe_exento': exento, 'created_at': now, 'updated_at': now
+    })
+    ids['cfdi_nomina_percepciones'] += len(nom)
+    ded_owner = np.repeat(np.arange(len(nom)), 2)
+    frames['cfdi_nomina_deducciones'] = pd.DataFrame({
+        'id': np.arange(ids['cfdi_nomina_deducciones'], ids['cfdi_nomina_deducciones'] + ded_owner.size),
+        'cfdi_nomina_id': nomina_id[ded_owner], 'tipo_deduccion': np.tile(['002', '001'], len(nom)),
+        'clave': np.tile(['045', '052'], len(nom)), 'concepto': np.tile(['ISR', 'I.M.S.S.'], len(nom)),
+        'importe': np.ravel(np.column_stack([isr, imss])), 'created_at': now, 'updated_at': now
+    })
+    ids['cfdi_nomina_deducciones'] += ded_owner.size
+    sub = np.flatnonzero(subsidio > 0)
+    frames['cfdi_nomina_otros_pagos'] = pd.DataFrame({
+        'id': np.arange(ids['cfdi_nomina_otros_pagos'], ids['cfdi_nomina_otros_pagos'] + sub.size),
+        'cfdi_nomina_id': nomina_id[sub], 'tipo_otro_pago': '002', 'clave': '035', 'concepto': 'Subsidio al empleo',
+        'importe': subsidio[sub], 'subsidio_causado': subsidio[sub], 'created_at': now, 'updated_at': now
+    })
+    ids['cfdi_nomina_otros_pagos'] += sub.size
+
+    # --- Invoices and timbres ---
+    fecha_txt = fmt_dates(fecha)
+    frames['cfdis'] = pd.DataFrame({
+        'id': cfdi_id, 'company_id': company_id, 'uuid': uuids, 'direccion': np.where(emitido, 'emitido', 'recibido'),
+        'tipo': tipo, 'serie': rng.choice(['A', 'B', 'FAC', 'NOM'], n), 'folio': rng.integers(1, 10 ** 7, n),
+        'fecha_emision': fecha_txt, 'version': '4.0', 'subtotal': money(subtotal), 'descuento': money(descuento),
+        'total': money(total), 'moneda': 'MXN', 'tipo_cambio': 1.0,
+        'forma_pago': np.where(metodo == 'PUE', rng.choice(FORMAS_PAGO, n), np.where(metodo == 'PPD', '99', None)),
+        'metodo_pago': metodo, 'exportacion': '01', 'lugar_expedicion': rng.integers(1000, 99999, n).astype(str),
+        'emisor_id': emisor_id, 'receptor_id': receptor_id,
+        'receptor_uso_cfdi': np.where(is_n, 'CN01', np.where(tipo == 'P', 'CP01', rng.choice(USOS_CFDI[:5], n))),
+        'xml_size': rng.integers(3000, 12000, n), 'cancelado': np.where(cancelled, 't', 'f'),
+        'fecha_cancelacion': np.where(cancelled, fecha_txt, None), 'motivo_cancelacion': np.where(cancelled, '02', None),
+        'estatus': np.where(cancelled, 'cancelado', 'vigente'), 'created_at': fecha_txt, 'updated_at': fecha_txt,
+        'source': 'synthetic'
+    })
+    frames['timbre_fiscal_digitales'] = pd.DataFrame({
+        'id': cfdi_id, 'cfdi_id': cfdi_id, 'version': '1.1', 'uuid': uuids,
+        'fecha_timbrado': fmt_dates(fecha + np.timedelta64(2, 'm')), 'rfc_prov_certif': 'SAT970701NN3',
+        'created_at': now, 'updated_at': now
+    })
+    return frames
+
+
+def generate(out_dir, invoices, seed=SYNTH_SEED, chunk=SYNTH_CHUNK, company_id=1, start='2024-01-01', months=24):
+    """
+    Writes a synthetic lake with `invoices` CFDIs to `out_dir` (existing tables are overwritten).
+    Returns {table: rows written}.
+    """
+    t0 = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    start = pd.Timestamp(start)
+    days = max((start + pd.DateOffset(months=months) - start).days, 1)
+
+    n_emisors = max(50, invoices // 200)
+    n_receptors = max(50, invoices // 100)
+    n_employees = max(10, min(invoices // 500, 20000))
+    emisors, receptors = build_parties(rng, n_emisors, n_receptors + n_employees + 1, n_employees, now)
+    staff = build_staff(rng, n_employees)
+    staff['curp'] = receptors['curp'].to_numpy()[1:n_employees + 1]
+
+    ids = {table: 1 for table in TABLE_COLUMNS}
+    counts = {}
+    for first_id in range(1, invoices + 1, chunk):
+        n = min(chunk, invoices - first_id + 1)
+        frames = build_chunk(rng, first_id, n, ids, staff, n_emisors, len(receptors), start, days, company_id, now)
+        for table, frame in frames.items():
+            write_table(out_dir, table, frame, header=table not in counts)
+            counts[table] = counts.get(table, 0) + len(frame)
+        logging.info(f"Synthetic lake: {first_id + n - 1:,} / {invoices:,} invoices")
+
+    write_table(out_dir, 'cfdi_emisors', emisors, header=True)
+    write_table(out_dir, 'cfdi_receptors', receptors, header=True)
+    pd.DataFrame({'id': [company_id], 'rfc': [TENANT_RFC], 'razon_social': [TENANT_NAME], 'activo': ['t'],
+                  'created_at': [now], 'updated_at': [now]}).to_csv(os.path.join(out_dir, 'companies.csv'), index=False)
+    counts.update(cfdi_emisors=len(emisors), cfdi_receptors=len(receptors), companies=1)
+    logging.info(f"Synthetic lake: {invoices:,} invoices, {counts['cfdi_conceptos']:,} conceptos written to {out_dir} "
+                 f"in {time.perf_counter() - t0:.1f} s")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic CFDI lake generator")
+    parser.add_argument("out_dir", help="Directory the CSV tables are written to")
+    parser.add_argument("--invoices", type=int, default=10000, help="Number of CFDIs (10K to 10M)")
+    parser.add_argument("--seed", type=int, default=SYNTH_SEED, help="Random seed (same seed = same lake)")
+    parser.add_argument("--chunk", type=int, default=SYNTH_CHUNK, help="Invoices generated per chunk")
+    parser.add_argument("--company-id", default=1, help="cfdis.company_id of the generated tenant")
+    parser.add_argument("--start", default='2024-01-01', help="First fecha_emision")
+    parser.add_argument("--months", type=int, default=24, help="Months covered by the invoices")
+    args = parser.parse_args()
+    generate(args.out_dir, args.invoices, args.seed, args.chunk, args.company_id, args.start, args.months)
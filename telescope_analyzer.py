@@ -0,0 +1,226 @@
+"""
+Slow-query analyzer for the Laravel Telescope export (telescope_entries.csv) of the upstream
+backend that feeds the lake.
+
+  - The CSV is read in chunks; only the 'query' entries are kept and their JSON `content` is
+    parsed in a process pool, so memory stays flat whatever the export size.
+  - Every SQL statement is reduced to a fingerprint: literals become ?, IN / VALUES lists
+    collapse to a single placeholder group, quoted identifiers and whitespace are normalized.
+  - The report gives calls, total time and p50/p95/p99 latency per fingerprint and per
+    batch_id (one Telescope batch = one request / job), plus the N+1 candidates: the same
+    fingerprint repeated at least N_PLUS_ONE_THRESHOLD times inside a single batch.
+"""
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import logging
+import multiprocessing
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+# Setup Logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Load Environment Variables
+load_dotenv()
+
+# Configuration
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+TELESCOPE_WORKERS = int(os.getenv("TELESCOPE_WORKERS", os.cpu_count() or 1))
+TELESCOPE_CHUNKSIZE = int(os.getenv("TELESCOPE_CHUNKSIZE", 5000))      # CSV rows read (and handed to a worker) at a time
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", 5))       # Repeats of a fingerprint in one batch
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 100))                 # Used when the entry has no `slow` flag
+
+ENTRY_COLUMNS = ['sequence', 'batch_id', 'type', 'content', 'created_at']
+QUERY_COLUMNS = ['sequence', 'batch_id', 'created_at', 'fingerprint', 'sql', 'time_ms', 'slow', 'connection', 'location']
+PERCENTILES = [0.5, 0.95, 0.99]
+
+STRING_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.IGNORECASE)
+IDENTIFIER_RE = re.compile(r'[`"]([^`"]+)[`"]')
+PLACEHOLDER_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+GROUP_LIST_RE = re.compile(r"\(\?\+\)(?:\s*,\s*\(\?\+\))+")
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """Fingerprint text of a statement: same shape, literals and list lengths stripped."""
+    text = STRING_RE.sub('?', sql or '')
+    text = IDENTIFIER_RE.sub(r'\1', text)
+    text = NUMBER_RE.sub('?', text)
+    text = WHITESPACE_RE.sub(' ', text).strip().lower()
+    text = PLACEHOLDER_LIST_RE.sub('(?+)', text)
+    return GROUP_LIST_RE.sub('(?+)+', text)
+
+
+def fingerprint(normalized):
+    return hashlib.md5(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+def parse_chunk(rows):
+    """
+    Worker: (sequence, batch_id, created_at, content) tuples of query entries -> list of
+    QUERY_COLUMNS tuples. Entries with unparseable content are dropped.
+    """
+    out = []
+    for sequence, batch_id, created_at, content in rows:
+        try:
+            entry = json.loads(content)
+        except (TypeError, ValueError):
+            continue
+        normalized = normalize_sql(entry.get('sql'))
+        try:
+            time_ms = float(entry.get('time'))
+        except (TypeError, ValueError):
+            time_ms = np.nan
+        slow = entry.get('slow')
+        if slow is None:
+            slow = time_ms >= SLOW_QUERY_MS
+        location = f"{entry['file']}:{entry.get('line')}" if entry.get('file') else None
+        out.append((sequence, batch_id, created_at, fingerprint(normalized), normalized, time_ms,
+                    bool(slow), entry.get('connection'), location))
+    return out
+
+
+def iter_query_chunks(path, chunksize=TELESCOPE_CHUNKSIZE):
+    """Streams the export and yields the query entries of each chunk as plain tuples."""
+    for chunk in pd.read_csv(path, usecols=ENTRY_COLUMNS, dtype=str, chunksize=chunksize, keep_default_na=False):
+        queries = chunk[chunk['type'] == 'query']
+        if not queries.empty:
+            yield list(zip(pd.to_numeric(queries['sequence'], errors='coerce'), queries['batch_id'],
+                           queries['created_at'], queries['content']))
+
+
+def load_queries(path, workers=TELESCOPE_WORKERS, chunksize=TELESCOPE_CHUNKSIZE):
+    """One row per query entry (QUERY_COLUMNS), parsed in `workers` processes."""
+    rows = []
+    if workers <= 1:
+        for chunk in iter_query_chunks(path, chunksize):
+            rows.extend(parse_chunk(chunk))
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes=workers) as pool:
+            for part in pool.imap(parse_chunk, iter_query_chunks(path, chunksize)):
+                rows.extend(part)
+    queries = pd.DataFrame.from_records(rows, columns=QUERY_COLUMNS)
+    queries['time_ms'] = queries['time_ms'].astype(float)
+    queries['slow'] = queries['slow'].astype(bool)
+    return queries
+
+
+def latency_stats(queries, keys):
+    """calls, total/mean/max time, p50/p95/p99 and slow calls per `keys` group."""
+    grouped = queries.groupby(keys, sort=False)
+    stats = grouped.agg(calls=('time_ms', 'size'), total_ms=('time_ms', 'sum'), mean_ms=('time_ms', 'mean'),
+                        max_ms=('time_ms', 'max'), slow=('slow', 'sum'))
+    quantiles = grouped['time_ms'].quantile(PERCENTILES).unstack()
+    quantiles.columns = [f'p{int(q * 100)}_ms' for q in PERCENTILES]
+    return stats.join(quantiles)
+
+
+def by_fingerprint(queries):
+    """Per-fingerprint report, slowest total first, with a sample statement and its call site."""
+    if queries.empty:
+        return pd.DataFrame()
+    stats = latency_stats(queries, 'fingerprint')
+    first = queries.drop_duplicates('fingerprint').set_index('fingerprint')
+    stats['batches'] = queries.groupby('fingerprint')['batch_id'].nunique()
+    stats['sql'] = first['sql']
+    stats['location'] = first['location']
+    stats['share'] = stats['total_ms'] / stats['total_ms'].sum()
+    return stats.sort_values('total_ms', ascending=False)
+
+
+def by_batch(queries):
+    """Per-batch report: query latency plus the number of distinct fingerprints."""
+    if queries.empty:
+        return pd.DataFrame()
+    stats = latency_stats(queries, 'batch_id')
+    stats['fingerprints'] = queries.groupby('batch_id')['fingerprint'].nunique()
+    stats['started_at'] = queries.groupby('batch_id')['created_at'].min()
+    return stats.sort_values('total_ms', ascending=False)
+
+
+def n_plus_one(queries, threshold=N_PLUS_ONE_THRESHOLD):
+    """
+    Fingerprints executed at least `threshold` times inside one batch: the per-row lookups
+    of an N+1 loop. One row per (batch_id, fingerprint), most repeated first.
+    """
+    if queries.empty:
+        return pd.DataFrame()
+    stats = latency_stats(queries, ['batch_id', 'fingerprint'])
+    stats = stats[stats['calls'] >= threshold].reset_index()
+    first = queries.drop_duplicates('fingerprint').set_index('fingerprint')
+    stats['sql'] = stats['fingerprint'].map(first['sql'])
+    stats['location'] = stats['fingerprint'].map(first['location'])
+    return stats.sort_values(['calls', 'total_ms'], ascending=False).reset_index(drop=True)
+
+
+def analyze(path, workers=TELESCOPE_WORKERS, chunksize=TELESCOPE_CHUNKSIZE, threshold=N_PLUS_ONE_THRESHOLD):
+    """Returns {'queries', 'fingerprints', 'batches', 'n_plus_one', 'seconds'}."""
+    start = time.perf_counter()
+    queries = load_queries(path, workers, chunksize)
+    report = {
+        'queries': queries,
+        'fingerprints': by_fingerprint(queries),
+        'batches': by_batch(queries),
+        'n_plus_one': n_plus_one(queries, threshold)
+    }
+    report['seconds'] = time.perf_counter() - start
+    logging.info(f"Telescope: {len(queries)} queries, {len(report['fingerprints'])} fingerprints, "
+                 f"{len(report['batches'])} batches, {len(report['n_plus_one'])} N+1 candidates "
+                 f"in {report['seconds']:.2f} s with {workers} workers")
+    return report
+
+
+def print_report(report, top=15, threshold=N_PLUS_ONE_THRESHOLD):
+    fingerprints, batches, suspects = report['fingerprints'], report['batches'], report['n_plus_one']
+    columns = ['calls', 'total_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'slow']
+    with pd.option_context('display.width', 200, 'display.max_colwidth', 90, 'display.float_format', '{:,.2f}'.format):
+        print(f"\n=== Top {top} fingerprints by total time ===")
+        if not fingerprints.empty:
+            print(fingerprints[columns + ['batches']].head(top).to_string())
+            print()
+            for fp, row in fingerprints.head(top).iterrows():
+                print(f"{fp}  {row['sql'][:150]}")
+        print(f"\n=== Top {top} batches by query time ===")
+        if not batches.empty:
+            print(batches[columns + ['fingerprints', 'started_at']].head(top).to_string())
+        print(f"\n=== N+1 candidates (>= {threshold} calls per batch) ===")
+        if suspects.empty:
+            print("none")
+        else:
+            print(suspects[['batch_id', 'fingerprint', 'calls', 'total_ms', 'p95_ms', 'location']].head(top).to_string(index=False))
+
+
+def write_report(report, output_dir):
+    """Writes the three reports as CSV files under `output_dir`."""
+    os.makedirs(output_dir, exist_ok=True)
+    report['fingerprints'].to_csv(os.path.join(output_dir, 'telescope_fingerprints.csv'))
+    report['batches'].to_csv(os.path.join(output_dir, 'telescope_batches.csv'))
+    report['n_plus_one'].to_csv(os.path.join(output_dir, 'telescope_n_plus_one.csv'), index=False)
+    logging.info(f"Telescope reports written to {output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Slow-query analyzer for telescope_entries.csv")
+    parser.add_argument("--path", default=os.path.join(DATA_DIR, "telescope_entries.csv"), help="Telescope entries export")
+    parser.add_argument("--workers", type=int, default=TELESCOPE_WORKERS, help="JSON parser processes")
+    parser.add_argument("--chunk-size", type=int, default=TELESCOPE_CHUNKSIZE, help="CSV rows per chunk")
+    parser.add_argument("--threshold", type=int, default=N_PLUS_ONE_THRESHOLD, help="Calls per batch flagged as N+1")
+    parser.add_argument("--top", type=int, default=15, help="Rows shown per section")
+    parser.add_argument("--output-dir", help="Also write the reports as CSV files here")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        logging.error(f"{args.path} not found")
+        sys.exit(1)
+    report = analyze(args.path, args.workers, args.chunk_size, args.threshold)
+    print_report(report, args.top, args.threshold)
+    if args.output_dir:
+        write_report(report, args.output_dir)
@@ -0,0 +1,202 @@
+"""
+Multi-tenant migration runner: executes migration.main for many tenants in a process pool.
+
+Each tenant runs in its own spawned process with its own environment (COMPANY_ID, DATA_DIR,
+SOURCE_COMPANY_ID, MONGO_URI, ...), so module-level configuration, memory and failures never
+leak between tenants. A tenant whose process crashes or exceeds TENANT_TIMEOUT_S is reported
+as failed without stopping the others.
+
+Tenant data is resolved as:
+  - <tenants-root>/<company_id>/ if that directory exists (one CSV lake per tenant), else
+  - the shared DATA_DIR filtered on cfdis.company_id (companies.csv tenants).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import traceback
+import multiprocessing
+from dotenv import load_dotenv
+
+import schema_registry
+
+# Setup Logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Load Environment Variables
+load_dotenv()
+
+# Configuration
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+TENANTS_ROOT = os.getenv("TENANTS_ROOT")
+TENANT_WORKERS = int(os.getenv("TENANT_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+TENANT_TIMEOUT_S = float(os.getenv("TENANT_TIMEOUT_S", 6 * 3600))  # 0 = no limit
+
+
+def tenants_from_companies(data_dir=DATA_DIR):
+    """Active, non-deleted companies from companies.csv as tenant specs (company_id = companies.id)."""
+    companies = schema_registry.read_table('companies', data_dir)
+    if companies is None:
+        return []
+    if 'deleted_at' in companies.columns:
+        companies = companies[companies['deleted_at'].isna()]
+    if 'activo' in companies.columns:
+        companies = companies[companies['activo'].astype(str).str.lower().isin(['1', 'true', 't', 'yes'])]
+    return [{'company_id': str(cid), 'source_company_id': str(cid)} for cid in companies['id']]
+
+
+def resolve_tenant(spec, tenants_root=TENANTS_ROOT, data_dir=DATA_DIR):
+    """Fills in the data dir of a tenant spec ({'company_id': ...} or a bare id string)."""
+    if isinstance(spec, str):
+        spec = {'company_id': spec}
+    spec = dict(spec)
+    if not spec.get('data_dir'):
+        own_dir = os.path.join(tenants_root, spec['company_id']) if tenants_root else None
+        if own_dir and os.path.isdir(own_dir):
+            spec['data_dir'] = own_dir
+        else:
+            spec['data_dir'] = data_dir
+            spec.setdefault('source_company_id', spec['company_id'])
+    return spec
+
+
+def run_tenant(spec, options):
+    """
+    Worker entry point (runs inside the child process). Configures the environment for one
+    tenant, then imports and runs the migration. Returns a result dict, never raises.
+    """
+    company_id = spec['company_id']
+    env = {
+        'COMPANY_ID': company_id,
+        'DATA_DIR': spec['data_dir'],
+        'SOURCE_COMPANY_ID': spec.get('source_company_id') or '',
+        'MONGO_URI': spec.get('mongo_uri', options.get('mongo_uri')) or '',
+    }
+    if options.get('gold_dir'):
+        env['GOLD_DIR'] = options['gold_dir']
+    os.environ.update(env)
+
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - %(levelname)s - [{company_id}] %(message)s', force=True)
+
+    result = {'company_id': company_id, 'data_dir': spec['data_dir'], 'status': 'failed', 'seconds': 0.0, 'error': None}
+    start = time.perf_counter()
+    try:
+        import migration  # Imported after the environment is set: its config is read at import time
+        ok = migration.main(incremental=options.get('incremental', False),
+                            streaming=options.get('streaming', False),
+                            chunksize=options.get('chunksize') or migration.CHUNK_SIZE)
+        result['status'] = 'ok' if ok else 'failed'
+        if not ok:
+            result['error'] = 'migration aborted or load failed (see log)'
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+        result['traceback'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def _tenant_process(spec, options, conn):
+    """Child process body: runs one tenant and sends its result back to the runner."""
+    conn.send(run_tenant(spec, options))
+    conn.close()
+
+
+def _failed(spec, seconds, error):
+    return {'company_id': spec['company_id'], 'data_dir': spec['data_dir'], 'status': 'failed', 'seconds': seconds, 'error': error}
+
+
+def run_tenants(specs, workers=TENANT_WORKERS, timeout=TENANT_TIMEOUT_S, **options):
+    """
+    Runs the migration for every tenant spec with at most `workers` tenants in flight, each in
+    its own process. A tenant whose process dies without a result (OOM kill, segfault, os._exit)
+    or runs longer than `timeout` seconds (0 = no limit) is reported as failed; the others go on.
+    Returns the per-tenant results in the order the specs were given.
+    """
+    specs = [resolve_tenant(s) for s in specs]
+    if not specs:
+        logging.warning("No tenants to migrate.")
+        return []
+
+    logging.info(f"Migrating {len(specs)} tenants with {workers} workers...")
+    results = {}
+    queue = list(specs)
+    running = {}   # company_id -> (spec, process, result pipe, start time)
+    ctx = multiprocessing.get_context('spawn')
+    try:
+        while queue or running:
+            while queue and len(running) < max(1, workers):
+                spec = queue.pop(0)
+                reader, writer = ctx.Pipe(duplex=False)
+                process = ctx.Process(target=_tenant_process, args=(spec, options, writer), name=f"tenant-{spec['company_id']}")
+                process.start()
+                writer.close()  # The child holds its own end; EOF on the reader means it is gone
+                running[spec['company_id']] = (spec, process, reader, time.perf_counter())
+
+            for company_id, (spec, process, reader, started) in list(running.items()):
+                elapsed = time.perf_counter() - started
+                result = None
+                try:
+                    if reader.poll():
+                        result = reader.recv()
+                except (EOFError, OSError):
+                    pass  # Closed without a result: the exit code below tells why
+                if result is None and process.is_alive():
+                    if not timeout or elapsed < timeout:
+                        continue
+                    process.terminate()
+                    result = _failed(spec, elapsed, f"timed out after {timeout:.0f} s")
+                process.join()
+                reader.close()
+                if result is None:
+                    result = _failed(spec, elapsed, f"worker process exited with code {process.exitcode} without a result")
+                del running[company_id]
+                level = logging.INFO if result['status'] == 'ok' else logging.ERROR
+                logging.log(level, f"Tenant {result['company_id']}: {result['status']} in {result['seconds']:.1f} s" + (f" ({result['error']})" if result['error'] else ""))
+                results[company_id] = result
+            if running:
+                time.sleep(0.2)
+    finally:
+        for spec, process, reader, started in running.values():
+            process.terminate()
+            process.join()
+    return [results[s['company_id']] for s in specs]
+
+
+def print_report(results):
+    print("\n--- MULTI-TENANT MIGRATION REPORT ---")
+    for r in results:
+        print(f"{r['company_id']:<24} {r['status']:<7} {r['seconds']:8.1f} s  {r['error'] or ''}")
+    failed = [r for r in results if r['status'] != 'ok']
+    print(f"Tenants: {len(results)} | OK: {len(results) - len(failed)} | Failed: {len(failed)} | Total tenant time: {sum(r['seconds'] for r in results):.1f} s")
+    print("-------------------------------------\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-Tenant CFDI Migration Runner")
+    parser.add_argument("--tenants", nargs="*", default=[], help="Tenant company ids to migrate")
+    parser.add_argument("--companies", action="store_true", help="Migrate every active company in companies.csv")
+    parser.add_argument("--tenants-root", default=TENANTS_ROOT, help="Directory holding one CSV lake per tenant (<root>/<company_id>/)")
+    parser.add_argument("--workers", type=int, default=TENANT_WORKERS, help="Max tenants migrated concurrently")
+    parser.add_argument("--timeout", type=float, default=TENANT_TIMEOUT_S, help="Seconds before a tenant is stopped and reported as failed (0 = no limit)")
+    parser.add_argument("--incremental", action="store_true", help="Only reprocess CFDIs changed since each tenant's watermark")
+    parser.add_argument("--streaming", action="store_true", help="Bounded-memory chunked ingestion")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Rows per CSV chunk in streaming mode")
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI"), help="Target Mongo (omit for the local gold layer)")
+    parser.add_argument("--gold-dir", default=os.getenv("GOLD_DIR"), help="Shared local gold layer for all tenants")
+    parser.add_argument("--report", help="Write the per-tenant results to this JSON file")
+    args = parser.parse_args()
+
+    specs = list(args.tenants)
+    if args.companies:
+        specs.extend(tenants_from_companies())
+    specs = [resolve_tenant(s, tenants_root=args.tenants_root) for s in specs]
+
+    results = run_tenants(specs, workers=args.workers, timeout=args.timeout, incremental=args.incremental, streaming=args.streaming,
+                          chunksize=args.chunk_size, mongo_uri=args.mongo_uri, gold_dir=args.gold_dir)
+    print_report(results)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if results and all(r['status'] == 'ok' for r in results) else 1)
@@ -7,9 +7,14 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg')
+import email
+import tempfile
+import threading
+import socketserver
+import sqlite3
+
+import alert_outbox
+import forensics
 
 # Setup Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -56,23 +61,6 @@ def send_alert(subject, body, image_path=None):
     except Exception as e:
         logging.error(f"Failed to send real alert: {e}")
 
-def create_trend_chart(series, title, filename):
-    try:
-        plt.figure(figsize=(10, 6))
-        series.plot(kind='bar', color='#00f2ff', edgecolor='black')
-        plt.title(title, fontsize=14, fontweight='bold', color='black')
-        plt.ylabel('Volumen', fontsize=12)
-        plt.xlabel('Periodo (Mes)', fontsize=12)
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-        plt.tight_layout()
-        chart_path = os.path.join(os.getcwd(), filename)
-        plt.savefig(chart_path)
-        plt.close()
-        return chart_path
-    except Exception as e:
-        logging.error(f"Failed to create chart: {e}")
-        return None
-
 def run_test():
     logging.info("Starting Cancellation Spike Test...")
     
@@ -93,27 +81,15 @@ def run_test():
     df['fecha_dt'] = pd.to_datetime(df['fecha_emision'])
     df['month_year'] = df['fecha_dt'].dt.to_period('M')
     
-    alerts = []
-    
-    # Logic from migration.py
+    # Same engine as migration.py (forensics.SPIKE_RULES)
+    monthly = forensics.monthly_metrics(df)
+    logging.info(f"Monthly cancellations found:\n{monthly.groupby('month_year')['cancelaciones'].sum()}")
+    alerts, chart = forensics.spike_alerts(monthly)
+
     chart_to_send = None
-    if 'estatus' in df.columns:
-        cancelled_mask = df['estatus'].astype(str).str.lower().str.contains('cancel', na=False)
-        monthly_cancelled = df[cancelled_mask].groupby('month_year').size().sort_index()
-        
-        logging.info(f"Monthly cancellations found:\n{monthly_cancelled}")
-        
-        if not monthly_cancelled.empty:
-            cancelled_pct_change = monthly_cancelled.pct_change()
-            if not cancelled_pct_change.empty:
-                latest_cancel_change = cancelled_pct_change.iloc[-1]
-                logging.info(f"Latest change: {latest_cancel_change:.1%}")
-                
-                if latest_cancel_change > 0.20:
-                    alert_msg = f"Incremento Atípico de Cancelaciones Detectado: {latest_cancel_change:.1%} de aumento supera el límite del 20%."
-                    alerts.append(alert_msg)
-                    # Create chart for cancellation trend
-                    chart_to_send = create_trend_chart(monthly_cancelled, "Tendencia de Facturas Canceladas (PRUEBA)", "test_alerta_cancelaciones.png")
+    if chart:
+        chart = dict(chart, title=f"{chart['title']} (PRUEBA)", filename="test_alerta_cancelaciones.png")
+        chart_to_send = alert_outbox.create_trend_chart(chart, os.getcwd())
 
     if alerts:
         send_alert("PRUEBA: Alerta Forense CFDI - Pico de Cancelaciones", "\n\n".join(alerts), image_path=chart_to_send)
@@ -126,5 +102,95 @@ def run_test():
     else:
         logging.warning("La prueba falló: No se detectó el pico. Revisa la lógica de los datos.")
 
+class SMTPStandIn(socketserver.StreamRequestHandler):
+    """Minimal local SMTP server: accepts every message, or answers 451 to the next `fail_next` MAIL FROMs."""
+
+    def handle(self):
+        server = self.server
+        server.sessions += 1
+        self.wfile.write(b"220 localhost SMTP stand-in\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode(errors='replace').strip().upper()
+            if cmd.startswith(('EHLO', 'HELO')):
+                self.wfile.write(b"250 localhost\r\n")
+            elif cmd.startswith('MAIL'):
+                if server.fail_next > 0:
+                    server.fail_next -= 1
+                    self.wfile.write(b"451 Temporary failure, try again later\r\n")
+                else:
+                    self.wfile.write(b"250 OK\r\n")
+            elif cmd.startswith('RCPT') or cmd.startswith('RSET') or cmd.startswith('NOOP'):
+                self.wfile.write(b"250 OK\r\n")
+            elif cmd.startswith('DATA'):
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                data = []
+                for data_line in iter(self.rfile.readline, b''):
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    data.append(data_line)
+                server.messages.append(email.message_from_bytes(b"".join(data)))
+                self.wfile.write(b"250 OK: queued\r\n")
+            elif cmd.startswith('QUIT'):
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                self.wfile.write(b"502 Command not implemented\r\n")
+
+def start_smtp_stand_in():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPStandIn)
+    server.daemon_threads = True
+    server.messages, server.sessions, server.fail_next = [], 0, 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_outbox_test():
+    """End-to-end: pipeline enqueue -> outbox worker -> local SMTP stand-in (with one transient failure)."""
+    logging.info("Starting Alert Outbox End-to-End Test...")
+    smtp = start_smtp_stand_in()
+    alert_outbox.SMTP_SERVER, alert_outbox.SMTP_PORT = smtp.server_address
+    alert_outbox.SMTP_STARTTLS = False
+    alert_outbox.SMTP_USER = alert_outbox.SMTP_PASSWORD = None
+    alert_outbox.ALERT_RECEIVER = "auditoria@example.com"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        outbox = os.path.join(tmp, "outbox.sqlite")
+        monthly_cancelled = pd.Series([10, 20], index=pd.PeriodIndex(['2025-12', '2026-01'], freq='M'))
+        chart = alert_outbox.chart_spec(monthly_cancelled, "Tendencia de Facturas Canceladas (PRUEBA)", "test_alerta_cancelaciones.png")
+
+        start = pd.Timestamp.now()
+        alert_outbox.enqueue("PRUEBA: Pico de Cancelaciones", "Incremento Atípico de Cancelaciones: 100.0%", chart=chart, path=outbox)
+        alert_outbox.enqueue("PRUEBA: Duplicados", "Posibles Duplicados Detectados", path=outbox)
+        alert_outbox.enqueue("PRUEBA: Retenciones", "Incremento Atípico de Retenciones", path=outbox)
+        enqueue_ms = (pd.Timestamp.now() - start).total_seconds() * 1000
+        assert not smtp.messages, "enqueue must not talk to SMTP"
+
+        # First delivery attempt fails with a 451; backoff 0 so the retry happens in the same drain
+        smtp.fail_next = 1
+        stats = alert_outbox.drain(outbox, batch_size=10, max_attempts=3, base_delay=0)
+        subjects = sorted(m['Subject'] for m in smtp.messages)
+        logging.info(f"Outbox drain: {stats}, {smtp.sessions} SMTP sessions, received {subjects}")
+
+        assert stats == {'sent': 3, 'failed': 1}, stats
+        assert len(smtp.messages) == 3
+        assert smtp.sessions == 2, "one session per batch (the retry runs in a second batch)"
+        chart_mail = next(m for m in smtp.messages if 'Cancelaciones' in m['Subject'])
+        assert any(part.get_content_type() == 'image/png' for part in chart_mail.walk()), "chart must be rendered and attached by the worker"
+
+        # A message that keeps failing is parked as dead instead of blocking the queue
+        alert_outbox.enqueue("PRUEBA: Siempre falla", "x", path=outbox)
+        smtp.fail_next = 5
+        alert_outbox.drain(outbox, max_attempts=2, base_delay=0)
+        with sqlite3.connect(outbox) as conn:
+            status = dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        assert status == {'sent': 3, 'dead': 1}, status
+
+    smtp.shutdown()
+    smtp.server_close()
+    logging.info(f"Alert outbox test passed (enqueue of 3 alerts took {enqueue_ms:.1f} ms).")
+
 if __name__ == "__main__":
     run_test()
+    run_outbox_test()
@@ -0,0 +1,510 @@
+"""
+Native CFDI XML ingestion: walks a directory of CFDI 3.3 / 4.0 XML files and appends them to
+the CSV lake (DATA_DIR) as the same tables the Laravel exports provide, so migration.py picks
+them up like any other new rows (including incremental runs, through updated_at).
+
+  - Parsing is a streaming expat pass over the raw bytes (no element tree is built) inside a
+    process pool; only the attributes of Comprobante, Emisor, Receptor, Conceptos, Impuestos,
+    TimbreFiscalDigital, Pagos 1.0/2.0 and Nómina 1.2 nodes are kept.
+  - A file whose sha256 (xml_hash) is already in cfdis.csv is skipped before it is parsed.
+  - Ids are assigned by the parent in batches; child tables are appended before their
+    parents so an interrupted run never leaves a parent row without its children.
+"""
+import os
+import re
+import sys
+import time
+import hashlib
+import argparse
+import csv
+import logging
+import multiprocessing
+from functools import lru_cache
+from xml.parsers import expat
+import numpy as np
+from dotenv import load_dotenv
+
+import schema_registry
+
+# Setup Logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Load Environment Variables
+load_dotenv()
+
+# Configuration
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+SOURCE_COMPANY_ID = os.getenv("SOURCE_COMPANY_ID")
+XML_WORKERS = int(os.getenv("XML_WORKERS", os.cpu_count() or 1))
+XML_BATCH_SIZE = int(os.getenv("XML_BATCH_SIZE", 5000))      # CFDIs appended to the lake per flush
+XML_CHUNKSIZE = int(os.getenv("XML_CHUNKSIZE", 64))           # Files handed to a worker at a time
+
+NAMESPACES = {
+    'http://www.sat.gob.mx/cfd/4': 'cfdi',
+    'http://www.sat.gob.mx/cfd/3': 'cfdi',
+    'http://www.sat.gob.mx/TimbreFiscalDigital': 'tfd',
+    'http://www.sat.gob.mx/Pagos20': 'pago',
+    'http://www.sat.gob.mx/Pagos': 'pago',
+    'http://www.sat.gob.mx/nomina12': 'nomina',
+}
+
+# Output columns per lake table (same order as the Laravel exports)
+TABLE_COLUMNS = {
+    'cfdis': ['id', 'company_id', 'uuid', 'direccion', 'tipo', 'serie', 'folio', 'fecha_emision', 'version', 'subtotal',
+              'descuento', 'total', 'moneda', 'tipo_cambio', 'forma_pago', 'metodo_pago', 'exportacion', 'lugar_expedicion',
+              'confirmacion', 'emisor_id', 'receptor_id', 'receptor_uso_cfdi', 'xml_path', 'pdf_path', 'xml_filename', 'xml_hash',
+              'xml_size', 'cancelado', 'fecha_cancelacion', 'motivo_cancelacion', 'estatus', 'metadata', 'created_at',
+              'updated_at', 'deleted_at', 'source'],
+    'cfdi_emisors': ['id', 'rfc', 'nombre', 'regimen_fiscal', 'curp', 'num_reg_id_trib', 'residencia_fiscal', 'metadata',
+                     'created_at', 'updated_at'],
+    'cfdi_receptors': ['id', 'rfc', 'nombre', 'domicilio_fiscal_cp', 'regimen_fiscal', 'curp', 'num_reg_id_trib',
+                       'residencia_fiscal', 'uso_cfdi_preferido', 'metadata', 'created_at', 'updated_at'],
+    'cfdi_relacionados': ['id', 'cfdi_id', 'tipo_relacion', 'uuid_relacionado', 'cfdi_relacionado_id', 'created_at', 'updated_at'],
+    'cfdi_conceptos': ['id', 'cfdi_id', 'clave_prod_serv', 'no_identificacion', 'cantidad', 'clave_unidad', 'unidad',
+                       'descripcion', 'valor_unitario', 'importe', 'descuento', 'objeto_impuesto', 'metadata', 'created_at',
+                       'updated_at'],
+    'cfdi_concepto_impuestos': ['id', 'cfdi_concepto_id', 'created_at', 'updated_at'],
+    'cfdi_concepto_traslados': ['id', 'cfdi_concepto_impuestos_id', 'base', 'impuesto', 'tipo_factor', 'tasa_o_cuota',
+                                'importe', 'created_at', 'updated_at'],
+    'cfdi_concepto_retenciones': ['id', 'cfdi_concepto_impuestos_id', 'base', 'impuesto', 'tipo_factor', 'tasa_o_cuota',
+                                  'importe', 'created_at', 'updated_at'],
+    'cfdi_comprobante_impuestos': ['id', 'cfdi_id', 'total_impuestos_trasladados', 'total_impuestos_retenidos',
+                                   'created_at', 'updated_at'],
+    'cfdi_comprobante_traslados': ['id', 'cfdi_comprobante_impuestos_id', 'impuesto', 'tipo_factor', 'tasa_o_cuota', 'base',
+                                   'importe', 'created_at', 'updated_at'],
+    'cfdi_comprobante_retenciones': ['id', 'cfdi_comprobante_impuestos_id', 'impuesto', 'importe', 'created_at', 'updated_at'],
+    'timbre_fiscal_digitales': ['id', 'cfdi_id', 'version', 'uuid', 'fecha_timbrado', 'sello_cfdi', 'no_certificado_sat',
+                                'sello_sat', 'rfc_prov_certif', 'leyenda', 'created_at', 'updated_at'],
+    'cfdi_pagos': ['id', 'cfdi_id', 'version', 'created_at', 'updated_at'],
+    'cfdi_pago_totales': ['id', 'cfdi_pago_id', 'total_retenciones_iva', 'total_retenciones_isr', 'total_retenciones_ieps',
+                          'total_traslados_base_iva16', 'total_traslados_impuesto_iva16', 'total_traslados_base_iva8',
+                          'total_traslados_impuesto_iva8', 'total_traslados_base_iva0', 'total_traslados_impuesto_iva0',
+                          'total_traslados_base_iva_exento', 'monto_total_pagos', 'created_at', 'updated_at'],
+    'cfdi_pago_detalles': ['id', 'cfdi_pago_id', 'fecha_pago', 'forma_pago_p', 'moneda_p', 'tipo_cambio_p', 'monto',
+                           'num_operacion', 'rfc_emisor_cta_ord', 'nom_banco_ord_ext', 'cta_ordenante', 'rfc_emisor_cta_ben',
+                           'cta_beneficiario', 'tipo_cad_pago', 'cert_pago', 'cad_pago', 'sello_pago', 'created_at', 'updated_at'],
+    'cfdi_pago_documentos_relacionados': ['id', 'cfdi_pago_detalle_id', 'id_documento', 'cfdi_relacionado_id', 'serie',
+                                          'folio', 'moneda_dr', 'equivalencia_dr', 'num_parcialidad', 'imp_saldo_ant',
+                                          'imp_pagado', 'imp_saldo_insoluto', 'objeto_imp_dr', 'created_at', 'updated_at'],
+    'cfdi_pago_dr_impuestos': ['id', 'cfdi_pago_documento_relacionado_id', 'base_dr', 'impuesto_dr', 'tipo_factor_dr',
+                               'tasa_o_cuota_dr', 'importe_dr', 'tipo', 'created_at', 'updated_at'],
+    'cfdi_nominas': ['id', 'cfdi_id', 'version', 'tipo_nomina', 'fecha_pago', 'fecha_inicial_pago', 'fecha_final_pago',
+                     'num_dias_pagados', 'total_percepciones', 'total_deducciones', 'total_otros_pagos', 'created_at', 'updated_at'],
+    'cfdi_nomina_emisores': ['id', 'cfdi_nomina_id', 'curp', 'registro_patronal', 'rfc_patron_origen', 'created_at', 'updated_at'],
+    'cfdi_nomina_receptores': ['id', 'cfdi_nomina_id', 'curp', 'num_seguridad_social', 'fecha_inicio_rel_laboral',
+                               'antiguedad', 'tipo_contrato', 'sindicalizado', 'tipo_jornada', 'tipo_regimen', 'num_empleado',
+                               'departamento', 'puesto', 'riesgo_puesto', 'periodicidad_pago', 'banco', 'cuenta_bancaria',
+                               'salario_base_cot_apor', 'salario_diario_integrado', 'clave_ent_fed', 'created_at', 'updated_at'],
+    'cfdi_nomina_percepciones': ['id', 'cfdi_nomina_id', 'tipo_percepcion', 'clave', 'concepto', 'importe_gravado',
+                                 'importe_exento', 'created_at', 'updated_at'],
+    'cfdi_nomina_horas_extra': ['id', 'cfdi_nomina_id', 'dias', 'tipo_horas', 'horas_extra', 'importe_pagado', 'created_at', 'updated_at'],
+    'cfdi_nomina_deducciones': ['id', 'cfdi_nomina_id', 'tipo_deduccion', 'clave', 'concepto', 'importe', 'created_at', 'updated_at'],
+    'cfdi_nomina_otros_pagos': ['id', 'cfdi_nomina_id', 'tipo_otro_pago', 'clave', 'concepto', 'importe', 'subsidio_causado',
+                                'created_at', 'updated_at'],
+    'cfdi_nomina_incapacidades': ['id', 'cfdi_nomina_id', 'dias_incapacidad', 'tipo_incapacidad', 'importe_monetario',
+                                  'created_at', 'updated_at'],
+}
+
+# child table -> (foreign key column, parent table); parents listed before their children
+FOREIGN_KEYS = {
+    'cfdi_relacionados': ('cfdi_id', 'cfdis'),
+    'cfdi_conceptos': ('cfdi_id', 'cfdis'),
+    'cfdi_concepto_impuestos': ('cfdi_concepto_id', 'cfdi_conceptos'),
+    'cfdi_concepto_traslados': ('cfdi_concepto_impuestos_id', 'cfdi_concepto_impuestos'),
+    'cfdi_concepto_retenciones': ('cfdi_concepto_impuestos_id', 'cfdi_concepto_impuestos'),
+    'cfdi_comprobante_impuestos': ('cfdi_id', 'cfdis'),
+    'cfdi_comprobante_traslados': ('cfdi_comprobante_impuestos_id', 'cfdi_comprobante_impuestos'),
+    'cfdi_comprobante_retenciones': ('cfdi_comprobante_impuestos_id', 'cfdi_comprobante_impuestos'),
+    'timbre_fiscal_digitales': ('cfdi_id', 'cfdis'),
+    'cfdi_pagos': ('cfdi_id', 'cfdis'),
+    'cfdi_pago_totales': ('cfdi_pago_id', 'cfdi_pagos'),
+    'cfdi_pago_detalles': ('cfdi_pago_id', 'cfdi_pagos'),
+    'cfdi_pago_documentos_relacionados': ('cfdi_pago_detalle_id', 'cfdi_pago_detalles'),
+    'cfdi_pago_dr_impuestos': ('cfdi_pago_documento_relacionado_id', 'cfdi_pago_documentos_relacionados'),
+    'cfdi_nominas': ('cfdi_id', 'cfdis'),
+    'cfdi_nomina_emisores': ('cfdi_nomina_id', 'cfdi_nominas'),
+    'cfdi_nomina_receptores': ('cfdi_nomina_id', 'cfdi_nominas'),
+    'cfdi_nomina_percepciones': ('cfdi_nomina_id', 'cfdi_nominas'),
+    'cfdi_nomina_horas_extra': ('cfdi_nomina_id', 'cfdi_nominas'),
+    'cfdi_nomina_deducciones': ('cfdi_nomina_id', 'cfdi_nominas'),
+    'cfdi_nomina_otros_pagos': ('cfdi_nomina_id', 'cfdi_nominas'),
+    'cfdi_nomina_incapacidades': ('cfdi_nomina_id', 'cfdi_nominas'),
+}
+DOCUMENT_TABLES = ['cfdis'] + list(FOREIGN_KEYS)
+
+# XML attribute -> column where the snake_case of the attribute is not the column name
+ATTRIBUTE_OVERRIDES = {
+    'cfdis': {'Fecha': 'fecha_emision', 'SubTotal': 'subtotal', 'TipoDeComprobante': 'tipo'},
+    'cfdi_receptors': {'DomicilioFiscalReceptor': 'domicilio_fiscal_cp', 'RegimenFiscalReceptor': 'regimen_fiscal'},
+    'cfdi_conceptos': {'ObjetoImp': 'objeto_impuesto'},
+    'timbre_fiscal_digitales': {'SelloCFD': 'sello_cfdi'},
+    'cfdi_pago_detalles': {'FormaDePagoP': 'forma_pago_p'},
+    'cfdi_nomina_receptores': {'Antigüedad': 'antiguedad'},
+}
+DATETIME_COLUMNS = {'fecha_emision', 'fecha_timbrado', 'fecha_pago'}
+
+_CAMEL = re.compile(r'(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])')
+
+
+@lru_cache(maxsize=None)
+def column_for(table, attribute):
+    """Lake column for an XML attribute of `table` (None if the table has no such column)."""
+    column = ATTRIBUTE_OVERRIDES.get(table, {}).get(attribute) or _CAMEL.sub('_', attribute).lower()
+    return column if column in TABLE_COLUMNS[table] else None
+
+
+def to_row(table, attrs):
+    row = {}
+    for name, value in attrs.items():
+        column = column_for(table, name)
+        if column:
+            row[column] = value.replace('T', ' ', 1) if column in DATETIME_COLUMNS else value
+    return row
+
+
+# --- Parsing (runs in the workers) ---
+
+def parse_cfdi(data):
+    """
+    Parses one CFDI XML document (bytes) into {'tables': {table: [rows]}, 'emisor': {...},
+    'receptor': {...}}. Row ids and foreign keys are local to the document (1-based).
+    """
+    tables = {}
+    doc = {'tables': tables, 'emisor': {}, 'receptor': {}}
+    stack = []
+    current = {}
+
+    def add(table, attrs, parent=None, **extra):
+        rows = tables.setdefault(table, [])
+        row = to_row(table, attrs)
+        row['id'] = len(rows) + 1
+        if parent is not None:
+            row[FOREIGN_KEYS[table][0]] = current[parent]
+        row.update(extra)
+        rows.append(row)
+        current[table] = row['id']
+        return row
+
+    def start(name, attrs):
+        uri, _, local = name.rpartition(' ')
+        ns = NAMESPACES.get(uri)
+        parent = stack[-1] if stack else None
+        stack.append(local)
+        if ns == 'cfdi':
+            if local == 'Comprobante':
+                add('cfdis', attrs)
+            elif local == 'Emisor':
+                doc['emisor'] = to_row('cfdi_emisors', attrs)
+            elif local == 'Receptor':
+                doc['receptor'] = to_row('cfdi_receptors', attrs)
+                current['uso_cfdi'] = attrs.get('UsoCFDI')
+            elif local == 'CfdiRelacionados':
+                current['tipo_relacion'] = attrs.get('TipoRelacion')
+            elif local == 'CfdiRelacionado':
+                add('cfdi_relacionados', {}, 'cfdis', tipo_relacion=current.get('tipo_relacion'), uuid_relacionado=attrs.get('UUID', '').lower())
+            elif local == 'Concepto':
+                add('cfdi_conceptos', attrs, 'cfdis')
+            elif local == 'Impuestos':
+                if parent == 'Concepto':
+                    add('cfdi_concepto_impuestos', {}, 'cfdi_conceptos')
+                elif parent == 'Comprobante':
+                    add('cfdi_comprobante_impuestos', attrs, 'cfdis')
+            elif local in ('Traslado', 'Retencion') and len(stack) >= 4:
+                owner = stack[-4]  # Concepto|Comprobante / Impuestos / Traslados / Traslado
+                kind = 'traslados' if local == 'Traslado' else 'retenciones'
+                if owner == 'Concepto':
+                    add(f'cfdi_concepto_{kind}', attrs, 'cfdi_concepto_impuestos')
+                elif owner == 'Comprobante':
+                    add(f'cfdi_comprobante_{kind}', attrs, 'cfdi_comprobante_impuestos')
+        elif ns == 'tfd' and local == 'TimbreFiscalDigital':
+            row = add('timbre_fiscal_digitales', attrs, 'cfdis')
+            row['uuid'] = row.get('uuid', '').lower()
+        elif ns == 'pago':
+            if local == 'Pagos':
+                add('cfdi_pagos', attrs, 'cfdis')
+            elif local == 'Totales':
+                add('cfdi_pago_totales', attrs, 'cfdi_pagos')
+            elif local == 'Pago':
+                add('cfdi_pago_detalles', attrs, 'cfdi_pagos')
+            elif local == 'DoctoRelacionado':
+                add('cfdi_pago_documentos_relacionados', attrs, 'cfdi_pago_detalles')
+            elif local in ('TrasladoDR', 'RetencionDR'):
+                add('cfdi_pago_dr_impuestos', attrs, 'cfdi_pago_documentos_relacionados',
+                    tipo='traslado' if local == 'TrasladoDR' else 'retencion')
+        elif ns == 'nomina':
+            if local == 'Nomina':
+                add('cfdi_nominas', attrs, 'cfdis')
+            elif local == 'Emisor':
+                add('cfdi_nomina_emisores', attrs, 'cfdi_nominas')
+            elif local == 'Receptor':
+                row = add('cfdi_nomina_receptores', attrs, 'cfdi_nominas')
+                if 'sindicalizado' in row:
+                    row['sindicalizado'] = 't' if row['sindicalizado'].lower().startswith('s') else 'f'
+            elif local == 'Percepcion':
+                add('cfdi_nomina_percepciones', attrs, 'cfdi_nominas')
+            elif local == 'HorasExtra':
+                add('cfdi_nomina_horas_extra', attrs, 'cfdi_nominas')
+            elif local == 'Deduccion':
+                add('cfdi_nomina_deducciones', attrs, 'cfdi_nominas')
+            elif local == 'OtroPago':
+                add('cfdi_nomina_otros_pagos', attrs, 'cfdi_nominas')
+            elif local == 'SubsidioAlEmpleo' and parent == 'OtroPago':
+                tables['cfdi_nomina_otros_pagos'][-1]['subsidio_causado'] = attrs.get('SubsidioCausado')
+            elif local == 'Incapacidad':
+                add('cfdi_nomina_incapacidades', attrs, 'cfdi_nominas')
+
+    def end(name):
+        stack.pop()
+
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.Parse(data, True)
+
+    cfdi = tables.get('cfdis')
+    if not cfdi:
+        raise ValueError("not a CFDI (no cfdi:Comprobante)")
+    timbre = tables.get('timbre_fiscal_digitales')
+    cfdi[0]['uuid'] = timbre[0]['uuid'] if timbre else None
+    cfdi[0]['receptor_uso_cfdi'] = current.get('uso_cfdi')
+    # Descuento is optional in the XML; the exports carry 0.00
+    cfdi[0].setdefault('descuento', '0.00')
+    for concepto in tables.get('cfdi_conceptos', ()):
+        concepto.setdefault('descuento', '0.00')
+    return doc
+
+
+_known_prefixes = np.empty(0, dtype=np.uint64)
+
+
+def _init_worker(known_prefixes):
+    global _known_prefixes
+    _known_prefixes = known_prefixes
+
+
+def hash_prefix(xml_hash):
+    return np.uint64(int(xml_hash[:16], 16))
+
+
+def process_file(path):
+    """Worker task: (path, xml_hash, size, doc | None, error | None). Known hashes are not parsed."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        return path, None, 0, None, f"{type(e).__name__}: {e}"
+    xml_hash = hashlib.sha256(data).hexdigest()
+    prefix = hash_prefix(xml_hash)
+    i = np.searchsorted(_known_prefixes, prefix)
+    if i < len(_known_prefixes) and _known_prefixes[i] == prefix:
+        return path, xml_hash, len(data), None, None
+    try:
+        return path, xml_hash, len(data), parse_cfdi(data), None
+    except Exception as e:
+        return path, xml_hash, len(data), None, f"{type(e).__name__}: {e}"
+
+
+def iter_xml_files(root):
+    """Every *.xml file below `root` (recursive, sorted per directory)."""
+    dirs = [root]
+    while dirs:
+        directory = dirs.pop()
+        with os.scandir(directory) as entries:
+            entries = sorted(entries, key=lambda e: e.name)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif entry.name.lower().endswith('.xml'):
+                yield entry.path
+
+
+# --- Lake side (runs in the parent) ---
+
+def table_path(table, data_dir):
+    return os.path.join(data_dir, schema_registry.TABLE_SCHEMAS[table]['file'])
+
+
+def read_column(table, column, data_dir):
+    if not os.path.exists(table_path(table, data_dir)):
+        return None
+    frame = schema_registry.read_table(table, data_dir, usecols=[column])
+    return frame[column] if frame is not None and column in frame.columns else None
+
+
+def next_ids(data_dir):
+    """
+    First free id per table: above the table's own ids and above every foreign key that
+    points at it (children of an interrupted run must never attach to a new parent).
+    """
+    top = {}
+    for table in TABLE_COLUMNS:
+        ids = read_column(table, 'id', data_dir)
+        top[table] = int(ids.max()) if ids is not None and ids.notna().any() else 0
+    for child, (fk, parent) in FOREIGN_KEYS.items():
+        refs = read_column(child, fk, data_dir)
+        if refs is not None and refs.notna().any():
+            top[parent] = max(top[parent], int(refs.max()))
+    return {table: value + 1 for table, value in top.items()}
+
+
+def load_catalog(table, data_dir):
+    """{rfc: id} of an emisor/receptor catalog."""
+    if not os.path.exists(table_path(table, data_dir)):
+        return {}
+    catalog = schema_registry.read_table(table, data_dir, usecols=['id', 'rfc'])
+    catalog = catalog.dropna(subset=['rfc'])
+    return dict(zip(catalog['rfc'].astype(str).str.upper(), catalog['id'].astype(int)))
+
+
+def company_rfc(company_id, data_dir):
+    if company_id is None:
+        return None
+    companies = schema_registry.read_table('companies', data_dir)
+    if companies is None:
+        return None
+    match = companies.loc[companies['id'].astype(str) == str(company_id), 'rfc']
+    return str(match.iloc[0]).upper() if not match.empty else None
+
+
+def append_table(table, rows, data_dir):
+    """Appends rows (dicts) to a lake CSV, keeping the column order and encoding of the existing file."""
+    if not rows:
+        return
+    path = table_path(table, data_dir)
+    exists = os.path.exists(path)
+    encoding = schema_registry.detect_encoding(path) if exists else 'utf-8'
+    if exists:
+        with open(path, newline='', encoding=encoding) as f:
+            header = next(csv.reader(f))
+    else:
+        header = TABLE_COLUMNS[table]
+    with open(path, 'a', newline='', encoding=encoding, errors='replace') as f:
+        writer = csv.DictWriter(f, fieldnames=header, extrasaction='ignore')
+        if not exists:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+def resolve_party(table, party, catalog, ids, new_rows, now):
+    rfc = (party.get('rfc') or '').upper()
+    if rfc not in catalog:
+        catalog[rfc] = ids[table]
+        ids[table] += 1
+        new_rows.append(dict(party, id=catalog[rfc], rfc=rfc, created_at=now, updated_at=now))
+    return catalog[rfc]
+
+
+def flush(batch, xml_dir, ids, catalogs, data_dir, company_id=None, rfc=None):
+    """
+    Assigns lake ids to a batch of parsed documents and appends every table. Children are
+    written before their parents (catalogs and cfdis last).
+    """
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    party_rows = {'cfdi_emisors': [], 'cfdi_receptors': []}
+    for path, xml_hash, size, doc in batch:
+        cfdi = doc['tables']['cfdis'][0]
+        emisor_rfc = (doc['emisor'].get('rfc') or '').upper()
+        cfdi.update(
+            emisor_id=resolve_party('cfdi_emisors', doc['emisor'], catalogs['cfdi_emisors'], ids, party_rows['cfdi_emisors'], now),
+            receptor_id=resolve_party('cfdi_receptors', doc['receptor'], catalogs['cfdi_receptors'], ids, party_rows['cfdi_receptors'], now),
+            company_id=company_id,
+            direccion=('emitido' if emisor_rfc == rfc else 'recibido') if rfc else None,
+            xml_path=os.path.relpath(path, xml_dir), xml_filename=os.path.basename(path), xml_hash=xml_hash, xml_size=size,
+            cancelado='f', estatus='vigente', source='xml'
+        )
+
+    # Local ids -> lake ids: each document's rows follow the previous document's in every table
+    offsets = [{} for _ in batch]
+    table_rows = {}
+    for table in DOCUMENT_TABLES:
+        fk, parent = FOREIGN_KEYS.get(table, (None, None))
+        base = ids[table] - 1
+        rows = []
+        for doc_offsets, (_, _, _, doc) in zip(offsets, batch):
+            part = doc['tables'].get(table)
+            if not part:
+                continue
+            for row in part:
+                row['id'] += base
+                if fk:
+                    row[fk] += doc_offsets[parent]
+                row['created_at'] = row['updated_at'] = now
+            doc_offsets[table] = base
+            base += len(part)
+            rows.extend(part)
+        ids[table] = base + 1
+        table_rows[table] = rows
+
+    for table in reversed(DOCUMENT_TABLES[1:]):
+        append_table(table, table_rows[table], data_dir)
+    for table, rows in party_rows.items():
+        append_table(table, rows, data_dir)
+    append_table('cfdis', table_rows['cfdis'], data_dir)
+
+
+def ingest(xml_dir, data_dir=DATA_DIR, company_id=SOURCE_COMPANY_ID, rfc=None, workers=XML_WORKERS,
+           batch_size=XML_BATCH_SIZE, chunksize=XML_CHUNKSIZE):
+    """
+    Ingests every new XML below `xml_dir` into the lake at `data_dir`.
+    Returns {'files', 'ingested', 'skipped', 'failed', 'seconds'}.
+    """
+    start = time.perf_counter()
+    known = read_column('cfdis', 'xml_hash', data_dir)
+    known = set(known.dropna().astype(str).str.lower()) if known is not None else set()
+    prefixes = np.unique(np.array([hash_prefix(h) for h in known if len(h) >= 16], dtype=np.uint64))
+    ids = next_ids(data_dir)
+    catalogs = {table: load_catalog(table, data_dir) for table in ('cfdi_emisors', 'cfdi_receptors')}
+    rfc = (rfc or company_rfc(company_id, data_dir) or '').upper() or None
+
+    stats = {'files': 0, 'ingested': 0, 'skipped': 0, 'failed': 0}
+    batch = []
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes=max(1, workers), initializer=_init_worker, initargs=(prefixes,)) as pool:
+        for path, xml_hash, size, doc, error in pool.imap(process_file, iter_xml_files(xml_dir), chunksize=chunksize):
+            stats['files'] += 1
+            if error:
+                logging.error(f"{path}: {error}")
+                stats['failed'] += 1
+                continue
+            if xml_hash in known:
+                stats['skipped'] += 1
+                continue
+            if doc is None:
+                # 64-bit prefix collision with an ingested file: parse it here
+                try:
+                    with open(path, 'rb') as f:
+                        doc = parse_cfdi(f.read())
+                except Exception as e:
+                    logging.error(f"{path}: {type(e).__name__}: {e}")
+                    stats['failed'] += 1
+                    continue
+            known.add(xml_hash)  # identical copies later in the walk are skipped too
+            batch.append((path, xml_hash, size, doc))
+            if len(batch) >= batch_size:
+                flush(batch, xml_dir, ids, catalogs, data_dir, company_id, rfc)
+                stats['ingested'] += len(batch)
+                batch = []
+        if batch:
+            flush(batch, xml_dir, ids, catalogs, data_dir, company_id, rfc)
+            stats['ingested'] += len(batch)
+
+    stats['seconds'] = time.perf_counter() - start
+    rate = stats['files'] / max(stats['seconds'], 1e-9)
+    logging.info(f"XML ingestion: {stats['files']} files ({stats['ingested']} new, {stats['skipped']} already ingested, "
+                 f"{stats['failed']} failed) in {stats['seconds']:.2f} s, {rate:,.0f} files/s with {workers} workers")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CFDI XML Ingestion into the CSV lake")
+    parser.add_argument("xml_dir", help="Directory with CFDI XML files (searched recursively)")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Lake directory the tables are appended to")
+    parser.add_argument("--company-id", default=SOURCE_COMPANY_ID, help="companies.id stamped on the new CFDIs")
+    parser.add_argument("--rfc", help="Tenant RFC used for direccion (emitido/recibido); defaults to companies.csv")
+    parser.add_argument("--workers", type=int, default=XML_WORKERS, help="Parser processes")
+    parser.add_argument("--batch-size", type=int, default=XML_BATCH_SIZE, help="CFDIs appended to the lake per flush")
+    args = parser.parse_args()
+
+    stats = ingest(args.xml_dir, args.data_dir, args.company_id, args.rfc, args.workers, args.batch_size)
+    sys.exit(1 if stats['failed'] else 0)